@@ -127,41 +127,34 @@ class bookmark_list(object):
             self.add(uri, line, source, comment)
             return True
 
-    def update(self, uri, offset, cur_line, end_line):
-        if self._list.has_key(uri):
-            iters = {}
-            
-            keys = self._list[uri]["iters"].keys()
+    def move(self, uri, moves): # Moves bookmarks of an uri to new lines (returns old lines of the dropped ones)
+        dropped = []
+        moved = []
+        
+        iters = self.get_iters(uri)
+        
+        for line in sorted(moves.keys()):
+            if not iters.has_key(line):
+                dropped.append(line)
+                continue
             
-            for line in keys:
-                row = self._list[uri]["iters"][line]
-                
-                comment = self._config.get(uri, str(line))
-                self._config.remove_option(uri, str(line))
-
-                if line < cur_line:
-                    self._list[uri]["store"].set_value(row, 0, line)
-                    iters[line] = row
-                    
-                    # Upadate configuration
-                    self._config.set(uri, str(line), comment)
-                    
-                elif (end_line < 0 and line >= cur_line) or (end_line >= 0 and line > end_line):
-                    line = line-offset
-                    self._list[uri]["store"].set_value(row, 0, line)
-                    iters[line] = row
-                    
-                    # Upadate configuration
-                    self._config.set(uri, str(line), comment)
-                    
-                else:
-                    self._list[uri]["store"].remove(row)
-                    
-            self._list[uri]["iters"] = iters
+            moved.append((line, iters.pop(line), self._config.get(uri, str(line))))
+            self._config.remove_option(uri, str(line))
+        
+        # Upadate configuration once all old lines are removed
+        for line, row, comment in moved:
+            new_line = moves[line]
             
-            return True 
-        else:
-            return False
+            # Two bookmarks can not share a line, the first one wins
+            if iters.has_key(new_line):
+                self._list[uri]["store"].remove(row)
+                dropped.append(line)
+            else:
+                self._list[uri]["store"].set_value(row, 0, new_line)
+                iters[new_line] = row
+                self._config.set(uri, str(new_line), comment)
+        
+        return dropped
 
     def _line_sort(self, model, line1, line2):
         val1 = model.get_value(line1, 0)
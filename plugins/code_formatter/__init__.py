@@ -14,13 +14,16 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 from gettext import gettext as _
+import gobject
 import gtk
 import gedit
 import re
-import os
-import subprocess
 
+from lib.threads import start_thread
+from server import FormatterProcess, FormatterError
 
+# Width of an indent level in the Ruby beautifier output
+INDENT_WIDTH = 2
 
 ui_str = """<ui>
   <menubar name="MenuBar">
@@ -38,6 +41,10 @@ class CodeFormatterPlugin(gedit.Plugin):
         gedit.Plugin.__init__(self)
         self._instances = {}
 
+        # Started on the first request and shared by all windows
+        self.formatter = FormatterProcess()
+        self.busy = False
+
     def activate(self, window):
         self._instances[window] = CodeFormatterWindowHelper(self, window)
 
@@ -45,15 +52,41 @@ class CodeFormatterPlugin(gedit.Plugin):
         self._instances[window].deactivate()
         del self._instances[window]
 
+        if not self._instances:
+            self.formatter.cancel()
+
     def update_ui(self, window):
         self._instances[window].update_ui()
 
+    def format(self, text, indent, callback):
+        """
+            Formats text in a background thread, so a slow formatter does not
+            freeze gedit, and calls callback(out, error) from the main loop.
+            One request runs at a time.
+        """
+        self.busy = True
+        start_thread(self._format, (text, indent, callback))
+
+    def _format(self, text, indent, callback): # Runs in a background thread
+        try:
+            out, error = self.formatter.format(text, indent), None
+        except FormatterError, e:
+            out, error = None, e
+        gobject.idle_add(self._formatted, callback, out, error)
+
+    def _formatted(self, callback, out, error):
+        self.busy = False
+        callback(out, error)
+        return False
+
 class CodeFormatterWindowHelper:
     handlers = {}
     
     def __init__(self, plugin, window):
         self._window = window
         self._plugin = plugin
+        self._statusbar = window.get_statusbar()
+        self._context_id = self._statusbar.get_context_id("CodeFormatter")
 
         # Insert menu items
         self._insert_menu()
@@ -65,6 +98,7 @@ class CodeFormatterWindowHelper:
 
         self._window = None
         self._plugin = None
+        self._statusbar = None
         self._action_group = None
 
         
@@ -104,12 +138,77 @@ class CodeFormatterWindowHelper:
         doc = self._window.get_active_document()
         if not doc:
             return
-        formatter_script = os.path.join(os.path.dirname(__file__), "rubybeautifier.rb")
-        start, end = doc.get_bounds()
-        txt = doc.get_text(start,end)
-        proc = subprocess.Popen(["ruby",formatter_script], stdout=subprocess.PIPE, stdin=subprocess.PIPE)
-        proc.stdin.write(txt)
-        proc.stdin.close()
-        out = proc.stdout.read()
-        doc.set_text(out)
 
+        if self._plugin.busy:
+            self._statusbar.flash_message(self._context_id, _("The code is already being formatted"))
+            return
+
+        # Format the selected lines only, at the indent level of the first one
+        indent = 0
+        if doc.get_has_selection():
+            start, end = doc.get_selection_bounds()
+            start.set_line_offset(0)
+            if not end.starts_line():
+                end.forward_line()
+            txt = doc.get_text(start, end)
+            first = txt.split("\n", 1)[0].expandtabs(INDENT_WIDTH)
+            indent = (len(first) - len(first.lstrip())) / INDENT_WIDTH
+        else:
+            start, end = doc.get_bounds()
+            txt = doc.get_text(start, end)
+
+        offset = start.get_offset()
+        self._statusbar.push(self._context_id, _("Formatting the code..."))
+        self._plugin.format(txt, indent, lambda out, error: self.on_code_formatted(doc, offset, txt, out, error))
+
+    def on_code_formatted(self, doc, offset, txt, out, error):
+        # The window may have been closed or the plugin disabled meanwhile
+        if self._window is None:
+            return
+        self._statusbar.pop(self._context_id)
+
+        if error is not None:
+            self._statusbar.flash_message(self._context_id, _("Could not format the code: %s") % error)
+            return
+
+        # Edits made while the formatter ran would be overwritten
+        end = offset + len(unicode(txt, "utf-8"))
+        if doc not in self._window.get_documents() or doc.get_char_count() < end or \
+                doc.get_text(doc.get_iter_at_offset(offset), doc.get_iter_at_offset(end)) != txt:
+            self._statusbar.flash_message(self._context_id, _("The code changed while it was formatted"))
+            return
+
+        # The beautifier ends every line, the last one included
+        if not txt.endswith("\n") and out.endswith("\n"):
+            out = out[:-1]
+
+        self.replace_changed_lines(doc, offset, txt, out)
+
+    def replace_changed_lines(self, doc, offset, old, new):
+        # Lines left as they were are not touched, so the undo step and the
+        # cursor only concern the lines that changed
+        old_lines = old.splitlines(True)
+        new_lines = new.splitlines(True)
+        count = min(len(old_lines), len(new_lines))
+
+        prefix = 0
+        while prefix < count and old_lines[prefix] == new_lines[prefix]:
+            prefix += 1
+        suffix = 0
+        while suffix < count - prefix and old_lines[-1 - suffix] == new_lines[-1 - suffix]:
+            suffix += 1
+
+        removed = "".join(old_lines[prefix:len(old_lines) - suffix])
+        added = "".join(new_lines[prefix:len(new_lines) - suffix])
+        if removed == added:
+            return
+
+        # Buffer offsets count characters, the text is utf-8
+        offset += len(unicode("".join(old_lines[:prefix]), "utf-8"))
+        start = doc.get_iter_at_offset(offset)
+        end = doc.get_iter_at_offset(offset + len(unicode(removed, "utf-8")))
+
+        doc.begin_user_action()
+        doc.delete(start, end)
+        doc.insert(start, added)
+        doc.end_user_action()
@@ -58,12 +58,10 @@ def addLine(line,tab)
    return line + "\n"
 end
 
-def beautifyRuby
+def beautifyRuby(source, tab = 0)
    commentBlock = false
    multiLineArray = Array.new
    multiLineStr = ""
-   tab = 0
-   source = STDIN.read
    dest = ""
    source.split("\n").each do |line|
       # combine continuing lines
@@ -127,11 +125,32 @@ def beautifyRuby
          commentBlock = false
       end
    end
-   STDOUT.write(dest)
    # uncomment this to complain about mismatched blocks
    #if(tab != 0)
    #  STDERR.puts "Indentation error: #{tab}"
    #end 
+   return dest
 end
 
-beautifyRuby 
+# Formats requests until STDIN is closed. A request is a line with the
+# starting indent level and the source length, followed by the source;
+# the reply is a line with the length of the result, followed by it.
+def serveRequests
+   STDIN.binmode
+   STDOUT.binmode
+   STDOUT.sync = true
+   while header = STDIN.gets
+      tab, length = header.split.map { |n| n.to_i }
+      source = (length > 0)?STDIN.read(length):""
+      dest = beautifyRuby(source, tab)
+      size = (dest.respond_to? :bytesize) ? dest.bytesize : dest.length
+      STDOUT.write("#{size}\n")
+      STDOUT.write(dest)
+   end
+end
+
+if ARGV.include?("--server")
+   serveRequests
+else
+   STDOUT.write(beautifyRuby(STDIN.read))
+end 
@@ -0,0 +1,135 @@
+# Copyright (C) 2007 - Nando Vieira
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+# A formatter process stays alive between requests. Each request is a
+# header line "<indent level> <length>" followed by that many bytes of
+# source, and each reply a line "<length>" followed by the formatted
+# source. Running this file as a script serves the same protocol without
+# changing the source, so the plugin can be exercised without Ruby.
+#
+# Requests are made from a background thread. cancel may be called from
+# another thread meanwhile, so a request only works with the process it
+# started and only stops that one when it fails.
+
+import os
+import select
+import subprocess
+import sys
+import time
+
+# Seconds a formatter has to answer before it is killed
+FORMAT_TIMEOUT = 5
+
+RUBY_COMMAND = ["ruby", os.path.join(os.path.dirname(__file__), "rubybeautifier.rb"), "--server"]
+
+
+class FormatterError(Exception):
+    pass
+
+
+class FormatterProcess(object):
+    def __init__(self, command=RUBY_COMMAND, timeout=FORMAT_TIMEOUT):
+        self.command = command
+        self.timeout = timeout
+        self._proc = None
+        self._buffer = ""
+
+    def format(self, text, indent=0):
+        """Returns text formatted as if it started at the indent level."""
+        proc = None
+        try:
+            proc = self._start()
+            deadline = time.time() + self.timeout
+            self._write(proc, "%d %d\n%s" % (indent, len(text), text), deadline)
+            length = int(self._readline(proc, deadline))
+            return self._read(proc, length, deadline)
+        except (OSError, IOError, ValueError, FormatterError), e:
+            # The process state is unknown after a failure, start over next time
+            self._stop(proc)
+            raise FormatterError(str(e))
+
+    def cancel(self):
+        """Kills the process, a new one is started by the next request."""
+        self._stop(self._proc)
+
+    def _stop(self, proc):
+        if proc is None:
+            return
+        if self._proc is proc:
+            self._proc = None
+            self._buffer = ""
+        try:
+            proc.kill()
+        except OSError:
+            pass
+        proc.wait()
+
+    def _start(self):
+        if self._proc is None or self._proc.poll() is not None:
+            self._buffer = ""
+            self._proc = subprocess.Popen(self.command, stdin=subprocess.PIPE,
+                                          stdout=subprocess.PIPE, close_fds=True)
+        return self._proc
+
+    def _write(self, proc, data, deadline):
+        # A pipe takes PIPE_BUF bytes without blocking once it is writable
+        fd = proc.stdin.fileno()
+        while data:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([], [fd], [], remaining)[1]:
+                raise FormatterError("formatter timed out")
+            written = os.write(fd, data[:select.PIPE_BUF])
+            data = data[written:]
+
+    def _fill(self, proc, deadline):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise FormatterError("formatter timed out")
+        fd = proc.stdout.fileno()
+        if not select.select([fd], [], [], remaining)[0]:
+            raise FormatterError("formatter timed out")
+        data = os.read(fd, 65536)
+        if not data:
+            raise FormatterError("formatter exited")
+        self._buffer += data
+
+    def _readline(self, proc, deadline):
+        while "\n" not in self._buffer:
+            self._fill(proc, deadline)
+        line, self._buffer = self._buffer.split("\n", 1)
+        return line
+
+    def _read(self, proc, length, deadline):
+        while len(self._buffer) < length:
+            self._fill(proc, deadline)
+        data, self._buffer = self._buffer[:length], self._buffer[length:]
+        return data
+
+
+def serve(stdin=sys.stdin, stdout=sys.stdout):
+    """Answers requests with their source unchanged."""
+    while True:
+        header = stdin.readline()
+        if not header:
+            break
+        indent, length = [int(n) for n in header.split()]
+        text = stdin.read(length)
+        stdout.write("%d\n%s" % (len(text), text))
+        stdout.flush()
+
+
+if __name__ == "__main__":
+    serve()
@@ -21,13 +21,17 @@ import pygtk
 pygtk.require("2.0")
 import gtk
 import gedit
+import gobject
 import time
 import os
 import sys
 import gettext
+import threading
 import ConfigParser
+import StringIO
 import bookmarks
 import window_helper
+from lib.threads import start_thread
 
 APP_NAME = "plugin"
 LOC_PATH = os.path.join(os.path.expanduser("~/.gnome2/gedit/plugins/advanced-bookmarks/lang"))
@@ -35,12 +39,22 @@ LOC_PATH = os.path.join(os.path.expanduser("~/.gnome2/gedit/plugins/advanced-boo
 gettext.find(APP_NAME, LOC_PATH)
 gettext.install(APP_NAME, LOC_PATH, True)
 
+# Seconds to wait for more changes before bookmarks are written to disk
+FLUSH_DELAY = 3
+
 class AdvancedBookmarksPlugin(gedit.Plugin):
 
     def __init__(self):
         gedit.Plugin.__init__(self)
         
         self._instances = {}
+        
+        # Pending configuration changes
+        self._dirty = False
+        self._flush_id = None
+        self._write_lock = threading.Lock()
+        self._dumps = 0
+        self._written = 0
 
         # Setup configuration file path
         conf_path = os.path.join(os.path.expanduser("~/.gnome2/gedit/plugins/"), "advanced-bookmarks/plugin.conf")
@@ -62,9 +76,16 @@ class AdvancedBookmarksPlugin(gedit.Plugin):
         self._instances[window] = window_helper.window_helper(self, window, self._bookmarks, self._config)
         
     def deactivate(self, window):
+        # Bookmarks are renumbered lazily, catch up before the window goes away
+        if self._instances[window].resolve_lines():
+            self._dirty = True
+        
         self._instances[window].deactivate()
         del self._instances[window]
         
+        # Do not lose pending changes when gedit quits
+        self.flush_config()
+        
     def update_ui(self, window):
         self._instances[window].update_ui()
                         
@@ -130,10 +151,59 @@ class AdvancedBookmarksPlugin(gedit.Plugin):
         if not self._config.has_option("common", "highlight_color"):
             self._config.set("common", "highlight_color", "#FFF0DC")
         
-    def write_config(self): # Saves configuration to a file
-        self._conf_file.truncate(0)
-        self._conf_file.seek(0)
-
-        self._config.write(self._conf_file)
+    def write_config(self): # Saves configuration to a file right away
+        if self._flush_id is not None:
+            gobject.source_remove(self._flush_id)
+            self._flush_id = None
+        
+        self._write_file(*self._dump_config())
+        
+    def schedule_write(self): # Saves configuration a few seconds later, coalescing the changes made meanwhile
+        self._dirty = True
+        
+        if self._flush_id is None:
+            self._flush_id = gobject.timeout_add_seconds(FLUSH_DELAY, self._on_flush_timeout)
+            
+    def flush_config(self): # Saves pending changes right away
+        if self._dirty:
+            self.write_config()
+        
+    def _on_flush_timeout(self):
+        self._flush_id = None
+        
+        if self._dirty:
+            # Configuration is only read on the main thread, the file is written in background
+            start_thread(self._write_file, self._dump_config(), daemon=False)
+        
+        return False
+        
+    def _dump_config(self): # Returns a serial number and the configuration file contents
+        # Bookmarks are renumbered lazily, make them match the documents first
+        for window in self._instances:
+            self._instances[window].resolve_lines()
+        
+        self._dirty = False
+        self._dumps += 1
+        
+        text = StringIO.StringIO()
+        self._config.write(text)
+        
+        return self._dumps, text.getvalue()
+        
+    def _write_file(self, serial, text):
+        self._write_lock.acquire()
+        try:
+            # A newer dump may have been written meanwhile
+            if serial < self._written:
+                return
+            self._written = serial
+            
+            self._conf_file.truncate(0)
+            self._conf_file.seek(0)
+            
+            self._conf_file.write(text)
+            self._conf_file.flush()
+        finally:
+            self._write_lock.release()
         
 #ex:ts=4:et:
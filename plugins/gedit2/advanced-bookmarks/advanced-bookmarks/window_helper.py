@@ -21,6 +21,7 @@ import pygtk
 pygtk.require("2.0")
 import gtk
 import gedit
+import gobject
 import time
 import os
 import sys
@@ -28,6 +29,12 @@ import pango
 import bookmarks
 import toggle_dlg
 
+# Category of the source marks showing the bookmarks in the gutter
+MARK_CATEGORY = "advanced-bookmark"
+
+# Milliseconds to wait after a change before the visible bookmarks are renumbered
+RESOLVE_DELAY = 500
+
 class window_helper:
     def __init__(self, plugin, window, bookmarks, config):
         self._window = window
@@ -36,7 +43,7 @@ class window_helper:
         self._bookmarks = bookmarks
         self._config = config
         
-        self._doc_lines = {}
+        self._resolve_id = None
 
         # Create icon
         self._icon = gtk.Image()
@@ -88,6 +95,7 @@ class window_helper:
         self._tree.connect("row-activated", self._on_row_activated)
         self._tree.connect("cursor-changed", self._on_row_selected)
         self._tree.connect("focus-in-event", self._on_tree_focused)
+        self._tree.connect("map", self._on_tree_mapped)
 
         # Create popup menu for tree
         self._popup_menu = gtk.Menu()
@@ -140,16 +148,44 @@ class window_helper:
 
         # Setup handlers for all documents
         for doc in window.get_documents():
-            doc.connect("loaded", self._on_doc_loaded)
+            self._connect_doc(doc)
+            
+            if doc.get_uri():
+                self._on_doc_loaded(doc, None)
+        
+        # Setup highlighting for all views
+        highlight = self._config.getboolean("common", "highlighting")
+        for view in window.get_views():
+            self._setup_view_highlighting(view, highlight)
             
         # Setup tab handlers
-        window.connect("tab-added", self._on_tab_added)
-        window.connect("tab-removed", self._on_tab_removed)
-        window.connect("active-tab-changed", self._on_tab_changed)
+        self._window_handlers = [
+            window.connect("tab-added", self._on_tab_added),
+            window.connect("tab-removed", self._on_tab_removed),
+            window.connect("active-tab-changed", self._on_tab_changed),
+        ]
     
     def deactivate(self):
         # Remove any installed menu items
         self._remove_menu()
+        
+        if self._resolve_id is not None:
+            gobject.source_remove(self._resolve_id)
+            self._resolve_id = None
+        
+        # Remove bookmark anchors and their highlighting
+        for view in self._window.get_views():
+            view.set_mark_category_background(MARK_CATEGORY, None)
+        
+        for doc in self._window.get_documents():
+            self._disconnect_doc(doc)
+            self._clear_anchors(doc)
+            doc.set_data("AdvancedBookmarksAnchors", None)
+            doc.set_data("AdvancedBookmarksIcons", None)
+
+        for handler_id in self._window_handlers:
+            self._window.disconnect(handler_id)
+        self._window_handlers = []
 
         self._window = None
         self._plugin = None
@@ -162,8 +198,125 @@ class window_helper:
         doc = self._window.get_active_document()
         if doc:
             uri = doc.get_uri()
+            
+            if self.resolve_lines(doc):
+                self._plugin.schedule_write()
+            
             self._tree.set_model(self._bookmarks.get_store(uri))
             
+    def resolve_lines(self, doc=None): # Renumbers bookmarks whose anchors moved since the last call (returns True if any did)
+        if doc is None:
+            docs = self._window.get_documents()
+        else:
+            docs = [doc]
+        
+        resolved = False
+        
+        for d in docs:
+            if d.get_data("AdvancedBookmarksMoved"):
+                d.set_data("AdvancedBookmarksMoved", False)
+                
+                if self._resolve_doc_lines(d):
+                    resolved = True
+                
+        return resolved
+        
+    def _resolve_doc_lines(self, doc):
+        uri = doc.get_uri()
+        anchors = self._get_anchors(doc)
+        
+        # Compare the lines the anchors are at with the ones bookmarks are stored under
+        moves = {}
+        for mark in anchors:
+            line = doc.get_iter_at_mark(mark).get_line() + 1
+            
+            if line != anchors[mark]:
+                moves[anchors[mark]] = line
+        
+        if not uri or not moves:
+            return False
+        
+        dropped = self._bookmarks.move(uri, moves)
+        
+        for mark in anchors.keys():
+            line = anchors[mark]
+            
+            if line in dropped:
+                self._delete_anchor(doc, mark)
+            elif moves.has_key(line):
+                anchors[mark] = moves[line]
+        
+        return True
+        
+    def _get_anchors(self, doc): # Returns the bookmark marks of a document mapped to the lines the bookmarks are stored under
+        anchors = doc.get_data("AdvancedBookmarksAnchors")
+        
+        if anchors is None:
+            anchors = {}
+            doc.set_data("AdvancedBookmarksAnchors", anchors)
+            
+        return anchors
+        
+    def _get_icons(self, doc): # Returns the source marks drawing the bookmarks in the gutter mapped by their anchors
+        icons = doc.get_data("AdvancedBookmarksIcons")
+        
+        if icons is None:
+            icons = {}
+            doc.set_data("AdvancedBookmarksIcons", icons)
+            
+        return icons
+        
+    def _add_anchor(self, doc, line): # Anchors a bookmark (line starting from 1) to the document text
+        text_iter = doc.get_iter_at_line(line-1)
+        
+        # The anchor has right gravity, so text inserted at the start of the line pushes it down with the line
+        mark = doc.create_mark(None, text_iter, False)
+        self._get_anchors(doc)[mark] = line
+        self._get_icons(doc)[mark] = doc.create_source_mark(None, MARK_CATEGORY, text_iter)
+        
+    def _delete_anchor(self, doc, mark):
+        del self._get_anchors(doc)[mark]
+        doc.delete_mark(mark)
+        doc.delete_mark(self._get_icons(doc).pop(mark))
+        
+    def _remove_anchor(self, doc, line):
+        anchors = self._get_anchors(doc)
+        
+        for mark in anchors.keys():
+            if anchors[mark] == line:
+                self._delete_anchor(doc, mark)
+                
+    def _clear_anchors(self, doc):
+        for mark in self._get_anchors(doc).keys():
+            self._delete_anchor(doc, mark)
+        
+    def _move_icons(self, doc): # Moves the gutter marks back to the lines of their anchors
+        icons = self._get_icons(doc)
+        
+        for mark in icons:
+            text_iter = doc.get_iter_at_mark(mark)
+            
+            if doc.get_iter_at_mark(icons[mark]).get_line() != text_iter.get_line():
+                doc.move_mark(icons[mark], text_iter)
+        
+    def _bookmark_at(self, doc, line): # Returns the stored line of a bookmark anchored at a document line (strarting from 0)
+        anchors = self._get_anchors(doc)
+        
+        for mark in anchors:
+            if doc.get_iter_at_mark(mark).get_line() == line:
+                return anchors[mark]
+                
+        return None
+        
+    def _doc_line(self, doc, line): # Returns the document line (starting from 1) of a stored bookmark line
+        anchors = self._get_anchors(doc)
+        
+        for mark in anchors:
+            if anchors[mark] == line:
+                return doc.get_iter_at_mark(mark).get_line() + 1
+                
+        return line
+            
     def _insert_menu(self):
         # Get UI manager
         manager = self._window.get_ui_manager()
@@ -227,6 +380,10 @@ class window_helper:
         	uri = None
         	
         if uri:
+            # Bookmarks must match the document lines before they are looked up
+            if self.resolve_lines(doc):
+                self._plugin.schedule_write()
+            
             # Get current position
             text_iter = doc.get_iter_at_mark(doc.get_insert())
 
@@ -260,8 +417,14 @@ class window_helper:
                 # Toggle bookmark
                 added = self._bookmarks.toggle(uri, line+1, source, comment)
                 
+                # Anchor the bookmark to the text, its gutter mark highlights the line too
+                if added:
+                    self._add_anchor(doc, line+1)
+                else:
+                    self._remove_anchor(doc, line+1)
+                
                 # Save bookmarks
-                self._plugin.write_config()
+                self._plugin.schedule_write()
 
                 # Update sensitivity of edit button and menu item
                 self._btn_edit.set_sensitive(added)
@@ -277,9 +440,6 @@ class window_helper:
                     
                     self._tree.set_model(store)
                     self._tree.set_cursor(path[0])
-
-                highlight = self._config.getboolean("common", "highlighting")
-                self.set_line_highlighting(doc, start, end, added and highlight)
                         
 	        buf = self._window.get_active_view()
             buf.grab_focus()
@@ -292,73 +452,33 @@ class window_helper:
         # Hide configuration dialog
         dlg_toggle.hide()
     	
-    def _on_insert_text(self, textbuffer, iter, text, length):
-        # Get document uri
-        doc = self._window.get_active_document()
-        uri = doc.get_uri()
-        
-        if uri is not None:
-            # Get current line number (strarting from 0)
-            line = iter.get_line()            
-
-            # Check if the cursor is placed inside a bookmark
-            iters = self._bookmarks.get_iters(uri)
-            if iters.has_key(line+1) and iter.get_visible_line_offset() > 0:
-                line += 1
-
-            # Get new document line count
-            count = doc.get_line_count() + text.count("\n")
-			
-            # Update bookmarks and number of document lines
-            self._update_doc_lines(doc, count, line+1)
-
-    def _on_delete_text(self, textbuffer, start, end):
-        # Get document uri
-        doc = self._window.get_active_document()
-        uri = doc.get_uri()
-        
-        if uri is not None:
-            # Get start and end line numbers (strarting from 0)
-            start_line = start.get_line()
-            end_line = end.get_line()
-
-            # Check if the cursor is placed at the start of the line next a bookmark
-            iters = self._bookmarks.get_iters(uri)
-            if iters.has_key(end_line) and end.get_visible_line_offset() == 0:
-                start_line += 1
-            
-            # Get new document line count
-            count = doc.get_line_count() - int(abs(end_line - start_line))
-
-            # Update document line count and bookmarks
-            self._update_doc_lines(doc, count, start_line+1, end_line)
-
-    def _update_doc_lines(self, doc, line_count, line, end = -1):
-        uri = doc.get_uri()
-        if uri:
-            # Check if there is no number of lines stored yet
-            if not self._doc_lines.has_key(uri):
-                self._doc_lines[uri] = doc.get_line_count()
-                
-            # Check if number of lines have to be changed
-            if self._doc_lines[uri] != line_count:
-                # Update bookmarks
-                self._bookmarks.update(uri, self._doc_lines[uri] - line_count, line, end)
-                
-                # Setup new line count
-                self._doc_lines[uri] = line_count
-	
-            # Save bookmarks
-            self._plugin.write_config()
-            
     def _on_tab_added(self, window, tab):
         # Get tab document
         doc = tab.get_document()
         
-        # Setup document load handler
-        doc.connect("loaded", self._on_doc_loaded)
+        # Setup document handlers
+        self._connect_doc(doc)
+        
+        highlight = self._config.getboolean("common", "highlighting")
+        self._setup_view_highlighting(tab.get_view(), highlight)
+        
+    def _connect_doc(self, doc):
+        doc.set_data("AdvancedBookmarksHandlers", [
+            doc.connect("loaded",       self._on_doc_loaded),
+            doc.connect("changed",      self._on_doc_changed),
+            doc.connect("cursor-moved", self._on_cursor_moved),
+            doc.connect("saved",        self._on_doc_saved),
+        ])
+
+    def _disconnect_doc(self, doc):
+        for handler_id in doc.get_data("AdvancedBookmarksHandlers") or []:
+            doc.disconnect(handler_id)
+        doc.set_data("AdvancedBookmarksHandlers", None)
 
     def _on_tab_removed(self, window, tab):
+        # The document may move to another window, which connects it again
+        self._disconnect_doc(tab.get_document())
+        
         docs = window.get_documents()
 
         if len(docs) <= 0:
@@ -372,41 +492,40 @@ class window_helper:
         doc = tab.get_document()
         if doc:
             uri = doc.get_uri()
+            
+            if self.resolve_lines(doc):
+                self._plugin.schedule_write()
+            
             self._tree.set_model(self._bookmarks.get_store(uri))
 
     def _on_doc_changed(self, doc):
         uri = doc.get_uri()
         
         if uri:
-            # Update number of lines of the document
-            self._doc_lines[uri] = doc.get_line_count()
-            
-            # Refresh highlighting if needed
-            highlight = self._config.getboolean("common", "highlighting")
-            if highlight:
-                # Cleanup highlighting
-                self.setup_highlighting(False, doc)
-                
-                # Put highlighting back
-                self.setup_highlighting(True, doc)
+            anchors = self._get_anchors(doc)
             
-            iters = self._bookmarks.get_iters(uri)
+            if not anchors:
+                return
+            
+            # Anchors move with the text, bookmarks are renumbered only when they are shown or saved
+            doc.set_data("AdvancedBookmarksMoved", True)
+            self._move_icons(doc)
+            
+            if self._resolve_id is None and self._tree.flags() & gtk.MAPPED:
+                self._resolve_id = gobject.timeout_add(RESOLVE_DELAY, self._on_resolve_timeout)
             
             # Get current position
             text_iter = doc.get_iter_at_mark(doc.get_insert())
-
-            # Get current line number (strarting from 0)
-            line = text_iter.get_line() + 1
-
-            if iters.has_key(line):
-                it = iters[line]
-
-                store = self._bookmarks.get_store(uri)
+            
+            line = self._bookmark_at(doc, text_iter.get_line())
+            
+            if line is not None:
+                it = self._bookmarks.exists(uri, line)
                 
-                if self._config.get(uri, str(line)) == "":
+                if it and self._config.get(uri, str(line)) == "":
                     # Get position of the current and the next lines
-                    start = doc.get_iter_at_line(line-1)
-                    end   = doc.get_iter_at_line(line)
+                    start = doc.get_iter_at_line(text_iter.get_line())
+                    end   = doc.get_iter_at_line(text_iter.get_line()+1)
                     
                     # Check if we are at the last line
                     if start.get_offset() == end.get_offset():
@@ -415,14 +534,31 @@ class window_helper:
                     # Get line text
                     source = doc.get_text(start, end, False).strip()
                     
-                    store.set_value(it, 1, source.strip())
+                    self._bookmarks.get_store(uri).set_value(it, 1, source)
+
+    def _on_resolve_timeout(self):
+        self._resolve_id = None
+        
+        doc = self._window.get_active_document()
+        if doc and self.resolve_lines(doc):
+            self._plugin.schedule_write()
+        
+        return False
+        
+    def _on_tree_mapped(self, tree):
+        # Bookmarks panel is shown, make it match the active document
+        doc = self._window.get_active_document()
+        if doc and self.resolve_lines(doc):
+            self._plugin.schedule_write()
 
-    def _on_doc_loaded(self, doc, arg, put=True, connect_signals=True):
+    def _on_doc_loaded(self, doc, arg):
         # Update comments
         uri = doc.get_uri()
         
         if uri:
-            highlight = self._config.getboolean("common", "highlighting")
+            # Drop the anchors of the previous contents
+            self._clear_anchors(doc)
+            doc.set_data("AdvancedBookmarksMoved", False)
             
             store = self._bookmarks.get_store(uri)
             iters = self._bookmarks.get_iters(uri)
@@ -430,27 +566,27 @@ class window_helper:
             for i in iters:
                 it = iters[i]
 
-                line = int(store.get_value(it, 0)) - 1
+                line = int(store.get_value(it, 0))
                 
-                start = doc.get_iter_at_line(line)
-                end   = doc.get_iter_at_line(line+1)
+                self._add_anchor(doc, line)
                 
-                # Check if we are at the last line
-                if start.get_offset() == end.get_offset():
-                    end = doc.get_end_iter()
-                
-                self.set_line_highlighting(doc, start, end, put and highlight)
-                    
                 if store.get_value(it, 1) == "":
+                    start = doc.get_iter_at_line(line-1)
+                    end   = doc.get_iter_at_line(line)
+                    
+                    # Check if we are at the last line
+                    if start.get_offset() == end.get_offset():
+                        end = doc.get_end_iter()
+                    
                     source = doc.get_text(start, end, False)
                     store.set_value(it, 1, source.strip())
             
-        if connect_signals:
-            # Setup update handlers
-            doc.connect("insert-text",  self._on_insert_text)
-            doc.connect("delete-range", self._on_delete_text)
-            doc.connect("changed",      self._on_doc_changed)
-            doc.connect("cursor-moved", self._on_cursor_moved)
+    def _on_doc_saved(self, doc, error):
+        # Bookmarks of a saved document must match the file on disk
+        if self.resolve_lines(doc):
+            self._plugin.schedule_write()
+        
+        self._plugin.flush_config()
         
     def _on_edit_clicked(self, btn):
         model = self._tree.get_model()
@@ -491,6 +627,9 @@ class window_helper:
             # Get current position
             text_iter = doc.get_iter_at_mark(doc.get_insert())
 
+            # Bookmark may have moved since the panel was refreshed
+            line = self._doc_line(doc, line)
+
             if line != text_iter.get_line()+1:
                 # Jump to bookmark
                 doc.goto_line(int(line)-1)
@@ -519,8 +658,9 @@ class window_helper:
             self._bookmarks.delete(uri, line)
 
             # Get position of the current and the next lines
-            start = doc.get_iter_at_line(line-1)
-            end   = doc.get_iter_at_line(line)
+            doc_line = self._doc_line(doc, line)
+            start = doc.get_iter_at_line(doc_line-1)
+            end   = doc.get_iter_at_line(doc_line)
             
             # Check if we are at the last line
             if start.get_offset() == end.get_offset():
@@ -534,7 +674,7 @@ class window_helper:
             self._tree.set_model(self._bookmarks.get_store(uri))
             
             # Save bookmarks
-            self._plugin.write_config()
+            self._plugin.schedule_write()
         
     def _on_tree_focused(self, tree, direction):
         view = self._window.get_active_view()
@@ -565,10 +705,10 @@ class window_helper:
         # Get current position
         text_iter = doc.get_iter_at_mark(doc.get_insert())
 
-        # Get current line number (strarting from 0)
-        line = text_iter.get_line() + 1
+        # Get stored line number of a bookmark at the current line
+        line = self._bookmark_at(doc, text_iter.get_line())
 
-        exists = self._bookmarks.exists(uri, line)
+        exists = line is not None and self._bookmarks.exists(uri, line)
         
         if exists:
             iters = self._bookmarks.get_iters(uri)
@@ -584,45 +724,16 @@ class window_helper:
             self._act_edit.set_sensitive(False)
             self._pop_edit.set_sensitive(False)
     
-    def set_line_highlighting(self, doc, start, end, highlight):
-        tag_table = doc.get_tag_table()
-        tag = tag_table.lookup("bookmark")
-        
-        if tag is None:
-            color = self._config.get("common", "highlight_color")
-            tag = doc.create_tag("bookmark", paragraph_background_gdk = gtk.gdk.color_parse(color))
-        
+    def _setup_view_highlighting(self, view, highlight):
         if highlight:
-            doc.apply_tag(tag, start, end)
-        else:
-            doc.remove_tag(tag, start, end)
-    
-    def _remove_highlighting(self, doc):
-        tag_table = doc.get_tag_table()
-        tag = tag_table.lookup("bookmark")
-        
-        if tag is not None:
-            start = doc.get_start_iter()
-            end = doc.get_end_iter()
-            doc.remove_tag(tag, start, end)
-    
-    def setup_highlighting(self, highlight, doc=None):
-        func = highlight and (lambda doc: self._on_doc_loaded(doc, None, True, False)) or (lambda doc: self._remove_highlighting(doc))
-        
-        if doc is None:
-            docs = self._window.get_documents()
+            color = gtk.gdk.color_parse(self._config.get("common", "highlight_color"))
         else:
-            docs = [doc]
+            color = None
             
-        for d in docs:
-            tag_table = d.get_tag_table()
-            tag = tag_table.lookup("bookmark")
-            
-            if tag is not None:
-                tag_table.remove(tag)
-                color = self._config.get("common", "highlight_color")
-                tag = d.create_tag("bookmark", paragraph_background_gdk = gtk.gdk.color_parse(color))
-
-            func(d)
+        view.set_mark_category_background(MARK_CATEGORY, color)
+    
+    def setup_highlighting(self, highlight):
+        for view in self._window.get_views():
+            self._setup_view_highlighting(view, highlight)
     
 # ex:ts=4:et:
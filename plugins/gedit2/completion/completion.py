@@ -22,20 +22,25 @@ This plugin can be used to speed up writing and to avoid spelling errors in
 either regular text documents or in programming documents if no programming
 language -aware completion is available.
 
-Words are automatically scanned at regular intervals. Once you have typed a
-word and the interval has passed, the word is available in the completion
-system. A completion window listing possible completions is shown and updated
-as you type. You can complete to the topmost word in the window with the Tab
-key, or choose another completion with the arrow keys and complete with the Tab
-key. The keybindinds are configurable only by editing the source code.
+Words are indexed as they are typed. Only the lines touched by an edit are
+rescanned, and all documents share one sorted word list, so looking up
+completions costs the same regardless of how many documents are open. A
+completion window listing possible completions is shown and updated as you
+type. You can complete to the topmost word in the window with the Tab key, or
+choose another completion with the arrow keys and complete with the Tab key.
+The keybindinds are configurable only by editing the source code.
 """
 
+import bisect
 import gedit
 import gobject
 import gtk
+import heapq
 import pango
 import re
+import time
 from lib import sgconf # gmate lib
+from lib.vocabulary import ProjectVocabulary
 
 class CompletionWindow(gtk.Window):
 
@@ -126,11 +131,100 @@ class CompletionWindow(gtk.Window):
 
         self._view.modify_font(font_desc)
 
+class WordIndex(object):
+
+    """Sorted list of the words in all indexed documents.
+
+    '_counts' is a dictionary mapping words to the number of their occurrences
+    in all documents and '_words' is a sorted list of the words that occur at
+    least once. Words beginning with a prefix are found with a binary search.
+    """
+
+    def __init__(self):
+
+        self._counts = {}
+        self._words = []
+
+    def add(self, word, count=1):
+        """Add count occurrences of word."""
+
+        total = self._counts.get(word, 0)
+        if total == 0:
+            bisect.insort(self._words, word)
+        self._counts[word] = total + count
+
+    def count(self, word):
+        """Return the number of occurrences of word."""
+
+        return self._counts.get(word, 0)
+
+    def remove(self, word, count=1):
+        """Remove count occurrences of word."""
+
+        total = self._counts.get(word, 0) - count
+        if total > 0:
+            self._counts[word] = total
+            return
+        self._counts.pop(word, None)
+        index = bisect.bisect_left(self._words, word)
+        if index < len(self._words) and self._words[index] == word:
+            del self._words[index]
+
+    def iter_prefix(self, prefix):
+        """Iterate over words beginning with prefix in alphabetical order."""
+
+        words = self._words
+        index = bisect.bisect_left(words, prefix)
+        while index < len(words) and words[index].startswith(prefix):
+            yield words[index]
+            index += 1
+
+class DocumentWords(object):
+
+    """Word counts of a single document.
+
+    All changes to the counts are mirrored to the 'WordIndex' given when
+    creating the instance, so that the shared index always holds the sum of
+    the words in all documents.
+    """
+
+    def __init__(self, index):
+
+        self._counts = {}
+        self._index = index
+
+    def add(self, words):
+        """Add one occurrence of each word in words."""
+
+        for word in words:
+            self._counts[word] = self._counts.get(word, 0) + 1
+            self._index.add(word)
+
+    def clear(self):
+        """Remove all words."""
+
+        for word, count in self._counts.iteritems():
+            self._index.remove(word, count)
+        self._counts = {}
+
+    def remove(self, words):
+        """Remove one occurrence of each word in words."""
+
+        for word in words:
+            count = self._counts.get(word, 0)
+            if count == 0: continue
+            if count == 1:
+                del self._counts[word]
+            else:
+                self._counts[word] = count - 1
+            self._index.remove(word)
+
 class Settings(sgconf.Options):
     _uri = u"/apps/gedit-2/plugins/completion"
 
     max_completions_show = sgconf.IntOption(6)
     enter_behaviour_mode = sgconf.StringOption('complete')
+    scope = sgconf.StringOption('application')
 
 class CompletionConfigDialog(gtk.Dialog):
     Title = 'Completion plugin settings'
@@ -140,6 +234,11 @@ class CompletionConfigDialog(gtk.Dialog):
     OnEnterNewLine =  ('Completion after select suggestion in popup menu', 'newline')
     EnterBehaviourKey = 'behaviour'
     EnterBehaviourFrameText = "<b>Behaviour for key 'enter':</b>"
+    # words to complete from:
+    ScopeApplication = ('All open documents', 'application')
+    ScopeProject = ('All open documents and source files in the project', 'project')
+    ScopeKey = 'scope'
+    ScopeFrameText = "<b>Complete using words from:</b>"
 
     def __init__(self, settings):
         gtk.Dialog.__init__(self, self.Title, None, gtk.DIALOG_DESTROY_WITH_PARENT)
@@ -171,6 +270,25 @@ class CompletionConfigDialog(gtk.Dialog):
         btn2 = entermode_radio(*(self.OnEnterNewLine +  (btn1, )))
         frame.add(scope_box)
         mainbox.pack_start(frame)
+
+        # Scope frame
+        frame = gtk.Frame(self.ScopeFrameText)
+        frame.set_shadow_type(gtk.SHADOW_NONE)
+        frame.get_label_widget().set_use_markup(True)
+
+        words_box = gtk.VBox(False, 0)
+        words_box.set_border_width(5)
+        def scope_radio(text, scope, group=None):
+            btn = gtk.RadioButton(group, text)
+            btn.set_data(self.ScopeKey, scope)
+            btn.connect('toggled', self.scope_change)
+            btn.set_active(self._settings.scope == scope)
+            words_box.pack_start(btn)
+            return btn
+        btn1 = scope_radio(*self.ScopeApplication)
+        btn2 = scope_radio(*(self.ScopeProject + (btn1, )))
+        frame.add(words_box)
+        mainbox.pack_start(frame)
         
         # Max Completions frame
         frame = gtk.Frame()
@@ -204,6 +322,12 @@ class CompletionConfigDialog(gtk.Dialog):
         if mode is not None and mode in ('complete', 'newline'):
             self._settings.enter_behaviour_mode = mode
 
+    def scope_change(self, widget):
+        if not widget.get_active(): return
+        scope = widget.get_data(self.ScopeKey)
+        if scope is not None and scope in ('application', 'project'):
+            self._settings.scope = scope
+
 
 class CompletionPlugin(gedit.Plugin):
 
@@ -212,13 +336,19 @@ class CompletionPlugin(gedit.Plugin):
     Instance variables are as follows. '_completion_windows' is a dictionary
     mapping 'gedit.Windows' to 'CompletionWindows'.
 
-    '_all_words' is a dictionary mapping documents to a frozen set containing
-    all words in the document. '_favorite_words' is a dictionary mapping
-    documents to a set of words that the user has completed to. Favorites are
-    thus always document-specific and there are no degrees to favoritism. These
-    favorites will be displayed at the top of the completion window. As
-    '_all_words' and '_favorite_words' are both sets, the exact order in which
-    the words are listed in the completion window is unpredictable.
+    '_all_words' is a dictionary mapping documents to 'DocumentWords' holding
+    the word counts of the document. '_index' is the 'WordIndex' shared by all
+    documents, kept up to date from the documents' insert and delete signals.
+    '_favorite_words' is a dictionary mapping documents to dictionaries mapping
+    words that the user has completed to to the time they were last completed
+    to. Favorites are thus always document-specific. If the 'scope' setting is
+    'project', words from the source files of the project, as collected by
+    'ProjectVocabulary', are candidates as well.
+
+    Candidates are ranked with favorites first, most recently completed first,
+    followed by other words by their number of occurrences and alphabetically
+    among equals. Only the top 'max_completions_show' candidates are selected,
+    with a heap rather than by sorting all candidates.
 
     '_completions' is a list of the currently active complete words, shown in
     the completion window, that the user can complete to. Similarly '_remains'
@@ -235,10 +365,6 @@ class CompletionPlugin(gedit.Plugin):
     # Unlike gedit itself, consider underscores alphanumeric characters
     # allowing completion of identifier names in many programming languages.
     _re_alpha = re.compile(r"\w+", re.UNICODE | re.MULTILINE)
-    _re_non_alpha = re.compile(r"\W+", re.UNICODE | re.MULTILINE)
-
-    # TODO: Are these sane defaults?
-    _scan_frequency = 10000 # ms
 
     def __init__(self):
 
@@ -248,6 +374,7 @@ class CompletionPlugin(gedit.Plugin):
         self._completions = []
         self._favorite_words = {}
         self._font_ascent = 0
+        self._index = WordIndex()
         self._remains = []
         self._settings = Settings()
 
@@ -265,16 +392,22 @@ class CompletionPlugin(gedit.Plugin):
         doc = window.get_active_document()
         index = self._completion_windows[window].get_selected()
         doc.insert_at_cursor(self._remains[index])
-        words = self._favorite_words.setdefault(doc, set(()))
-        words.add(self._completions[index])
+        words = self._favorite_words.setdefault(doc, {})
+        words[self._completions[index]] = time.time()
         self._terminate_completion()
 
     def _connect_document(self, doc):
-        """Connect to document's 'loaded' signal."""
+        """Connect to document's loading and editing signals."""
 
         callback = lambda doc, x, self: self._scan_document(doc)
-        handler_id = doc.connect("loaded", callback, self)
-        doc.set_data(self.__class__.__name__, (handler_id,))
+        id_1 = doc.connect("loaded", callback, self)
+        id_2 = doc.connect("insert-text", self._on_document_insert_text)
+        callback = self._on_document_insert_text_after
+        id_3 = doc.connect_after("insert-text", callback)
+        id_4 = doc.connect("delete-range", self._on_document_delete_range)
+        callback = self._on_document_delete_range_after
+        id_5 = doc.connect_after("delete-range", callback)
+        doc.set_data(self.__class__.__name__, (id_1, id_2, id_3, id_4, id_5))
 
     def _connect_view(self, view, window):
         """Connect to view's editing signals."""
@@ -307,29 +440,86 @@ class CompletionPlugin(gedit.Plugin):
         self._show_completion_window(view, insert)
 
     def _find_completions(self, doc, incomplete):
-        """Find completions for incomplete word and save them."""
-
-        self._completions = []
-        self._remains = []
-        favorites = self._favorite_words.get(doc, ())
-        _all_words = set(())
-        for words in self._all_words.itervalues():
-            _all_words.update(words)
+        """Find the best completions for incomplete word and save them."""
+
+        favorites = self._favorite_words.get(doc, {})
+        # All sequences are sorted, so merging them yields the candidates in
+        # alphabetical order, which 'heapq.nlargest' keeps among equal ranks.
+        sequences = [sorted(x for x in favorites if x.startswith(incomplete)),
+                     self._index.iter_prefix(incomplete)]
+        vocabulary = None
+        if self._settings.scope == 'project':
+            vocabulary = ProjectVocabulary.for_document(doc)
+            # Outside a project only the open documents are looked at
+            if vocabulary is not None:
+                sequences.append(vocabulary.words_with_prefix(incomplete))
+        def iter_candidates():
+            previous = incomplete
+            for word in heapq.merge(*sequences):
+                if word == previous: continue
+                previous = word
+                yield word
+        def rank(word):
+            count = self._index.count(word)
+            if vocabulary is not None:
+                count += vocabulary.count(word)
+            return (favorites.get(word, 0), count)
         limit = self._settings.max_completions_show
-        for sequence in (favorites, _all_words):
-            for word in sequence:
-                if not word.startswith(incomplete): continue
-                if word == incomplete: continue
-                if word in self._completions: continue
-                self._completions.append(word)
-                self._remains.append(word[len(incomplete):])
-                if len(self._remains) >= limit: break
+        self._completions = heapq.nlargest(limit, iter_candidates(), key=rank)
+        self._remains = [x[len(incomplete):] for x in self._completions]
+
+    def _get_document_words(self, doc):
+        """Return the 'DocumentWords' of document, creating it if needed."""
+
+        words = self._all_words.get(doc)
+        if words is None:
+            words = self._all_words[doc] = DocumentWords(self._index)
+        return words
+
+    def _get_line_words(self, doc, first, last):
+        """Return a list of all words on lines from first to last."""
+
+        start = doc.get_iter_at_line(first)
+        end = doc.get_iter_at_line(last)
+        if not end.ends_line():
+            end.forward_to_line_end()
+        text = unicode(doc.get_text(start, end))
+        return self._re_alpha.findall(text)
 
     def _check_by_completion_moved(self, moved):
         if self._settings.enter_behaviour_mode == 'newline':
             return moved
         return True
 
+    def _on_document_delete_range(self, doc, start, end):
+        """Remove words on the lines about to be deleted from."""
+
+        words = self._get_line_words(doc, start.get_line(), end.get_line())
+        self._get_document_words(doc).remove(words)
+
+    def _on_document_delete_range_after(self, doc, start, end):
+        """Add words on the line joined by the deletion."""
+
+        line = start.get_line()
+        words = self._get_line_words(doc, line, line)
+        self._get_document_words(doc).add(words)
+
+    def _on_document_insert_text(self, doc, itr, text, length):
+        """Remove words on the line about to be inserted to."""
+
+        line = itr.get_line()
+        words = self._get_line_words(doc, line, line)
+        self._get_document_words(doc).remove(words)
+
+    def _on_document_insert_text_after(self, doc, itr, text, length):
+        """Add words on the lines spanned by the inserted text."""
+
+        # After the default handler 'itr' points to the end of the insertion.
+        last = itr.get_line()
+        first = last - text.count("\n")
+        words = self._get_line_words(doc, first, last)
+        self._get_document_words(doc).add(words)
+
     def _on_view_key_press_event(self, view, event, window):
         """Manage actions for completions and the completion window."""
 
@@ -380,24 +570,23 @@ class CompletionPlugin(gedit.Plugin):
         """Remove closed document's word and favorite sets."""
 
         doc = tab.get_document()
-        self._all_words.pop(doc, None)
-        self._favorite_words.pop(doc, None)
+        self._remove_document(doc)
 
-    def _scan_active_document(self, window):
-        """Scan all the words in the active document in window."""
+    def _remove_document(self, doc):
+        """Remove document's words from the index and forget its favorites."""
 
-        # Return False to not scan again.
-        if window is None: return False
-        doc = window.get_active_document()
-        if doc is not None:
-            self._scan_document(doc)
-        return True
+        words = self._all_words.pop(doc, None)
+        if words is not None:
+            words.clear()
+        self._favorite_words.pop(doc, None)
 
     def _scan_document(self, doc):
         """Scan and save all words in document."""
 
         text = unicode(doc.get_text(*doc.get_bounds()))
-        self._all_words[doc] = frozenset(self._re_non_alpha.split(text))
+        words = self._get_document_words(doc)
+        words.clear()
+        words.add(self._re_alpha.findall(text))
 
     def _show_completion_window(self, view, itr):
         """Show the completion window below the caret."""
@@ -453,14 +642,6 @@ class CompletionPlugin(gedit.Plugin):
             self._connect_view(view, window)
         if views: self._update_fonts(views[0])
         self._completion_windows[window] = CompletionWindow(window)
-        # Scan the active document in window if it has input focus
-        # for new words at constant intervals.
-        def scan(self, window):
-            if not window.is_active(): return True
-            return self._scan_active_document(window)
-        freq = self._scan_frequency
-        priority = gobject.PRIORITY_LOW
-        gobject.timeout_add(freq, scan, self, window, priority=priority)
 
     def deactivate(self, window):
         """Deactivate plugin."""
@@ -476,5 +657,4 @@ class CompletionPlugin(gedit.Plugin):
         self._terminate_completion()
         self._completion_windows.pop(window)
         for doc in window.get_documents():
-            self._all_words.pop(doc, None)
-            self._favorite_words.pop(doc, None)
+            self._remove_document(doc)
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+    Project root detection shared by the plugins.
+
+    A RootResolver walks up from a path to the first directory holding all
+    of its marker files. What each directory holds is remembered, whether
+    it is a root or not, together with the mtimes of the directories the
+    markers live in. A memo entry is used only while those mtimes are
+    unchanged, so adding or removing a marker is noticed on the next
+    lookup. The memo is dropped once it holds MAX_MEMO directories, so
+    browsing through many trees does not grow it for good.
+"""
+import os
+import threading
+import urllib
+
+
+# Number of parent directories looked at before giving up
+MAX_DEPTH = 10
+
+# Number of directories remembered by a resolver
+MAX_MEMO = 1024
+
+
+class RootResolver(object):
+    """
+        Finds the project root of paths by the given markers, paths
+        relative to the root: 'dirs' must be directories, such as 'app',
+        'files' must be files, such as 'config/environment.rb', and
+        'entries' may be either, such as '.git' which is a file in a
+        worktree.
+    """
+
+    def __init__(self, dirs=(), files=(), entries=(), max_depth=MAX_DEPTH):
+        self.markers = ([(m, os.path.isdir) for m in dirs] +
+                        [(m, os.path.isfile) for m in files] +
+                        [(m, os.path.exists) for m in entries])
+        self.max_depth = max_depth
+        self._marker_dirs = sorted(set(os.path.dirname(m) for m, check in self.markers))
+        self._memo = {}
+        self._lock = threading.Lock()
+
+    def find(self, path):
+        """Returns the root of path (a file or directory) or None."""
+        if path is None:
+            return None
+        if path.startswith('file://'):
+            path = urllib.url2pathname(path[7:])
+        base_dir = os.path.abspath(path)
+        if not os.path.isdir(base_dir):
+            base_dir = os.path.dirname(base_dir)
+        for i in xrange(self.max_depth):
+            if self.is_root(base_dir):
+                return base_dir
+            parent = os.path.dirname(base_dir)
+            if parent == base_dir:
+                break
+            base_dir = parent
+        return None
+
+    def is_root(self, directory):
+        """Returns True if directory holds all the markers."""
+        mtimes = self._mtimes(directory)
+        self._lock.acquire()
+        try:
+            entry = self._memo.get(directory)
+        finally:
+            self._lock.release()
+        if entry is not None and entry[0] == mtimes:
+            return entry[1]
+        is_root = mtimes[0] is not None and all(
+            check(os.path.join(directory, m)) for m, check in self.markers)
+        self._lock.acquire()
+        try:
+            if len(self._memo) >= MAX_MEMO:
+                self._memo.clear()
+            self._memo[directory] = (mtimes, is_root)
+        finally:
+            self._lock.release()
+        return is_root
+
+    def forget(self, directory=None):
+        """Drops what is known about directory, or about every directory."""
+        self._lock.acquire()
+        try:
+            if directory is None:
+                self._memo.clear()
+            else:
+                self._memo.pop(directory, None)
+        finally:
+            self._lock.release()
+
+    def _mtimes(self, directory):
+        mtimes = []
+        for marker_dir in self._marker_dirs:
+            try:
+                mtimes.append(os.stat(os.path.join(directory, marker_dir)).st_mtime)
+            except OSError:
+                mtimes.append(None)
+        return tuple(mtimes)
+
+
+# Directories a Rails application is recognized by
+rails_roots = RootResolver(dirs=('app', 'config'))
+
+# Rails applications with their environment, as the loader wants them
+rails_environment_roots = RootResolver(dirs=('app', 'config'),
+                                       files=('config/environment.rb',))
+
+# Any version controlled project
+_vcs_roots = [RootResolver(entries=(marker,), max_depth=32)
+              for marker in ('.git', '.hg', '.bzr')]
+
+
+def rails_root(path):
+    """Returns the Rails application root of path or None."""
+    return rails_roots.find(path)
+
+
+def project_root(path):
+    """
+        Returns the closest root of path known to any resolver, Rails
+        applications and version controlled trees, or None.
+    """
+    roots = [resolver.find(path) for resolver in [rails_roots] + _vcs_roots]
+    roots = [root for root in roots if root is not None]
+    if not roots:
+        return None
+    # The deepest root is the closest one
+    return max(roots, key=len)
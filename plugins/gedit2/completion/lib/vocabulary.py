@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+    Vocabulary of the source files in a project, shared by the completion
+    plugins.
+
+    A ProjectVocabulary counts the words in every source file under a root
+    directory. Files are tokenized by a background thread which only reads
+    files whose mtime or size changed since the last scan. The result is
+    saved to a cache file, so a new session only rereads changed files.
+    Words are kept in a sorted list and looked up by prefix with bisect.
+
+    Roots are found by lib.roots.project_root, the projects the other
+    plugins work on. A document outside any project has no vocabulary,
+    rather than one of its directory or of the working directory, which may
+    well be the home directory.
+"""
+import bisect
+import cPickle
+import hashlib
+import os
+import re
+import threading
+import time
+
+from roots import project_root
+from threads import start_thread
+
+
+CACHE_DIR = os.path.expanduser('~/.gnome2/gedit/vocabulary')
+
+SOURCE_EXTENSIONS = frozenset((
+    '.c', '.cc', '.coffee', '.cpp', '.cs', '.css', '.erb', '.feature',
+    '.groovy', '.h', '.haml', '.hpp', '.htm', '.html', '.java', '.js',
+    '.less', '.php', '.pl', '.py', '.rake', '.rb', '.sass', '.scss', '.sh',
+    '.sql', '.xml', '.yml',
+))
+SKIPPED_DIRS = frozenset((
+    '.bzr', '.git', '.hg', '.svn', 'CVS', 'log', 'node_modules', 'tmp',
+))
+MAX_FILE_SIZE = 512 * 1024
+
+# Words shorter than this are not worth completing
+MIN_WORD_LENGTH = 3
+
+# Minimum number of seconds between two scans of the same root
+REFRESH_INTERVAL = 60
+
+WORD_RE = re.compile(r'\w+')
+
+def tokenize(text):
+    """Returns a dictionary mapping the words in text to their counts."""
+    counts = {}
+    for word in WORD_RE.findall(text):
+        if len(word) >= MIN_WORD_LENGTH and not word.isdigit():
+            counts[word] = counts.get(word, 0) + 1
+    return counts
+
+
+class ProjectVocabulary(object):
+    """
+        Word counts of the source files under root.
+
+        The scanned state is kept in one tuple (files, counts, words) which
+        the scanning thread replaces as a whole, so lookups from the main
+        thread never see a half updated state. 'files' maps paths to
+        (mtime, size, counts) tuples, 'counts' maps words to their total
+        count and 'words' is the sorted list of the words.
+    """
+
+    _instances = {}
+    _lock = threading.Lock()
+
+    def __init__(self, root):
+        self.root = root
+        self.cache_path = os.path.join(CACHE_DIR,
+            hashlib.md5(root.encode('utf-8') if isinstance(root, unicode)
+                        else root).hexdigest())
+        self._state = ({}, {}, [])
+        self._thread = None
+        self._last_scan = 0
+
+    @classmethod
+    def get(cls, root):
+        """Returns the shared vocabulary of root, starting a scan if needed."""
+        cls._lock.acquire()
+        try:
+            vocabulary = cls._instances.get(root)
+            if vocabulary is None:
+                vocabulary = cls._instances[root] = cls(root)
+        finally:
+            cls._lock.release()
+        vocabulary.refresh()
+        return vocabulary
+
+    @classmethod
+    def for_document(cls, doc):
+        """Returns the vocabulary of the project of doc or None."""
+        root = project_root(doc.get_uri())
+        if root is None:
+            return None
+        return cls.get(root)
+
+    def refresh(self, force=False):
+        """Starts a background scan unless one ran recently."""
+        if self._thread is not None and self._thread.isAlive():
+            return
+        if not force and time.time() - self._last_scan < REFRESH_INTERVAL:
+            return
+        self._last_scan = time.time()
+        self._thread = start_thread(self._scan)
+
+    def count(self, word):
+        return self._state[1].get(word, 0)
+
+    def words_with_prefix(self, prefix):
+        """Yields the words beginning with prefix in alphabetical order."""
+        words = self._state[2]
+        i = bisect.bisect_left(words, prefix)
+        while i < len(words) and words[i].startswith(prefix):
+            yield words[i]
+            i += 1
+
+    def _iter_source_files(self):
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if d not in SKIPPED_DIRS]
+            for filename in filenames:
+                if os.path.splitext(filename)[1] in SOURCE_EXTENSIONS:
+                    yield os.path.join(dirpath, filename)
+
+    def _load_cache(self):
+        try:
+            cache = open(self.cache_path, 'rb')
+            try:
+                files = cPickle.load(cache)
+            finally:
+                cache.close()
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            return {}
+        return isinstance(files, dict) and files or {}
+
+    def _save_cache(self, files):
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        tmp_path = self.cache_path + '.tmp'
+        cache = open(tmp_path, 'wb')
+        try:
+            cPickle.dump(files, cache, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            cache.close()
+        os.rename(tmp_path, self.cache_path)
+
+    def _scan(self):
+        old_files = self._state[0] or self._load_cache()
+        files = {}
+        changed = False
+        for path in self._iter_source_files():
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if st.st_size > MAX_FILE_SIZE:
+                continue
+            entry = old_files.get(path)
+            if entry is None or entry[:2] != (st.st_mtime, st.st_size):
+                try:
+                    source = open(path, 'rb')
+                    try:
+                        text = source.read()
+                    finally:
+                        source.close()
+                except IOError:
+                    continue
+                entry = (st.st_mtime, st.st_size, tokenize(text))
+                changed = True
+            files[path] = entry
+        if not changed and len(files) == len(old_files) and self._state[2]:
+            return
+        counts = {}
+        for mtime, size, file_counts in files.itervalues():
+            for word, count in file_counts.iteritems():
+                counts[word] = counts.get(word, 0) + count
+        self._state = (files, counts, sorted(counts))
+        try:
+            self._save_cache(files)
+        except (IOError, OSError):
+            pass
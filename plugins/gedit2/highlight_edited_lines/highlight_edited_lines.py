@@ -1,8 +1,11 @@
 import gtk
 import gconf
 import gedit
+import gobject
 import copy
 
+from lib.lines import LineRanges
+
 version = "0.1"
 
 Xpm_Data = [
@@ -142,7 +145,11 @@ class WinAttachedObject:
   def __init__(M, win):
     M.win            = win
     M.connected_docs = []
+    M.edited         = {} # id(doc) -> LineRanges
+    M.pending_syncs  = {} # id(doc) -> idle source id
+    M.synced_ranges  = {} # id(view) -> visible lines when marks were last synced
     M.win.connect("tab-added",M.on_win_tab_added)
+    M.win.connect("tab-removed",M.on_win_tab_removed)
     
   def getdoc(M):
     tab = M.win.get_active_tab()
@@ -164,26 +171,82 @@ class WinAttachedObject:
     if PREFS['highlight']:
       map = view.get_colormap()
       view.set_mark_category_background('EDITED',map.alloc_color(PREFS['highlight_bg_color']))
+    # marks only exist for the lines in view, add them when scrolling
+    view.connect_after("expose-event", M.on_view_expose_event)
+    
+  def on_win_tab_removed(M, win, tab):
+    doc = tab.get_document()
+    M.edited.pop(id(doc), None)
+    source_id = M.pending_syncs.pop(id(doc), None)
+    if source_id is not None:
+      gobject.source_remove(source_id)
+    M.synced_ranges.pop(id(tab.get_view()), None)
+    
+  def edited_lines(M, doc):
+    if id(doc) not in M.edited:
+      M.edited[id(doc)] = LineRanges()
+    return M.edited[id(doc)]
+    
   def on_doc_loaded(M, doc, unused):
     # the initial insertion of the entire text left a spurious mark
     doc.remove_source_marks(doc.get_start_iter(),doc.get_end_iter())
+    M.edited_lines(doc).clear()
 
   def on_doc_insert_text(M, doc, loc, text, N):
-    N        = text.count('\n') + 1
+    N        = text.count('\n')
     nextchar = loc.get_char()
-    itr      = loc.copy()
+    last     = loc.get_line()
+    first    = last - N
+    edited   = M.edited_lines(doc)
+    edited.insert_lines(first, N)
     if text[0]=='\n' and nextchar=='\n':
       # we inserted a \n at end of line, leave that line alone
-      N -= 1
-    for i in range(N):
-      doc.create_source_mark(None,'EDITED',itr)
-      itr.backward_line()
+      first += 1
+    edited.add(first, last)
+    M.queue_sync(doc)
       
   def on_doc_delete_range(M, doc, start, end):
+    edited = M.edited_lines(doc)
+    line = start.get_line()
+    edited.delete_lines(line, end.get_line() - line)
     if not start.ends_line():
-      doc.create_source_mark(None,'EDITED',start)
-    else:
+      edited.add(line, line)
+    M.queue_sync(doc)
+    
+  def on_view_expose_event(M, view, event):
+    if M.visible_lines(view) <> M.synced_ranges.get(id(view)):
+      M.queue_sync(view.get_buffer())
+    
+  def visible_lines(M, view):
+    rect = view.get_visible_rect()
+    first = view.get_line_at_y(rect.y)[0].get_line()
+    last = view.get_line_at_y(rect.y+rect.height)[0].get_line()
+    return first, last
+    
+  def queue_sync(M, doc):
+    'update the marks in view once the pending edits and redraws are done'
+    if id(doc) not in M.pending_syncs:
+      M.pending_syncs[id(doc)] = gobject.idle_add(M.sync_marks, doc)
+      
+  def sync_marks(M, doc):
+    '''give every edited line in view exactly one mark and the others none,
+    marks outside the view are left alone until it is scrolled there'''
+    M.pending_syncs.pop(id(doc), None)
+    edited = M.edited.get(id(doc))
+    if edited is None:
+      return False
+    for view in M.win.get_views():
+      if view.get_buffer() is not doc:
+        continue
+      first, last = M.visible_lines(view)
+      M.synced_ranges[id(view)] = first, last
+      start = doc.get_iter_at_line(first)
+      end = doc.get_iter_at_line(last)
+      end.forward_to_line_end()
       doc.remove_source_marks(start, end, 'EDITED')
+      for line in edited.lines_in(first, last):
+        doc.create_source_mark(None,'EDITED',doc.get_iter_at_line(line))
+    return False
 
   def update_ui(M):
     doc = M.getdoc()
@@ -203,6 +266,15 @@ class WinAttachedObject:
     #print 'deactivate called'
     # ?? turn off EDITED line mark
     M.win.disconnect_by_func(M.on_win_tab_added)
+    M.win.disconnect_by_func(M.on_win_tab_removed)
+    for source_id in M.pending_syncs.values():
+      gobject.source_remove(source_id)
+    M.pending_syncs = {}
+    for view in M.win.get_views():
+      try:
+        view.disconnect_by_func(M.on_view_expose_event)
+      except TypeError:
+        pass # tab was there before the plugin was activated
     for doc in M.win.get_documents():
       if id(doc) in M.connected_docs:
         doc.disconnect_by_func(M.on_doc_loaded)
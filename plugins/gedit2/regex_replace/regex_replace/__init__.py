@@ -14,7 +14,7 @@ class RegexSearch(gedit.Plugin):
 	
     def deactivate(self, window):
         regexsearch_instance = window.get_data(self.DATA_TAG)
-        # regexsearch_instance destroy!?
+        regexsearch_instance.deactivate()
         window.set_data(self.DATA_TAG, None)
 		
     def update_ui(self, window):
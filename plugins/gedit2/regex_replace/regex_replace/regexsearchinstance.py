@@ -1,9 +1,14 @@
 import gedit
 from gettext import gettext as _
+import gobject
 import gtk
 import gtk.glade
 import os
 import re
+import urllib
+from lib.roots import project_root
+from replacements import find_replacements, apply_replacements
+from projectpreview import ProjectPreview
 
 ui_str = """
 <ui>
@@ -19,12 +24,17 @@ ui_str = """
 
 GLADE_FILE = os.path.join(os.path.dirname(__file__), "regexsearch.glade")
 
+# Replacements applied per idle call by "Replace All" in large documents
+REPLACEMENTS_PER_CHUNK = 500
+
 class RegexSearchInstance:
 
     ###
     # Object initialization
     def __init__(self, window):
         self._window = window
+        self._replace_all_id = None
+        self._replace_all = None
         self.create_menu_item()
         self.load_dialog()
 
@@ -63,6 +73,8 @@ class RegexSearchInstance:
         self._replace_button.connect("clicked", self.on_replace_button_clicked)
         self._replace_all_button = glade_xml.get_widget("replace_all_button")
         self._replace_all_button.connect("clicked", self.on_replace_all_button_clicked)
+        self._replace_in_project_button = glade_xml.get_widget("replace_in_project_button")
+        self._replace_in_project_button.connect("clicked", self.on_replace_in_project_button_clicked)
 
 #        close_button = glade_xml.get_widget("close_button")
 #        close_button.connect("clicked", self.on_close_button_clicked)
@@ -76,6 +88,7 @@ class RegexSearchInstance:
         self._wrap_around_check = glade_xml.get_widget("wrap_around_check")
         self._use_backreferences_check = glade_xml.get_widget("use_backreferences_check")
         self._case_sensitive_check = glade_xml.get_widget("case_sensitive_check")
+        self._replace_progress = glade_xml.get_widget("replace_progress")
 
 
     ###
@@ -89,7 +102,13 @@ class RegexSearchInstance:
         self.search_document(button = 'replace')
 
     # Called when the "Replace All" button is clicked.
+    #
+    # Only the matched ranges are replaced, back to front so the offsets of
+    # the ranges left stay valid, as one user action. Large documents are
+    # done in chunks on idle, with the progress shown in the dialog.
     def on_replace_all_button_clicked(self, replace_button):
+        if self._replace_all_id is not None: return
+
         document = self._window.get_active_document()
         start_iter = document.get_start_iter()
         end_iter = document.get_end_iter()
@@ -98,19 +117,128 @@ class RegexSearchInstance:
         regex = self.create_regex()
         if regex==None: return
 
-        replace_string = self._replace_text_box.get_text()
-        if not self._use_backreferences_check.get_active():
-            replace_string = replace_string.replace('\\','\\\\') # turn \ into \\ so that backreferences are not done.
+        replace_string = unicode(self._replace_text_box.get_text(), "utf-8")
+        use_backreferences = self._use_backreferences_check.get_active()
+
+        spans, n_replacements = find_replacements(regex, alltext, replace_string, use_backreferences)
+
+        if len(spans) <= REPLACEMENTS_PER_CHUNK:
+            document.begin_user_action()
+            apply_replacements(document, spans)
+            document.end_user_action()
+            self.show_alert_dialog(u"%d replacement(s)." % (n_replacements))
+            return
+
+        # The document must not change under the pending ranges: the view is
+        # made read-only and the run stops if the document changes anyway,
+        # is reloaded or its tab is closed.
+        view = gedit.tab_get_from_document(document).get_view()
+        self._replace_all = {
+            "document": document,
+            "view": view,
+            "editable": view.get_editable(),
+            "spans": spans,
+            "total": len(spans),
+            "n_replacements": n_replacements,
+            "version": 0,
+        }
+        self._replace_all["changed_id"] = document.connect("changed", self.on_replace_all_document_changed)
+        self._replace_all["tab_removed_id"] = self._window.connect("tab-removed", self.on_replace_all_tab_removed)
+        view.set_editable(False)
+        self._replace_all_button.set_sensitive(False)
+        self._replace_progress.set_fraction(0)
+        self._replace_progress.show()
+
+        document.begin_user_action()
+        self._replace_all_id = gobject.idle_add(self.replace_all_chunk, self._replace_all["version"])
 
-        new_string, n_replacements = regex.subn(replace_string, alltext)
+    ###
+    # Called when the "In Project" button is clicked.
+    #
+    # Searches every file of the project of the active document, its Rails
+    # or version controlled root, and shows the matches in a preview where
+    # the replacements can be applied.
+    def on_replace_in_project_button_clicked(self, button):
+        regex = self.create_regex()
+        if regex==None: return
 
-        selection_bound_mark = document.get_mark("selection_bound")
-        document.place_cursor(start_iter)
-        document.move_mark(selection_bound_mark, end_iter)
-        document.delete_selection(False, False)
-        document.insert_at_cursor(new_string)
+        replace_string = unicode(self._replace_text_box.get_text(), "utf-8")
+        use_backreferences = self._use_backreferences_check.get_active()
+
+        document = self._window.get_active_document()
+        root = None
+        if document is not None and document.get_uri() is not None:
+            root = project_root(document.get_uri())
+            if root is None and document.get_uri().startswith("file://"):
+                root = os.path.dirname(urllib.url2pathname(document.get_uri()[7:]))
+        if root is None:
+            root = os.getcwd()
+
+        ProjectPreview(self._window, root, regex, replace_string, use_backreferences).show()
 
+    ###
+    # Applies the last chunk of the pending ranges, returns True while some are left.
+    #
+    # "version" is the number of changes the document had when the run
+    # started, the run is stopped if something else changed it since.
+    def replace_all_chunk(self, version):
+        state = self._replace_all
+        if state["version"] != version:
+            self._replace_all_id = None
+            self.stop_replace_all()
+            self.show_alert_dialog(u"Replace All was stopped because the document changed.")
+            return False
+
+        document = state["document"]
+        spans = state["spans"]
+        document.handler_block(state["changed_id"])
+        try:
+            apply_replacements(document, spans[-REPLACEMENTS_PER_CHUNK:])
+        finally:
+            document.handler_unblock(state["changed_id"])
+        del spans[-REPLACEMENTS_PER_CHUNK:]
+
+        if spans:
+            total = state["total"]
+            self._replace_progress.set_fraction(1 - float(len(spans)) / total)
+            self._replace_progress.set_text(u"%d of %d" % (total - len(spans), total))
+            return True
+
+        n_replacements = state["n_replacements"]
+        self._replace_all_id = None
+        self.stop_replace_all()
         self.show_alert_dialog(u"%d replacement(s)." % (n_replacements))
+        return False
+
+    def on_replace_all_document_changed(self, document):
+        self._replace_all["version"] += 1
+
+    def on_replace_all_tab_removed(self, window, tab):
+        if tab.get_document() == self._replace_all["document"]:
+            self.stop_replace_all()
+
+    ###
+    # Ends a running "Replace All": the idle call is removed, the user
+    # action ended and the view made editable again.
+    def stop_replace_all(self):
+        state = self._replace_all
+        if state is None: return
+        self._replace_all = None
+
+        if self._replace_all_id is not None:
+            gobject.source_remove(self._replace_all_id)
+            self._replace_all_id = None
+        state["document"].disconnect(state["changed_id"])
+        self._window.disconnect(state["tab_removed_id"])
+        state["document"].end_user_action()
+        state["view"].set_editable(state["editable"])
+        self._replace_progress.hide()
+        self._replace_all_button.set_sensitive(True)
+
+    ###
+    # Called when the plugin is deactivated for the window.
+    def deactivate(self):
+        self.stop_replace_all()
 
     ###
 #    # Called when the "Close" button is clicked.
@@ -152,6 +280,7 @@ class RegexSearchInstance:
             if len(search_text) > 0 and len(replace_text) > 0:
                 self._replace_button.set_sensitive(True)
                 self._replace_all_button.set_sensitive(True)
+                self._replace_in_project_button.set_sensitive(True)
                 self.enable_replace = True
 
     ###
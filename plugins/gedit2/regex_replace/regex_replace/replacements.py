@@ -0,0 +1,253 @@
+"""
+    Regex replacements shared by the search dialog and the project search.
+
+    Matches are turned into (start offset, end offset, text) spans, which
+    are applied back to front to a document or rewritten into a file. The
+    project search reads the files under a root with a pool of threads and
+    queues the matches of each file as soon as it is read, so the preview
+    can show the first hits before the whole tree is searched.
+"""
+import bisect
+import os
+import tempfile
+import urllib
+import Queue
+from multiprocessing.pool import ThreadPool
+
+from lib.threads import start_thread
+
+# Number of threads reading files
+SEARCH_WORKERS = 4
+
+SKIPPED_DIRS = frozenset((
+    '.bzr', '.git', '.hg', '.svn', 'CVS', 'log', 'node_modules', 'tmp',
+))
+MAX_FILE_SIZE = 1024 * 1024
+
+# A file holding a NUL byte in its first bytes is taken for a binary file
+BINARY_CHECK_SIZE = 1024
+
+
+def find_replacements(regex, text, replace_string, use_backreferences):
+    """
+        Returns the spans replacing the matches of regex in text, sorted by
+        offset, and the number of matches. Matches the replacement would not
+        change get no span.
+    """
+    spans = []
+    n_replacements = 0
+    last_end = -1
+    for result in regex.finditer(text):
+        # Like subn, an empty match right after the previous match is skipped
+        if result.start() == result.end() == last_end:
+            continue
+        last_end = result.end()
+        n_replacements += 1
+        if use_backreferences:
+            replace_text = result.expand(replace_string) # perform backslash expansion, like \1
+        else:
+            replace_text = replace_string
+        if replace_text != result.group():
+            spans.append((result.start(), result.end(), replace_text))
+    return spans, n_replacements
+
+
+def apply_replacements(document, spans):
+    """Replaces the spans, sorted by offset, in a gtk.TextBuffer."""
+    for start, end, replace_text in reversed(spans):
+        start_iter = document.get_iter_at_offset(start)
+        end_iter = document.get_iter_at_offset(end)
+        document.delete(start_iter, end_iter)
+        document.insert(start_iter, replace_text)
+
+
+def replaced_text(text, spans):
+    """Returns text with the spans, sorted by offset, replaced."""
+    parts = []
+    position = 0
+    for start, end, replace_text in spans:
+        parts.append(text[position:start])
+        parts.append(replace_text)
+        position = end
+    parts.append(text[position:])
+    return u''.join(parts)
+
+
+def read_text(path):
+    """Returns the text of a UTF-8 file, None for binary or other files."""
+    try:
+        if os.path.getsize(path) > MAX_FILE_SIZE:
+            return None
+        source = open(path, 'rb')
+        try:
+            data = source.read()
+        finally:
+            source.close()
+    except (IOError, OSError):
+        return None
+    if '\0' in data[:BINARY_CHECK_SIZE]:
+        return None
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+
+
+def replace_in_file(path, regex, replace_string, use_backreferences):
+    """
+        Replaces the matches of regex in the file at path and returns their
+        number. The file is read again, so changes made since it was
+        searched are taken into account, and the new text is written to a
+        temporary file in the same directory which is then renamed over
+        the file: it is either left alone or replaced as a whole.
+        Raises IOError or OSError when the file can not be rewritten.
+    """
+    text = read_text(path)
+    if text is None:
+        raise IOError("%s is not a UTF-8 text file" % path)
+    spans, n_replacements = find_replacements(regex, text, replace_string, use_backreferences)
+    if not spans:
+        return n_replacements
+    mode = os.stat(path).st_mode
+    directory, name = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(prefix='.%s.' % name, dir=directory)
+    try:
+        tmp = os.fdopen(fd, 'wb')
+        try:
+            tmp.write(replaced_text(text, spans).encode('utf-8'))
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        finally:
+            tmp.close()
+        os.chmod(tmp_path, mode & 07777)
+        os.rename(tmp_path, path)
+    except:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    return n_replacements
+
+
+def document_path(document):
+    """Returns the local path of a gedit document or None."""
+    uri = document.get_uri()
+    if uri is None or not uri.startswith('file://'):
+        return None
+    return urllib.url2pathname(uri[7:])
+
+
+class Match(object):
+    """
+        A match of the project search: its span, the line it starts on, the
+        text of that line and the column of the match in it.
+    """
+
+    __slots__ = ('line', 'column', 'text', 'span')
+
+    def __init__(self, line, column, text, span):
+        self.line = line
+        self.column = column
+        self.text = text
+        self.span = span
+
+
+class ProjectSearch(object):
+    """
+        Searches the files under root in the background.
+
+        'buffers' maps the paths of the documents open in gedit to their
+        text, which is searched instead of the file. Each file with matches
+        is queued as a (path, matches) tuple, followed by (None, None) once
+        the search is over.
+    """
+
+    def __init__(self, root, regex, replace_string, use_backreferences, buffers=None):
+        self.root = root
+        self.regex = regex
+        self.replace_string = replace_string
+        self.use_backreferences = use_backreferences
+        self.buffers = buffers or {}
+        self.results = Queue.Queue()
+        self.n_files = 0
+        self._cancelled = False
+        self._thread = None
+
+    def start(self):
+        self._thread = start_thread(self._search)
+
+    def cancel(self):
+        '''stops the search after the files being read'''
+        self._cancelled = True
+
+    def walk(self):
+        for path in self.buffers:
+            if path.startswith(os.path.join(self.root, '')):
+                yield path
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            if self._cancelled:
+                return
+            dirnames[:] = [d for d in dirnames if d not in SKIPPED_DIRS]
+            dirnames.sort()
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                if path not in self.buffers and not os.path.islink(path):
+                    yield path
+
+    def search_file(self, path):
+        if self._cancelled:
+            return path, None
+        text = self.buffers.get(path)
+        if text is None:
+            text = read_text(path)
+            if text is None:
+                return path, None
+        spans, n_replacements = find_replacements(self.regex, text,
+                                                  self.replace_string,
+                                                  self.use_backreferences)
+        if not spans:
+            return path, None
+        line_starts = [0]
+        position = text.find(u'\n')
+        while position != -1:
+            line_starts.append(position + 1)
+            position = text.find(u'\n', position + 1)
+        matches = []
+        for span in spans:
+            line = bisect.bisect_right(line_starts, span[0]) - 1
+            if line + 1 < len(line_starts):
+                end = line_starts[line + 1] - 1
+            else:
+                end = len(text)
+            matches.append(Match(line, span[0] - line_starts[line],
+                                 text[line_starts[line]:end], span))
+        return path, matches
+
+    def _search(self):
+        pool = ThreadPool(SEARCH_WORKERS)
+        try:
+            for path, matches in pool.imap_unordered(self.search_file, self.walk()):
+                self.n_files += 1
+                if matches:
+                    self.results.put((path, matches))
+                if self._cancelled:
+                    break
+        finally:
+            pool.close()
+            pool.join()
+        # Tells the main thread the search is over
+        self.results.put((None, None))
+
+    def pop_results(self, limit):
+        '''returns up to limit queued results and whether the search is over'''
+        results = []
+        while len(results) < limit:
+            try:
+                path, matches = self.results.get_nowait()
+            except Queue.Empty:
+                return results, False
+            if path is None:
+                return results, True
+            results.append((path, matches))
+        return results, False
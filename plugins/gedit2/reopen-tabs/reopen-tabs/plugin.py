@@ -21,6 +21,7 @@ import pygtk
 pygtk.require("2.0")
 import gtk
 import gedit
+import gobject
 import time
 import os
 import sys
@@ -28,6 +29,9 @@ import getopt
 import ConfigParser
 import gettext
 
+from lib.tabs import create_pending_tab, document_uri, load_pending_tab
+from lib.threads import start_thread
+
 APP_NAME = "plugin"
 LOC_PATH = os.path.join(os.path.expanduser("~/.gnome2/gedit/plugins/reopen-tabs/lang"))
 
@@ -95,6 +99,9 @@ class ReopenTabsPlugin(gedit.Plugin):
 		if not self._config.has_option("common", "active_document"):
 			self._config.set("common", "active_document", "")
 
+		if not self._config.has_option("common", "lazy_restore"):
+			self._config.set("common", "lazy_restore", "off")
+
 		if not self._config.has_section("documents"):
 			self._config.add_section("documents")
 
@@ -118,6 +125,8 @@ class ReopenTabsPlugin(gedit.Plugin):
 
 	def _on_active_tab_changed(self, window, tab):
 		log('Event: active tab changed')
+		load_pending_tab(tab)
+
 		if self._state == RELOADER_STATE_INIT:
 			self._state = RELOADER_STATE_READY
 			self._on_active_tab_state_changed(window)
@@ -133,9 +142,9 @@ class ReopenTabsPlugin(gedit.Plugin):
 			# Check if we are ready to reload
 			if tab and tab.get_state() == gedit.TAB_STATE_NORMAL:
 				if self._state == RELOADER_STATE_READY:
+					# State is set to done once the tabs are restored
 					self._state = RELOADER_STATE_RELOADING
 					self._reopen_tabs(window)
-					self._state = RELOADER_STATE_DONE
 				else:
 					self._save_tabs()
 
@@ -160,8 +169,9 @@ class ReopenTabsPlugin(gedit.Plugin):
 		app = gedit.app_get_default()
 		win = app.get_active_window()
 		
-		# Return list of documents which having URI's
-		docs = [d.get_uri() for d in win.get_documents() if d.get_uri()]
+		# Return list of documents which having URI's (placeholders included)
+		docs = [document_uri(d) for d in win.get_documents()]
+		docs = [uri for uri in docs if uri]
 		
 		# Check if there is anything to save
 		if len(docs) > 0:
@@ -169,7 +179,7 @@ class ReopenTabsPlugin(gedit.Plugin):
 			self._config.remove_option("common", "active_document")
 	
 			cur_doc = win.get_active_document()
-			if cur_doc: cur_uri = cur_doc.get_uri()
+			if cur_doc: cur_uri = document_uri(cur_doc)
 			else: cur_uri = None
 			cur_doc = None
 		
@@ -203,42 +213,61 @@ class ReopenTabsPlugin(gedit.Plugin):
 		log('ACTION load tabs')
 		# Get list of open documents
 		open_docs = [d.get_uri() for d in window.get_documents() if d.get_uri()]
-		
-		# Get saved active document
-		active = self._config.get("common", "active_document")
-	
+
 		# Get document list
 		docs = self._config.options("documents")
 		log(str(docs))
 
+		# Documents to restore as (option name, uri) pairs
+		uris = []
+		for d in docs:
+			# Get document uri
+			uri = self._config.get("documents", d)
+
+			# Check if document is not already opened
+			if open_docs.count(uri) > 0: continue
+
+			uris.append((d, uri))
+
+		# Check if documents exist in background, a slow or unmounted drive
+		# must not block gedit startup
+		start_thread(self._check_documents, (window, uris))
+
+	def _check_documents(self, window, uris): # Runs in a background thread
+		existing = [(d, uri) for d, uri in uris if os.path.exists(uri.replace('file://', '', 1))]
+
+		# Tabs are created on the main loop
+		gobject.idle_add(self._restore_tabs, window, existing)
+
+	def _restore_tabs(self, window, docs):
+		# Get saved active document
+		active = self._config.get("common", "active_document")
+
+		# Placeholder tabs load their document when first activated
+		lazy = self._config.getboolean("common", "lazy_restore")
+
 		empty_tab = None
 		active_tab = None
 
 		# Check if active document is untitled (there is empty tab)
-		if window.get_active_document().is_untitled():
+		doc = window.get_active_document()
+		if doc and doc.is_untitled() and not document_uri(doc):
 			# Remember empty tab to close it later
 			empty_tab = window.get_active_tab()
 
-		# Check if document list is not empty
-		if len(docs) > 0:
-			
-			# Process the rest documents
-			for d in docs:
-				# Get document uri
-				uri = self._config.get("documents", d)
-				
-				# Check if document is not already opened
-				if open_docs.count(uri) > 0: continue
-
-				# Check if document exists
-				if not os.path.exists(uri.replace('file://', '', 1)): continue
-
+		for d, uri in docs:
+			if lazy and d != active:
+				# Create placeholder tab
+				tab = create_pending_tab(window, uri)
+			else:
 				# Create new tab
 				tab = window.create_tab_from_uri(uri, None, 0, True, False)
-		
-				# Check if document was active (and there is NOT file in command line)
-				if d == active and empty_tab != None:
-					active_tab = tab
+
+			# Check if document was active (and there is NOT file in command line)
+			if d == active and empty_tab != None:
+				active_tab = tab
+
+		self._state = RELOADER_STATE_DONE
 
 		# Connect handler that switches saved active document tab
 		log('empty tab: ' + str(empty_tab))
@@ -256,3 +285,4 @@ class ReopenTabsPlugin(gedit.Plugin):
 		if empty_tab == None:
 			self._save_tabs()
 
+		return False
@@ -21,7 +21,8 @@ default_use_spaces_key = "/apps/gedit-2/preferences/editor/tabs/insert_spaces"
 
 gconf_base_uri = u"/apps/gedit-2/plugins/smart_indent"
 config_client = gconf.client_get_default()
-config_client.add_dir(gconf_base_uri, gconf.CLIENT_PRELOAD_NONE)
+# Preloading makes the client cache the values and report their changes
+config_client.add_dir(gconf_base_uri, gconf.CLIENT_PRELOAD_ONELEVEL)
 
 DEFAULT_USE_SPACES = config_client.get(default_use_spaces_key)
 if DEFAULT_USE_SPACES:
@@ -39,6 +40,7 @@ keystrokes_key_str = "%s_unindent_keystrokes"
 
 # Trailsave Plugin Config
 crop_spaces_eol_key_str        = "%s_crop_spaces_eol"
+crop_modified_lines_key_str    = "%s_crop_modified_lines_only"
 insert_newline_eof_key_str     = "%s_insert_newline_eof"
 remove_blank_lines_eol_key_str = "%s_remove_blank_lines_eol"
 
@@ -154,11 +156,46 @@ def get_indent_config(key, lang, setting_type, default):
     return get_config(key, lang, setting_type, default, default_indent_config)
 
 
-get_indent_regex = lambda lang: get_indent_config(indent_key_str, lang, 'string', '')
-get_unindent_regex = lambda lang: get_indent_config(unindent_key_str, lang, 'string', '')
-get_unindent_keystrokes = lambda lang: get_indent_config(keystrokes_key_str, lang, 'string', '')
-get_use_spaces = lambda lang: get_indent_config(space_key_str, lang, 'bool', DEFAULT_USE_SPACES)
-get_tab_size = lambda lang: get_indent_config(size_key_str, lang, 'int', DEFAULT_TAB_SIZE)
+# Settings of the languages used so far, dropped whenever a setting changes
+language_settings = {}
+
+
+def get_language_settings(lang):
+    settings = language_settings.get(lang)
+    if settings is None:
+        settings = read_language_settings(lang)
+        language_settings[lang] = settings
+    return settings
+
+
+def read_language_settings(lang):
+    settings = {
+        'indent_regex'        : get_indent_config(indent_key_str, lang, 'string', ''),
+        'unindent_regex'      : get_indent_config(unindent_key_str, lang, 'string', ''),
+        'unindent_keystrokes' : get_indent_config(keystrokes_key_str, lang, 'string', ''),
+        'use_spaces'          : get_indent_config(space_key_str, lang, 'bool', DEFAULT_USE_SPACES),
+        'tab_size'            : get_indent_config(size_key_str, lang, 'int', DEFAULT_TAB_SIZE),
+        'crop_spaces_eol'     : get_trail_config(lang, crop_spaces_eol_key_str),
+        'crop_modified_lines' : get_config(crop_modified_lines_key_str, lang, 'bool', False),
+        'insert_newline_eof'  : get_trail_config(lang, insert_newline_eof_key_str),
+        'remove_blanklines'   : get_trail_config(lang, remove_blank_lines_eol_key_str),
+    }
+    settings['re_indent'] = settings['indent_regex'] and re.compile(settings['indent_regex']) or None
+    settings['re_unindent'] = settings['unindent_regex'] and re.compile(settings['unindent_regex']) or None
+    return settings
+
+
+def on_config_changed(client, cnxn_id, entry, data):
+    language_settings.clear()
+
+config_client.notify_add(gconf_base_uri, on_config_changed)
+
+
+get_indent_regex = lambda lang: get_language_settings(lang)['indent_regex']
+get_unindent_regex = lambda lang: get_language_settings(lang)['unindent_regex']
+get_unindent_keystrokes = lambda lang: get_language_settings(lang)['unindent_keystrokes']
+get_use_spaces = lambda lang: get_language_settings(lang)['use_spaces']
+get_tab_size = lambda lang: get_language_settings(lang)['tab_size']
 
 
 # TrailSave Plugin -------------------------------------------------------------
@@ -168,15 +205,19 @@ def get_trail_config(lang, key_str):
 
 
 def get_crop_spaces_eol(lang):
-    return get_trail_config(lang, crop_spaces_eol_key_str)
+    return get_language_settings(lang)['crop_spaces_eol']
+
+
+def get_crop_modified_lines_only(lang):
+    return get_language_settings(lang)['crop_modified_lines']
 
 
 def get_insert_newline_eof(lang):
-    return get_trail_config(lang, insert_newline_eof_key_str)
+    return get_language_settings(lang)['insert_newline_eof']
 
 
 def get_remove_blanklines_eof(lang):
-    return get_trail_config(lang, remove_blank_lines_eol_key_str)
+    return get_language_settings(lang)['remove_blanklines']
 
 # ------------------------------------------------------------------------------
 
@@ -339,12 +380,16 @@ class ConfigurationWindowHelper:
 
         # TrailsSave Options
         crop_spaces = get_crop_spaces_eol(self.lang_id)
+        crop_modified_lines = get_crop_modified_lines_only(self.lang_id)
         insert_newline = get_insert_newline_eof(self.lang_id)
         remove_blanklines = get_remove_blanklines_eof(self.lang_id)
 
         self.cbx_crop_spaces_on_eol = glade_xml.get_widget('cbx_crop_spaces_on_eol')
         self.cbx_crop_spaces_on_eol.set_active(crop_spaces)
 
+        self.cbx_crop_modified_lines_only = glade_xml.get_widget('cbx_crop_modified_lines_only')
+        self.cbx_crop_modified_lines_only.set_active(crop_modified_lines)
+
         self.cbx_insert_newline_at_eof = glade_xml.get_widget('cbx_insert_newline_at_eof')
         self.cbx_insert_newline_at_eof.set_active(insert_newline)
 
@@ -385,6 +430,7 @@ class ConfigurationWindowHelper:
 
         #TrailSave Plugin
         crop_spaces = self.cbx_crop_spaces_on_eol.get_active()
+        crop_modified_lines = self.cbx_crop_modified_lines_only.get_active()
         insert_newline = self.cbx_insert_newline_at_eof.get_active()
         remove_blanklines = self.cbx_remove_blank_lines_at_eof.get_active()
 
@@ -396,6 +442,7 @@ class ConfigurationWindowHelper:
 
         # TrailSave Plugin
         crop_spaces_key = crop_spaces_eol_key_str % self.lang_id
+        crop_modified_lines_key = crop_modified_lines_key_str % self.lang_id
         insert_newline_key = insert_newline_eof_key_str % self.lang_id
         remove_blanklines_key = remove_blank_lines_eol_key_str % self.lang_id
 
@@ -407,9 +454,14 @@ class ConfigurationWindowHelper:
 
         # TrailSave Plugin
         config_client.set_bool(os.path.join(gconf_base_uri, crop_spaces_key), crop_spaces)
+        config_client.set_bool(os.path.join(gconf_base_uri, crop_modified_lines_key), crop_modified_lines)
         config_client.set_bool(os.path.join(gconf_base_uri, insert_newline_key), insert_newline)
         config_client.set_bool(os.path.join(gconf_base_uri, remove_blanklines_key), remove_blanklines)
 
+        # Change notifications arrive later, do not configure the view with
+        # the old settings meanwhile
+        language_settings.pop(self.lang_id, None)
+
         view.set_insert_spaces_instead_of_tabs(use_spaces)
         view.set_tab_width(size)
         self.plugin.set_status(view)
@@ -438,13 +490,12 @@ class SmartIndent:
 
     def set_indent_config(self, lang):
         self.clear_variables()
-        r_indent = get_indent_regex(lang)
-        r_unindent = get_unindent_regex(lang)
-        u_keystrokes = get_unindent_keystrokes(lang)
-        if r_indent:
-            self.re_indent_next = re.compile(r_indent)
-        if r_unindent:
-            self.re_unindent_curr = re.compile(r_unindent)
+        settings = get_language_settings(lang)
+        r_indent = settings['indent_regex']
+        r_unindent = settings['unindent_regex']
+        u_keystrokes = settings['unindent_keystrokes']
+        self.re_indent_next = settings['re_indent']
+        self.re_unindent_curr = settings['re_unindent']
         if u_keystrokes:
             self.unindent_keystrokes = u_keystrokes
         # Return configured if some of the options is present
@@ -456,8 +507,9 @@ class SmartIndent:
 
     def set_language(self, lang, view):
         self.__not_available = not self.set_indent_config(lang)
-        tab_size    = get_tab_size(lang)
-        use_spaces  = get_use_spaces(lang)
+        settings    = get_language_settings(lang)
+        tab_size    = settings['tab_size']
+        use_spaces  = settings['use_spaces']
         # Set the buffer tab configuration
         view.set_tab_width(tab_size)
         view.set_insert_spaces_instead_of_tabs(use_spaces)
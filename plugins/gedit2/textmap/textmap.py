@@ -24,6 +24,9 @@ import cairo
 import re
 import copy
 import platform
+import array
+import difflib
+import weakref
 
 version = "0.2 beta"
 
@@ -130,34 +133,186 @@ def match_RE_list(str, REs):
       return m.groups()[0]
   return None
 
-def document_lines(document):
-  if not document:
-    return None
-  #print 'document_lines',document
-  STR = document.get_property('text')
-  lines = STR.split('\n')
-  ans = []
-  for i,each in enumerate(lines):
-    x = struct()
-    x.i = i
-    x.len = len(each)
-    x.indent = indent(each)
-    x.raw = each
-    x.section = match_RE_list(x.raw,SectionREs)
-    x.subsection = None
-    x.search_match = False
-    if not x.section:
-      x.subsection = match_RE_list(x.raw,SubsectionREs)
-    if x.section or x.subsection:
-      match = Split_Off_Indent_Pattern.match(x.raw)
-      x.indentSTR = None
-      x.justextSTR = None
-      if match:
-        groups = match.groups()
-        if len(groups) == 2:
-          x.indentSTR, x.justextSTR = groups
-    ans.append(x)
-  return ans
+LineSplit_Pattern = re.compile('\r\n|\r|\n|\xe2\x80\xa9')  # same line breaks as GtkTextBuffer
+
+class LineModel:
+  """Per document line data, kept up to date from the buffer's edit signals.
+  
+  Only the lines touched by an edit are split and matched against the section
+  regexes again. Per line data lives in parallel arrays indexed by line number,
+  line records for drawing are only built for the lines that get displayed.
+  Downsampled layouts are cached per widget height until the next edit.
+  
+  Changes since the document was loaded are found by comparing line hashes
+  with a snapshot of the original hashes. Every line remembers the original
+  line it descends from, in origin, so an edit only compares the lines it
+  touched and changed is always a ready to use bitmap of the changed lines."""
+  
+  def __init__(me, doc):
+    me.version = 0
+    me.pending = None
+    me.original = None # hashes of the lines at load time, no snapshot yet
+    me.rebuild(doc)
+    me.handler_ids = [
+      doc.connect("loaded", me.on_loaded),
+      doc.connect_after("insert-text", me.on_insert_text),
+      doc.connect("delete-range", me.on_delete_range),
+      doc.connect_after("delete-range", me.on_delete_range_after),
+    ]
+    
+  def detach(me, doc):
+    'stop following the edits of doc'
+    for handler_id in me.handler_ids:
+      doc.disconnect(handler_id)
+    me.handler_ids = []
+    
+  def rebuild(me, doc):
+    me.raw = []
+    me.hashes = array.array('l')
+    me.indent = array.array('i')
+    me.section = []
+    me.subsection = []
+    me.origin = array.array('i')
+    me.changed = bytearray()
+    me.replace(0, 0, LineSplit_Pattern.split(doc.get_property('text')))
+    if me.original is not None:
+      me.match_original()
+      
+  def snapshot(me):
+    'take the current lines as the original ones'
+    me.original = array.array('l', me.hashes)
+    me.origin = array.array('i', xrange(len(me.raw)))
+    me.changed = bytearray(len(me.raw))
+    me.version += 1
+    me.layouts = {}
+    
+  def match_original(me):
+    'find the origin of every line from scratch, with a diff against the original'
+    n = len(me.raw)
+    me.origin = array.array('i', [-1])*n
+    matcher = difflib.SequenceMatcher(None, me.original, me.hashes, autojunk=False)
+    for a, b, size in matcher.get_matching_blocks():
+      me.origin[b:b+size] = array.array('i', xrange(a, a+size))
+    me.changed = bytearray(o < 0 for o in me.origin)
+    me.version += 1
+    me.layouts = {}
+    
+  def replace(me, start, stop, texts):
+    'replace lines start:stop with the lines in texts'
+    hashes = array.array('l', map(hash, texts))
+    if me.original is None:
+      origin = array.array('i', [-1])*len(texts)
+      changed = bytearray(len(texts))
+    else:
+      # new lines descend from the replaced lines with the same original text,
+      # keeping their order, an edited line keeps the origin of the first one
+      old = me.origin[start:stop]
+      origin = array.array('i')
+      j = 0
+      for h in hashes:
+        k = j
+        while k < len(old) and (old[k] < 0 or me.original[old[k]] <> h):
+          k += 1
+        if k < len(old):
+          origin.append(old[k])
+          j = k+1
+        else:
+          origin.append(-1)
+      if j == 0 and old and origin:
+        origin[0] = old[0]
+      changed = bytearray(o < 0 or me.original[o] <> h for o, h in zip(origin, hashes))
+    sections = [match_RE_list(t,SectionREs) for t in texts]
+    subsections = []
+    for t, section in zip(texts, sections):
+      if section:
+        subsections.append(None)
+      else:
+        subsections.append(match_RE_list(t,SubsectionREs))
+    me.raw[start:stop] = texts
+    me.hashes[start:stop] = hashes
+    me.origin[start:stop] = origin
+    me.changed[start:stop] = changed
+    me.indent[start:stop] = array.array('i', [indent(t) for t in texts])
+    me.section[start:stop] = sections
+    me.subsection[start:stop] = subsections
+    me.version += 1
+    me.layouts = {}
+    me.search_cache = (None, None)
+    
+  def read_lines(me, doc, first, last):
+    start = doc.get_iter_at_line(first)
+    end = doc.get_iter_at_line(last)
+    if not end.ends_line():
+      end.forward_to_line_end()
+    return LineSplit_Pattern.split(doc.get_text(start, end))
+    
+  def check_line_count(me, doc):
+    # joining or splitting a \r\n pair changes the line count unexpectedly,
+    # start over when that happens
+    if len(me.raw) <> doc.get_line_count():
+      me.rebuild(doc)
+    
+  def on_loaded(me, doc, *args):
+    me.rebuild(doc)
+    me.snapshot()
+    
+  def on_insert_text(me, doc, piter, text, length):
+    # after the default handler piter is at the end of the inserted text
+    last = piter.get_line()
+    first = last - len(LineSplit_Pattern.split(text)) + 1
+    me.replace(first, first+1, me.read_lines(doc, first, last))
+    me.check_line_count(doc)
+    
+  def on_delete_range(me, doc, start, end):
+    me.pending = start.get_line(), end.get_line()
+    
+  def on_delete_range_after(me, doc, start, end):
+    first, last = me.pending
+    me.pending = None
+    line = start.get_line()
+    me.replace(first, last+1, me.read_lines(doc, line, line))
+    me.check_line_count(doc)
+    
+  def search_matches(me, search_text):
+    'set of the indices of lines containing search_text'
+    if not search_text:
+      return frozenset()
+    text, matches = me.search_cache
+    if text <> search_text:
+      matches = frozenset(i for i, raw in enumerate(me.raw) if search_text in raw)
+      me.search_cache = (search_text, matches)
+    return matches
+    
+  def layout(me, h, min_scale, max_scale, search_matches):
+    'cached downsample_lines, see there'
+    key = (h, min_scale, max_scale, search_matches)
+    if key not in me.layouts:
+      me.layouts[key] = downsample_lines(me, h, min_scale, max_scale, search_matches)
+    return me.layouts[key]
+    
+  def line_records(me, indices, search_matches):
+    'build the line records the drawing code works with'
+    ans = []
+    for i in indices:
+      x = struct()
+      x.i = i
+      x.raw = me.raw[i]
+      x.len = len(x.raw)
+      x.indent = me.indent[i]
+      x.section = me.section[i]
+      x.subsection = me.subsection[i]
+      x.changed = bool(me.changed[i])
+      x.search_match = i in search_matches
+      if x.section or x.subsection:
+        match = Split_Off_Indent_Pattern.match(x.raw)
+        x.indentSTR = None
+        x.justextSTR = None
+        if match:
+          groups = match.groups()
+          if len(groups) == 2:
+            x.indentSTR, x.justextSTR = groups
+      ans.append(x)
+    return ans
   
 def lines_add_section_len(lines):
   line_prevsection = None
@@ -243,6 +398,42 @@ def show_section_label(str, fg, bg, cr):
   cr.set_source_rgb(*fg)
   cr.show_text(str)
     
+def draw_line(line, scale, whitespaceW, clr, cr):
+  "draw the silhouette of line at the current point, returns its text height or None if it is empty"
+  cr.set_font_size(scale)
+  
+  if not line.raw.strip(): # empty line
+    return None
+    
+  tw,th = text_extents(line.raw,cr)
+  cr.set_source_rgb(*clr)
+    
+  if line.section or line.subsection:
+    #cr.select_font_face(fontfamily, cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_BOLD)
+    cr.set_font_size(scale+3)
+    if line.justextSTR:
+      x,y = cr.get_current_point()
+      cr.move_to(whitespaceW*line.indent,y)
+      cr.show_text(line.justextSTR)
+    else:
+      cr.show_text(line.raw)
+  else:
+    #cr.select_font_face(fontfamily, cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
+    cr.set_font_size(scale)
+    cr.show_text(line.raw)
+  return th
+  
+def draw_line_marker(line, w, searchBG, changeCLR, cr):
+  if line.search_match:
+    clr = searchBG
+  elif line.changed:
+    clr = changeCLR
+  else:
+    return # nothing interesting has happened with this line
+  cr.set_source_rgb(*clr)      
+  cr.rectangle(w-3,line.y-2,2,5)
+  cr.fill()
+    
 def fit_text(str, w, h, fg, bg, cr):
   moved_down = False
   originalx,_ = cr.get_current_point()
@@ -301,8 +492,9 @@ def fit_text(str, w, h, fg, bg, cr):
       break
   return rn
       
-def downsample_lines(lines, h, min_scale, max_scale):
-  n = len(lines)
+def downsample_lines(model, h, min_scale, max_scale, search_matches):
+  'returns the indices of the lines to display, the font scale and whether lines were dropped'
+  n = len(model.raw)
   
   # pick scale
   for scale in range(max_scale,min_scale-1,-1): 
@@ -312,34 +504,31 @@ def downsample_lines(lines, h, min_scale, max_scale):
       
   if n <= maxlines_:
     downsampled = False
-    return lines, scale, downsampled
-    
-  # need to downsample
-  lines[0].score = sys.maxint # keep the first line
-  for i in range(1, len(lines)):
-    if lines[i].section:  # keep sections
-      lines[i].score = sys.maxint
-    elif lines[i].subsection:
-      lines[i].score = sys.maxint/2
-    elif lines[i].changed or lines[i].search_match:
-      lines[i].score = sys.maxint/2
-    else:
-      if 0: # get rid of lines that are very different
-        lines[i].score = abs(lines[i].indent-lines[i-1].indent) \
-                         + abs(len(lines[i].raw)-len(lines[i-1].raw))
-      if 1: # get rid of lines randomly
-        lines[i].score = hash(lines[i].raw)
-        if lines[i].score > sys.maxint/2:
-          lines[i].score -= sys.maxint/2
-                     
-  scoresorted = sorted(lines, lambda x,y: cmp(x.score,y.score))
+    return range(n), scale, downsampled
+    
+  # need to downsample, get rid of lines randomly
+  half = sys.maxint/2
+  scores = map(hash, model.raw)
+  for i, score in enumerate(scores):
+    if score > half:
+      scores[i] = score - half
+  for i in search_matches:
+    scores[i] = half
+  for i, section, subsection, changed in zip(xrange(n), model.section, model.subsection, model.changed):
+    if section:   # keep sections
+      scores[i] = sys.maxint
+    elif subsection or changed:
+      scores[i] = half
+  scores[0] = sys.maxint # keep the first line
+  
   erasures_ = int(math.ceil(n - maxlines_))
   #print 'erasures_',erasures_
-  scoresorted[0:erasures_]=[]
+  kept = sorted(xrange(n), key=scores.__getitem__)[erasures_:]
+  kept.sort()
     
   downsampled = True
   
-  return sorted(scoresorted, lambda x,y:cmp(x.i,y.i)), scale, downsampled
+  return kept, scale, downsampled
       
 def visible_lines_top_bottom(geditwin):
   view = geditwin.get_active_view()
@@ -578,56 +767,6 @@ def str2rgb(s):
   b = int(s[5:7],16)/256.
   return r,g,b
   
-def init_original_lines_info(doc,lines):
-  rn = []
-  # now we insert marks at the end of every line
-  iter = doc.get_start_iter()
-  n = 0
-  while 1:
-    if n>=len(lines):
-      break
-    more_left = iter.forward_line()
-    rec = struct()
-    lines[n].mark = doc.create_mark(None,iter,False) 
-    n+=1
-    if not more_left:
-      break
-  assert n>=len(lines)-1,(n,len(lines),'something off with our iterator logic')
-  if n==len(lines)-1:
-    lines[-1].mark=doc.create_mark(None,doc.get_end_iter(),False)
-  return lines
-  
-def mark_changed_lines(doc,original,current):
-  'unfortunate choice of name, has nothing to do with GtkTextBuffer marks'
-
-  # presume all current lines are changed
-  for line in current:
-    line.changed = True
-  
-  # mark any original lines we find as unchanged
-  start = doc.get_start_iter()
-  c=0
-  for oline in original:
-    end = doc.get_iter_at_mark(oline.mark)
-    slice = doc.get_slice(start,end)
-    # see if the first line between the marks is the original line
-    if slice.split('\n',1)[0] == oline.raw:
-      current[c].changed = False
-    # forward through all the slice lines
-    c += slice.count('\n')
-
-    start = end
-
-  return current
-      
-def lines_mark_search_matches(lines,docrec):
-  for line in lines:
-    if docrec.search_text and docrec.search_text in line.raw:
-      line.search_match = True
-    else:
-      line.search_match = False
-  return lines
-  
 Split_Off_Indent_Pattern = re.compile('(\s*)(.*)$')
       
 class TextmapView(gtk.VBox):
@@ -656,14 +795,16 @@ class TextmapView(gtk.VBox):
     #probj(me.darea)
 
     me.connected = {}
-    me.draw_scrollbar_only = False
     me.draw_sections = False
     me.topL = None
-    me.surface_textmap = None
+    me.surface_textmap = None # offscreen rendering of everything but the scrollbar
+    me.surface_key = None     # what surface_textmap shows, see expose
+    me.render_state = None    # layout of surface_textmap, for repaint_lines
     
     me.line_count = 0
     
     me.doc_attached_data = {}
+    me.tab_removed_id = geditwin.connect("tab-removed", me.on_tab_removed)
     
     me.show_all()
     
@@ -692,6 +833,24 @@ class TextmapView(gtk.VBox):
      #                               self.vruler)
      #'''
   
+  def detach_docrec(me, docrec):
+    doc = docrec.docref()
+    if doc is not None:
+      docrec.model.detach(doc)
+      
+  def on_tab_removed(me, geditwin, tab):
+    # the tab may be moved to another window, which keeps its own model
+    docrec = me.doc_attached_data.pop(id(tab.get_document()), None)
+    if docrec is not None:
+      me.detach_docrec(docrec)
+      
+  def detach(me):
+    'disconnect from the window and every document, before the view goes away'
+    me.geditwin.disconnect(me.tab_removed_id)
+    for docrec in me.doc_attached_data.values():
+      me.detach_docrec(docrec)
+    me.doc_attached_data = {}
+    
   def on_darea_motion_notify_event(me, widget, event):
     #probj(event)
     #print event.type
@@ -745,12 +904,6 @@ class TextmapView(gtk.VBox):
     topL = visible_lines_top_bottom(me.geditwin)[0]
     if topL <> me.topL:
       queue_refresh(me)
-      me.draw_scrollbar_only = True
-    
-  def on_insert_text(me, doc, piter, text, len):
-    pass
-    #if len < 20 and '\n' in text:
-    #  print 'piter',piter,'text',repr(text),'len',len
     
   def scroll_from_y_mouse_pos(me,y):
     for line in me.lines:
@@ -776,15 +929,12 @@ class TextmapView(gtk.VBox):
     if time.time()-me.last_scroll_time > .47:
       if me.draw_sections:
         me.draw_sections = False
-        me.draw_scrollbar_only = False
         queue_refresh(me)
     return False
     
   def on_scroll_event(me,view,event):
     me.last_scroll_time = time.time()
-    if me.draw_sections: # we are in the middle of scrolling
-      me.draw_scrollbar_only = True
-    else:
+    if not me.draw_sections: # otherwise we are in the middle of scrolling
       me.draw_sections = True # for the first scroll, turn on section names
     gobject.timeout_add(500,me.on_scroll_finished) # this will fade out sections
     queue_refresh(me)
@@ -806,6 +956,70 @@ class TextmapView(gtk.VBox):
       cr.set_font_size(each)
       me.font_face_keepalive.append(cr.get_font_face())
     
+  def repaint_lines(me, model, key, w, h, fg, bg, searchBG, changeCLR):
+    '''After an edit that keeps the layout of the textmap, repaint just the
+    bands of the lines that changed on the cached surface. Returns False if
+    everything needs to be redrawn instead.'''
+    state = me.render_state
+    if state is None or me.draw_sections: # section labels may cover any line
+      return False
+    if state.key[:1]+state.key[2:] <> key[:1]+key[2:]: # only the text may differ
+      return False
+    indices, scale, downsampled = model.layout(h, 2, state.max_scale, key[-1])
+    if scale <> state.scale or indices <> state.indices:
+      return False
+    lines = model.line_records(indices, key[-1])
+    
+    cr = cairo.Context(me.surface_textmap)
+    cr.select_font_face('monospace', cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
+    cr.set_font_size(scale)
+    dirty = []
+    for k, (old, line) in enumerate(zip(state.lines, lines)):
+      line.y = old.y
+      line.advance = old.advance
+      if (line.raw, line.changed, line.search_match) == (old.raw, old.changed, old.search_match):
+        continue
+      if not state.smooshed:
+        if line.raw.strip():
+          advance = text_extents(line.raw,cr)[1]
+        else:
+          advance = scale-1
+        if advance <> old.advance: # the lines below would move
+          return False
+      dirty.append(k)
+      
+    # glyphs reach up from a line's y into the band of the line before, so
+    # redraw the neighbours clipped to the band as well
+    margin = 3
+    for k in dirty:
+      top = k > 0 and lines[k-1].y or 0
+      bot = k+1 < len(lines) and lines[k+1].y or h
+      near = lines[max(k-1,0):k+3]
+      cr.save()
+      cr.rectangle(0,top,w,bot-top)
+      cr.clip()
+      cr.set_source_rgb(*bg)
+      cr.paint()
+      cr.translate(margin,0)
+      for line in near:
+        if line.search_match:
+          clr = searchBG
+        elif line.changed:
+          clr = changeCLR
+        else:
+          clr = fg
+        cr.move_to(0,line.y)
+        draw_line(line, scale, state.whitespaceW, clr, cr)
+      cr.translate(-margin,0)
+      for line in near:
+        draw_line_marker(line, w, searchBG, changeCLR, cr)
+      cr.restore()
+      
+    state.key = key
+    state.lines = lines
+    me.lines = lines
+    return True
+    
   def expose(me, widget, event):
     doc = me.geditwin.get_active_tab().get_document()
     if not doc:   # nothing open yet
@@ -814,7 +1028,6 @@ class TextmapView(gtk.VBox):
     if id(doc) not in me.connected:
       me.connected[id(doc)] = True
       doc.connect("cursor-moved", me.on_doc_cursor_moved)
-      doc.connect("insert-text", me.on_insert_text)
       doc.connect("search-highlight-updated", me.on_search_highlight_updated)
       
     view = me.geditwin.get_active_view()
@@ -865,260 +1078,243 @@ class TextmapView(gtk.VBox):
     except AttributeError:
       win = widget.window
     w,h = map(float,win.get_size())
-    cr = widget.window.cairo_create()
-    
-    #probj(cr,'rgb')
-    
-    # Are we drawing everything, or just the scrollbar?
-    fontfamily = 'sans-serif'
-    cr.select_font_face('monospace', cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
-            
-    if me.surface_textmap is None or not me.draw_scrollbar_only:
     
-      if TIMER: TIMER.push('document_lines')
+    docrec = me.doc_attached_data.get(id(doc))
+    if docrec is None or docrec.docref() is not doc: # ids get reused
+      if docrec is not None:
+        me.detach_docrec(docrec)
+      docrec = struct()
+      me.doc_attached_data[id(doc)] = docrec
+      docrec.docref = weakref.ref(doc)
+      docrec.model = LineModel(doc)
+      docrec.search_text = None
+    elif docrec.model.original is None: # we skip the first one, its empty
+      docrec.model.snapshot()
+    model = docrec.model
 
-      lines = document_lines(doc)
-      
-      if TIMER: TIMER.pop('document_lines')
-      
+    search_matches = frozenset()
+    if BUG_MASK & BUG_DOC_GET_SEARCH_TEXT:
+      pass
+    else:
+      docrec.search_text = doc.get_search_text()[0]
+      search_matches = model.search_matches(docrec.search_text)
+     
+    # The textmap is rendered offscreen and only redrawn when something it
+    # shows changes. Cursor moves and scrolling just composite it and draw
+    # the scrollbar on top.
+    key = (id(doc), model.version, w, h, fg, bg, me.draw_sections, search_matches)
+    if me.surface_textmap is None or me.surface_key <> key:
+    
       if TIMER: TIMER.push('draw textmap')
       
-      if id(doc) not in me.doc_attached_data:
-        docrec = struct()
-        me.doc_attached_data[id(doc)] = docrec
-        docrec.original_lines_info = None # we skip the first one, its empty
-        docrec.search_text = None
-        for l in lines:
-          l.changed = False
-      else:
-        docrec = me.doc_attached_data[id(doc)]
-        if docrec.original_lines_info == None:
-          docrec.original_lines_info = init_original_lines_info(doc,lines)
-        lines = mark_changed_lines(doc, docrec.original_lines_info, lines)
-        
-      if BUG_MASK & BUG_DOC_GET_SEARCH_TEXT:
-        pass
-      else:
-        docrec.search_text = doc.get_search_text()[0]
-        lines = lines_mark_search_matches(lines,docrec)
-     
-      cr.push_group()
+      if not me.repaint_lines(model, key, w, h, fg, bg, searchBG, changeCLR):
       
-      # bg
-      if 1:
-        #cr.set_source_rgb(46/256.,52/256.,54/256.)
-        cr.set_source_rgb(*bg)
-        cr.move_to(0,0)
-        cr.rectangle(0,0,w,h)
-        cr.fill()
-        cr.move_to(0,0)
+        me.surface_textmap = widget.window.cairo_create().get_target().create_similar(
+          cairo.CONTENT_COLOR_ALPHA, int(w), int(h))
+        cr = cairo.Context(me.surface_textmap)
+        
+        fontfamily = 'sans-serif'
+        cr.select_font_face('monospace', cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
+        
+        # bg
+        if 1:
+          #cr.set_source_rgb(46/256.,52/256.,54/256.)
+          cr.set_source_rgb(*bg)
+          cr.move_to(0,0)
+          cr.rectangle(0,0,w,h)
+          cr.fill()
+          cr.move_to(0,0)
       
-      if not lines:
-        return
+        if not model.raw:
+          return
         
-      # translate everthing in
-      margin = 3
-      cr.translate(margin,0)
-      w -= margin # an d here
+        # translate everthing in
+        margin = 3
+        cr.translate(margin,0)
+        w -= margin # an d here
             
-      if TIMER: TIMER.push('downsample')
-      max_scale = 3
-      lines, scale, downsampled = downsample_lines(lines, h, 2, max_scale)
-      if TIMER: TIMER.pop('downsample')
+        if TIMER: TIMER.push('downsample')
+        max_scale = 3
+        indices, scale, downsampled = model.layout(h, 2, max_scale, search_matches)
+        lines = model.line_records(indices, search_matches)
+        if TIMER: TIMER.pop('downsample')
       
-      smooshed = False
-      if downsampled or scale < max_scale:
-        smooshed = True
+        smooshed = False
+        if downsampled or scale < max_scale:
+          smooshed = True
       
-      if TIMER: TIMER.push('lines_add_section_len')
-      lines = lines_add_section_len(lines)
-      if TIMER: TIMER.pop('lines_add_section_len')
+        if TIMER: TIMER.push('lines_add_section_len')
+        lines = lines_add_section_len(lines)
+        if TIMER: TIMER.pop('lines_add_section_len')
       
-      if TIMER: TIMER.push('lines_mark_changed_sections')
-      lines = lines_mark_changed_sections(lines)
-      if TIMER: TIMER.pop('lines_mark_changed_sections')
+        if TIMER: TIMER.push('lines_mark_changed_sections')
+        lines = lines_mark_changed_sections(lines)
+        if TIMER: TIMER.pop('lines_mark_changed_sections')
 
-      n = len(lines)
-      lineH = h/n
+        n = len(lines)
+        lineH = h/n
       
-      #print 'doc',doc.get_uri(), lines[0].raw
+        #print 'doc',doc.get_uri(), lines[0].raw
       
-      if BUG_MASK & BUG_CAIRO_MAC_FONT_REF and me.font_face_keepalive is None:
-        me.save_refs_to_all_font_faces(cr,scale,scale+3,10,12)
+        if BUG_MASK & BUG_CAIRO_MAC_FONT_REF and me.font_face_keepalive is None:
+          me.save_refs_to_all_font_faces(cr,scale,scale+3,10,12)
       
-      cr.set_font_size(scale)
-      whitespaceW = text_extents('.',cr)[0]
-      #print pr_text_extents(' ',cr)
-      #print pr_text_extents('.',cr)
-      #print pr_text_extents(' .',cr)
+        cr.set_font_size(scale)
+        whitespaceW = text_extents('.',cr)[0]
+        #print pr_text_extents(' ',cr)
+        #print pr_text_extents('.',cr)
+        #print pr_text_extents(' .',cr)
       
-      # ------------------------ display text silhouette -----------------------
-      if TIMER: TIMER.push('draw silhouette')
+        # ------------------------ display text silhouette -----------------------
+        if TIMER: TIMER.push('draw silhouette')
       
-      if dark(*fg):
-        faded_fg = lighten(.5,*fg)
-      else:
-        faded_fg = darken(.5,*fg)
+        if dark(*fg):
+          faded_fg = lighten(.5,*fg)
+        else:
+          faded_fg = darken(.5,*fg)
           
-      rectH = h/float(len(lines))
-      sofarH= 0
-      sections = []
-      for i, line in enumerate(lines):
+        rectH = h/float(len(lines))
+        sofarH= 0
+        sections = []
+        for i, line in enumerate(lines):
       
-        line.y = sofarH
-        lastH = sofarH
-        cr.set_font_size(scale)
-        
-        if line.raw.strip(): # there is some text here
-            
-          tw,th = text_extents(line.raw,cr)
+          line.y = sofarH
+          lastH = sofarH
         
           if line.search_match:
-            cr.set_source_rgb(*searchBG)
+            clr = searchBG
           elif line.changed:
-            cr.set_source_rgb(*changeCLR)
+            clr = changeCLR
           elif me.draw_sections:
-            cr.set_source_rgb(*faded_fg)
-          else:
-            cr.set_source_rgb(*fg)
-            
-          if line.section or line.subsection:
-            #cr.select_font_face(fontfamily, cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_BOLD)
-            cr.set_font_size(scale+3)
-            if line.justextSTR:
-              x,y = cr.get_current_point()
-              cr.move_to(whitespaceW*line.indent,y)
-              cr.show_text(line.justextSTR)
-            else:
-              cr.show_text(line.raw)
+            clr = faded_fg
           else:
-            #cr.select_font_face(fontfamily, cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
-            cr.set_font_size(scale)
-            cr.show_text(line.raw)
+            clr = fg
+          th = draw_line(line, scale, whitespaceW, clr, cr)
           
           if smooshed:
             sofarH += lineH
+          elif th is None: # empty line
+            sofarH += scale-1
           else:
             sofarH += th
-        else: # empty line
-          if smooshed:
-            sofarH += lineH
-          else:
-            sofarH += scale-1
+          line.advance = sofarH-lastH
           
-        if line.section:
-          sections.append((line, lastH))
+          if line.section:
+            sections.append((line, lastH))
           
-        cr.move_to(0, sofarH)
+          cr.move_to(0, sofarH)
         
-      if TIMER: TIMER.pop('draw silhouette')
+        if TIMER: TIMER.pop('draw silhouette')
           
-      # ------------------- display sections and subsections labels  ------------------
+        # ------------------- display sections and subsections labels  ------------------
 
-      if me.draw_sections:
-        # Subsections
+        if me.draw_sections:
+          # Subsections
         
-        if TIMER: TIMER.push('draw subsections')
+          if TIMER: TIMER.push('draw subsections')
         
-        if dark(*bg):
-          bg_rect_C = lighten(.1,*bg)
-        else:
-          bg_rect_C = darken(.1,*bg)
+          if dark(*bg):
+            bg_rect_C = lighten(.1,*bg)
+          else:
+            bg_rect_C = darken(.1,*bg)
           
-        if 0: # - blot out the background -
-          cr.set_source_rgba(bg_rect_C[0],bg_rect_C[1],bg_rect_C[2],.5)
-          cr.rectangle(0,0,w,h)
-          cr.fill()
+          if 0: # - blot out the background -
+            cr.set_source_rgba(bg_rect_C[0],bg_rect_C[1],bg_rect_C[2],.5)
+            cr.rectangle(0,0,w,h)
+            cr.fill()
         
-        cr.new_path()
-        cr.set_line_width(1.5)
-        subsW = 10
-        subsmargin = 10
-        cr.set_font_size(10)
-        for line in lines:
-          if line.subsection:
-            if 0:
-              cr.move_to(subsmargin,line.y)
-              cr.line_to(subsmargin+subsW,line.y)
-            #if line.subsectionchanged:
-            #  cr.set_source_rgb(*changeCLR)
-            #else:
-            #  cr.set_source_rgb(*fg)
-            if 0:
-              cr.set_source_rgb(*fg)
-              cr.arc(subsmargin,line.y+3,2,0,6.28)
-              cr.stroke()
-            if 1:
-              #cr.move_to(20,line.y)
-              cr.set_source_rgb(*fg)
-              #cr.show_text(line.subsection)
-              cr.move_to(whitespaceW*line.indent,line.y)
-              #cr.move_to(10,line.y)
-              #fit_text(line.subsection, 10000, 10000, fg, bg, cr)
-              show_section_label(line.subsection, fg, bg_rect_C, cr)
+          cr.new_path()
+          cr.set_line_width(1.5)
+          subsW = 10
+          subsmargin = 10
+          cr.set_font_size(10)
+          for line in lines:
+            if line.subsection:
+              if 0:
+                cr.move_to(subsmargin,line.y)
+                cr.line_to(subsmargin+subsW,line.y)
+              #if line.subsectionchanged:
+              #  cr.set_source_rgb(*changeCLR)
+              #else:
+              #  cr.set_source_rgb(*fg)
+              if 0:
+                cr.set_source_rgb(*fg)
+                cr.arc(subsmargin,line.y+3,2,0,6.28)
+                cr.stroke()
+              if 1:
+                #cr.move_to(20,line.y)
+                cr.set_source_rgb(*fg)
+                #cr.show_text(line.subsection)
+                cr.move_to(whitespaceW*line.indent,line.y)
+                #cr.move_to(10,line.y)
+                #fit_text(line.subsection, 10000, 10000, fg, bg, cr)
+                show_section_label(line.subsection, fg, bg_rect_C, cr)
               
-        if TIMER: TIMER.pop('draw subsections')
+          if TIMER: TIMER.pop('draw subsections')
         
-        # Sections
+          # Sections
         
-        if TIMER: TIMER.push('draw sections')
-        cr.set_font_size(12)
-        for line, lastH in sections:
+          if TIMER: TIMER.push('draw sections')
+          cr.set_font_size(12)
+          for line, lastH in sections:
         
-          if 0: # section lines
-            cr.move_to(0, lastH)
-            cr.set_line_width(1)
-            cr.set_source_rgb(*fg)
-            cr.line_to(w,lastH)
-            cr.stroke()
+            if 0: # section lines
+              cr.move_to(0, lastH)
+              cr.set_line_width(1)
+              cr.set_source_rgb(*fg)
+              cr.line_to(w,lastH)
+              cr.stroke()
           
-          if 1: # section heading
-            cr.move_to(0,lastH)
-            #if line.sectionchanged:
-            #  cr.set_source_rgb(*changeCLR)
-            #else:
-            #  cr.set_source_rgb(*fg)
-            cr.set_source_rgb(*fg)         
-            #dispnfo = fit_text(line.section,4*w/5,line.section_len*rectH,fg,bg,cr)
-            show_section_label(line.section, fg, bg_rect_C, cr)
+            if 1: # section heading
+              cr.move_to(0,lastH)
+              #if line.sectionchanged:
+              #  cr.set_source_rgb(*changeCLR)
+              #else:
+              #  cr.set_source_rgb(*fg)
+              cr.set_source_rgb(*fg)         
+              #dispnfo = fit_text(line.section,4*w/5,line.section_len*rectH,fg,bg,cr)
+              show_section_label(line.section, fg, bg_rect_C, cr)
             
-          if 0 and dispnfo: # section hatches
-            cr.set_line_width(1)
-            r=dispnfo[0] # first line
-            cr.move_to(r.x+r.tw+2,r.y-r.th/2+2)
-            cr.line_to(w,r.y-r.th/2+2)
-            cr.stroke()
+            if 0 and dispnfo: # section hatches
+              cr.set_line_width(1)
+              r=dispnfo[0] # first line
+              cr.move_to(r.x+r.tw+2,r.y-r.th/2+2)
+              cr.line_to(w,r.y-r.th/2+2)
+              cr.stroke()
             
-        if TIMER: TIMER.pop('draw sections')
+          if TIMER: TIMER.pop('draw sections')
           
-      # ------------------ translate back for the scroll bar -------------------
+        # ------------------ translate back for the scroll bar -------------------
       
-      cr.translate(-margin,0)
-      w += margin
+        cr.translate(-margin,0)
+        w += margin
 
-      # -------------------------- mark lines markers --------------------------
+        # -------------------------- mark lines markers --------------------------
             
-      if TIMER: TIMER.push('draw line markers')
-      for line in lines:
-        if line.search_match:
-          clr = searchBG
-        elif line.changed:
-          clr = changeCLR
-        else:
-          continue # nothing interesting has happened with this line
-        cr.set_source_rgb(*clr)      
-        cr.rectangle(w-3,line.y-2,2,5)
-        cr.fill()
-      if TIMER: TIMER.pop('draw line markers')
+        if TIMER: TIMER.push('draw line markers')
+        for line in lines:
+          draw_line_marker(line, w, searchBG, changeCLR, cr)
+        if TIMER: TIMER.pop('draw line markers')
         
+        me.lines = lines
+        state = struct()
+        state.key = key
+        state.lines = lines
+        state.indices = indices
+        state.scale = scale
+        state.max_scale = max_scale
+        state.smooshed = smooshed
+        state.whitespaceW = whitespaceW
+        me.render_state = state
+      
+      me.surface_key = key
+      
       if TIMER: TIMER.pop('draw textmap')
       
-      # save
-      me.surface_textmap = cr.pop_group() # everything but the scrollbar
-      me.lines = lines
-
+    cr = widget.window.cairo_create()
+    
     if TIMER: TIMER.push('surface_textmap')
-    cr.set_source(me.surface_textmap)
+    cr.set_source_surface(me.surface_textmap,0,0)
     cr.rectangle(0,0,w,h)
     cr.fill()
     if TIMER: TIMER.pop('surface_textmap')
@@ -1137,7 +1333,6 @@ class TextmapView(gtk.VBox):
     if TIMER: TIMER.pop('scrollbar')
     
     me.topL = topL
-    me.draw_scrollbar_only = False
     
     if TIMER: TIMER.pop('expose')
     if TIMER: TIMER.print_()
@@ -1157,6 +1352,7 @@ class TextmapWindowHelper:
     me.panel = panel
 
   def deactivate(me):
+    me.textmapview.detach()
     me.window = None
     me.plugin = None
     me.textmapview = None
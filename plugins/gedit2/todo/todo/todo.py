@@ -19,25 +19,42 @@
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 #
 
-import os, sys, operator
-from stat import *
+import os
+import cPickle
+import hashlib
+import json
+import Queue
+from multiprocessing.pool import ThreadPool
 from string import Template
 import re
+import urllib
 
-def parse_directory(root):
+from lib.threads import start_thread
 
-    home_folder = os.path.expanduser('~')
+# Config FileName
+CONFIG_FILE = os.path.join(os.path.dirname(__file__), "todo.conf")
 
-    # TODO: Look first for a config file present in /etc to facility configuration
-    # Config FileName
-    config_file = os.path.join(os.path.dirname(__file__), "todo.conf")
+# Marks found in each file are kept here between sessions
+CACHE_DIR = os.path.expanduser('~/.gnome2/gedit/todo')
+
+# Number of threads reading files while scanning
+SCAN_WORKERS = 4
 
+def config_mtime():
+    try:
+        return os.stat(CONFIG_FILE).st_mtime
+    except OSError:
+        return None
+
+def load_configs():
+    # TODO: Look first for a config file present in /etc to facility configuration
     # Configs read regular expression
     cfg_rx = re.compile(r"(ALLOWED_EXTENSIONS|SKIPED_DIRS|KNOWN_MARKS|SKIPED_FILES|SHOW_EMPTY_MARKS|REQUIRE_COLON|MARK_COLORS)=+(.*?)$")
 
     # Get Configuration Info
-    cfg_file = open(config_file,'r')
+    cfg_file = open(CONFIG_FILE,'r')
     cfg_data = cfg_file.read().split('\n')
+    cfg_file.close()
 
     configs = {'ALLOWED_EXTENSIONS':'','SKIPED_DIRS':'','KNOWN_MARKS':'',\
             'SKIPED_FILES':'','SHOW_EMPTY_MARKS':'0','REQUIRE_COLON':'1','MARK_COLORS': ''}
@@ -46,183 +63,320 @@ def parse_directory(root):
         cfg_match = cfg_rx.search(cfg_line)
         if cfg_match:
             configs[cfg_match.group(1)] = cfg_match.group(2)
-
-    def make_regex(config_str):
-        return "|".join([re.escape(k) for k in configs[config_str].split(';')])
-
-    allowed_extensions_regex = make_regex('ALLOWED_EXTENSIONS')
-    skiped_dirs_regex = make_regex('SKIPED_DIRS')
-    known_marks_regex = make_regex('KNOWN_MARKS')
-    skiped_files_regex = make_regex('SKIPED_FILES')
-
-    known_marks_list = known_marks_regex.split('|')
-
-    # Initial Setup
-    allowed_types = re.compile(r'.*\.\b(%s)\b$' % allowed_extensions_regex)
-    skiped_dirs = re.compile(r'.*(%s)$' % skiped_dirs_regex)
-    # Enable os disable colons
-    if configs["REQUIRE_COLON"] == "1":
-        known_marks = re.compile(r'\b(%s)\b\s?: +(.*?)$' % known_marks_regex)
-    else:
-        known_marks = re.compile(r'\b(%s)\b\s?:? +(.*?)$' % known_marks_regex)
-    skiped_files = re.compile(r"("+skiped_files_regex+")$")
-
-    total_marks = 0
-
-    # Helper Functions
-    def file_link(file, line=0):
-        return "gedit:///%s?line=%d" % (file,line-1)
-
-    # Escape possible tags from comments as HTML
-    def escape(str_):
-        lt = re.compile(r'<')
-        gt = re.compile(r'>')
-        return lt.sub("&lt;",gt.sub("&gt;",str_))
-
-    # Todo Header image pattern
-    def todo_header():
-        return "file://" + os.path.join(os.path.dirname(__file__), "todo_header.png")
-
-    # Todo Gear Image
-    def todo_gears():
-        return "file://" + os.path.join(os.path.dirname(__file__), "todo_gears.png")
-
-    # Initialize the values list
-    values = []
-
-    # Markup Label Counter
-    labels = {}
-
-    for label in known_marks_list:
-        labels[label]=0
-
-
-    # walk over directory tree
-    def walktree(top, callback):
-        '''recursively descend the directory tree rooted at top,
-           calling the callback function for each regular file'''
-
-        for f in os.listdir(top):
-            pathname = os.path.join(top, f)
-            try:
-                mode = os.stat(pathname)[ST_MODE]
-                if S_ISDIR(mode):
-                    # It's a directory, recurse into it
-                    if not skiped_dirs.match(pathname):
-                        walktree(pathname, callback)
-                elif S_ISREG(mode):
-                    # It's a file, call the callback function
-                    if not skiped_files.match(pathname):
-                        callback(pathname)
-                else:
-                    # Unknown file type, pass
-                    pass
-            except OSError:
-                continue
-
-    # Test File Callback function
-    def test_file(file):
+    return configs
+
+# Helper Functions
+def file_link(file, line=0):
+    if isinstance(file, unicode):
+        file = file.encode('utf-8')
+    return "gedit:///%s?line=%d" % (urllib.quote(file),line-1)
+
+# Paths and file contents are bytes in any encoding, the page wants text
+def text(str_):
+    if isinstance(str_, unicode):
+        return str_
+    return str_.decode('utf-8', 'replace')
+
+# Escape possible tags from comments as HTML
+def escape(str_):
+    lt = re.compile(r'<')
+    gt = re.compile(r'>')
+    return lt.sub("&lt;",gt.sub("&gt;",str_))
+
+# Todo Header image pattern
+def todo_header():
+    return "file://" + os.path.join(os.path.dirname(__file__), "todo_header.png")
+
+# Todo Gear Image
+def todo_gears():
+    return "file://" + os.path.join(os.path.dirname(__file__), "todo_gears.png")
+
+class TodoScanner(object):
+    '''Finds the TODO marks of the files under a root directory.
+
+       Files are read by a pool of threads, skipping the files whose mtime
+       and size did not change since they were last read, either in this
+       session or in a previous one thanks to a cache file. The marks found
+       are handed to the main thread through a queue, so the list can be
+       shown while the scan goes on. Each scan has a queue of its own, so
+       results a previous scan left unread are never mixed with its own.
+
+       A scanner is kept for each root and replaced once todo.conf changed.'''
+
+    _instances = {}
+
+    def __init__(self, root):
+        self.root = root
+        self.config_mtime = config_mtime()
+        self.configs = configs = load_configs()
+
+        def make_regex(config_str):
+            return "|".join([re.escape(k) for k in configs[config_str].split(';')])
+
+        allowed_extensions_regex = make_regex('ALLOWED_EXTENSIONS')
+        skiped_dirs_regex = make_regex('SKIPED_DIRS')
+        known_marks_regex = make_regex('KNOWN_MARKS')
+        skiped_files_regex = make_regex('SKIPED_FILES')
+
+        self.known_marks_list = known_marks_regex.split('|')
+
+        # Initial Setup
+        self.allowed_types = re.compile(r'.*\.\b(%s)\b$' % allowed_extensions_regex)
+        self.skiped_dirs = re.compile(r'.*(%s)$' % skiped_dirs_regex)
+        # Enable os disable colons, one match per line as the whole file is searched at once
+        if configs["REQUIRE_COLON"] == "1":
+            self.known_marks = re.compile(r'\b(%s)\b[ \t]?: +(.*?)$' % known_marks_regex, re.M)
+        else:
+            self.known_marks = re.compile(r'\b(%s)\b[ \t]?:? +(.*?)$' % known_marks_regex, re.M)
+        self.skiped_files = re.compile(r"("+skiped_files_regex+")$")
+
+        # The cache is only valid for the marks it was built with
+        self.cache_key = (self.known_marks.pattern, configs['ALLOWED_EXTENSIONS'])
+        self.cache_path = os.path.join(CACHE_DIR, hashlib.md5(
+            root.encode('utf-8') if isinstance(root, unicode) else root).hexdigest())
+
+        # path -> (mtime, size, [(line, label, comment), ...])
+        self.files = {}
+
+        # Markup Label Counter
+        self.labels = {}
+        for label in self.known_marks_list:
+            self.labels[label] = 0
+
+        self.results = Queue.Queue()
+        self._thread = None
+
+    @classmethod
+    def get(cls, root):
+        scanner = cls._instances.get(root)
+        if scanner is None or scanner.config_mtime != config_mtime():
+            scanner = cls._instances[root] = cls(root)
+        return scanner
+
+    def walk(self):
+        '''descend the directory tree rooted at root,
+           yielding the files to be parsed'''
+        for top, dirs, files in os.walk(self.root):
+            dirs[:] = [d for d in dirs
+                       if not self.skiped_dirs.match(os.path.join(top, d))]
+            for f in files:
+                pathname = os.path.join(top, f)
+                if self.allowed_types.match(pathname) and not self.skiped_files.match(pathname):
+                    yield pathname
+
+    def read_marks(self, file):
         """ Parse the file passed as argument searching for TODO Tags"""
-        if allowed_types.match(file):
-            try:
-                file_search = open(file, 'r')
-            except IOError:
-                sys.exit(2)
-
+        file_search = open(file, 'r')
+        try:
             data = file_search.read()
-            data = data.split('\n')
-
-            # Line Number
-            ln = 0
-            for line in data:
-                ln = ln + 1
-                a_match = known_marks.search(line)
-                if (a_match):
-                    pt, fl = os.path.split(file)
-                    labels[a_match.group(1)] += 1
-                    result = [file,fl,ln,a_match.group(1),a_match.group(2)]
-                    values.append(result)
-
-    # Search Directories for files matching
-    walktree(root, test_file)
-
-    html = '<div id="todo_list">\n'
-
-    # Make the Menu
-    menu = '<ul id="navigation">\n'
-    for label in labels:
-        total_marks += labels[label]
-        if configs['SHOW_EMPTY_MARKS'] == '1' or labels[label]:
-            menu += '   <li class="%s"><a href="#%s-title">%s</a>: %d</li>\n' % (label.lower(), label.lower(), label, labels[label])
-
-    menu += '<li class="total">Total: %d</li></ul>\n' % total_marks
-
-    table_pattern = Template(\
-    """\
-        <h2 id=\"${label}-title\">${labelU}</h2>
-        <table id="${label}">
-        <thead>
-            <tr>
-                <th class="file">File</th>
-                <th class="comment">Comment</th>
-            </tr>
-        </thead>
-        <tbody>
-    """
-    )
-
-    tables = {}
-
-    for label_ in known_marks_list:
-        tables[label_]= table_pattern.substitute(dict(label=label_.lower(),labelU=label_.upper()))
-
-    table_row_pattern = '        <tr class="%s"><td><a href="%s"  title="%s">%s</a> <span>(%s)</span></td><td>%s</td>\n'
-
-    def format_row(value_):
-        return table_row_pattern % (css, file_link(value_[0], value_[2]), value_[0], value_[1], value_[2], value_[4])
-
-    for ix, value in enumerate(sorted(values,key=operator.itemgetter(3))):
-        css = 'odd'
-        if ix % 2 == 0:
-            css = 'even'
-        for table_value in tables:
-            if value[3] == table_value:
-                tables[table_value] += format_row(value)
-
-    for table_value in tables:
-        tables[table_value] += '    </tbody></table>\n'
-
-    html += menu
-
-    for label in labels:
-        if labels[label]:
-            html += tables[label]
-
-    html += '   <a href="#todo_list" id="toplink">↑ top</a>\n  </div>'
-
-    todo_links_css_pattern = \
-    """
-        #${label}-title {
-            color: ${color};
-        }
-        li.${label} {
-            background: ${color};
-        }
-    """
-
-    todo_links_css = ''
-
-    color_rx = re.compile(r'^(.*)(#[0-9a-fA-F]{6})$')
-
-    todo_links_template = Template(todo_links_css_pattern)
-
-    for markcolor in configs['MARK_COLORS'].split(';'):
-        c_match = color_rx.search(markcolor)
-        if c_match:
-            mark,mcolor = c_match.group(1), c_match.group(2)
-            todo_links_css += todo_links_template.substitute(label=mark.lower(),color=mcolor)
-    # TODO: load this template pattern from a file.
-    html_pattern = \
+        finally:
+            file_search.close()
+
+        marks = []
+        # Line Number
+        ln = 1
+        pos = 0
+        for a_match in self.known_marks.finditer(data):
+            ln += data.count('\n', pos, a_match.start())
+            pos = a_match.start()
+            marks.append((ln, a_match.group(1), a_match.group(2).decode('utf-8', 'replace')))
+        return marks
+
+    def read_entry(self, file, previous):
+        '''returns the (mtime, size, marks) entry of file, reusing the
+           previous one when the file did not change'''
+        try:
+            st = os.stat(file)
+            entry = previous.get(file)
+            if entry is None or entry[:2] != (st.st_mtime, st.st_size):
+                entry = (st.st_mtime, st.st_size, self.read_marks(file))
+        except (IOError, OSError):
+            entry = None
+        return file, entry
+
+    def watches(self, file):
+        '''whether file is one of the files the scan parses'''
+        relative = os.path.relpath(file, self.root)
+        if relative.startswith(os.pardir + os.sep):
+            return False
+        top = self.root
+        for d in relative.split(os.sep)[:-1]:
+            top = os.path.join(top, d)
+            if self.skiped_dirs.match(top):
+                return False
+        return bool(self.allowed_types.match(file)) and not self.skiped_files.match(file)
+
+    def rescan_file(self, file):
+        '''reads the marks of a single file again, returns whether it is
+           one of the files of this scanner'''
+        if not self.watches(file):
+            return False
+        self.set_entry(file, self.read_entry(file, {})[1])
+        return True
+
+    def scan(self):
+        '''starts scanning the tree in the background unless already scanning'''
+        if self._thread is not None and self._thread.isAlive():
+            return
+        self.results = Queue.Queue()
+        self._thread = start_thread(self._scan, (dict(self.files), self.results))
+
+    def _scan(self, known, results):
+        previous = known or self._load_cache()
+        files = {}
+        pool = ThreadPool(SCAN_WORKERS)
+        try:
+            for file, entry in pool.imap_unordered(lambda file: self.read_entry(file, previous), self.walk()):
+                if entry is None:
+                    continue
+                files[file] = entry
+                if known.get(file) != entry:
+                    results.put((file, entry))
+        finally:
+            pool.close()
+            pool.join()
+        for file in known:
+            if file not in files:
+                results.put((file, None))
+        # Tells the main thread the scan is over
+        results.put((None, None))
+        try:
+            self._save_cache(files)
+        except (IOError, OSError):
+            pass
+
+    def _load_cache(self):
+        try:
+            cache = open(self.cache_path, 'rb')
+            try:
+                key, files = cPickle.load(cache)
+            finally:
+                cache.close()
+        except (IOError, EOFError, ValueError, TypeError, cPickle.UnpicklingError):
+            return {}
+        if key != self.cache_key:
+            return {}
+        return files
+
+    def _save_cache(self, files):
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        tmp_path = self.cache_path + '.tmp'
+        cache = open(tmp_path, 'wb')
+        try:
+            cPickle.dump((self.cache_key, files), cache, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            cache.close()
+        os.rename(tmp_path, self.cache_path)
+
+    def set_entry(self, file, entry):
+        '''replaces the marks of file, keeping the label counters in sync'''
+        old = self.files.pop(file, None)
+        if old is not None:
+            for ln, label, comment in old[2]:
+                self.labels[label] -= 1
+        if entry is not None:
+            self.files[file] = entry
+            for ln, label, comment in entry[2]:
+                self.labels[label] += 1
+
+    def pop_results(self):
+        '''applies the results the scanning threads queued so far, returns
+           the changed files and whether the scan is over'''
+        changed = []
+        while True:
+            try:
+                file, entry = self.results.get_nowait()
+            except Queue.Empty:
+                return changed, False
+            if file is None:
+                return changed, True
+            current = self.files.get(file)
+            if current is not None and entry is not None and current[0] > entry[0]:
+                # the file was saved and read again since the scan read it
+                continue
+            self.set_entry(file, entry)
+            changed.append(file)
+
+    def update_script(self, files):
+        '''javascript call that shows the current marks of files in the page'''
+        rows = []
+        for file in files:
+            entry = self.files.get(file)
+            marks = []
+            if entry is not None:
+                for ln, label, comment in entry[2]:
+                    marks.append((label.lower(), ln, escape(text(comment)), file_link(file, ln)))
+            rows.append((text(file), text(os.path.basename(file)), marks))
+        counts = dict((label.lower(), count) for label, count in self.labels.items())
+        return 'todo_update(%s, %s);' % (json.dumps(rows), json.dumps(counts))
+
+    def render_page(self):
+        '''the page the marks are added to as the scan goes on'''
+        configs = self.configs
+        html = '<div id="todo_list">\n'
+
+        # Make the Menu
+        menu = '<ul id="navigation">\n'
+        for label in self.known_marks_list:
+            menu += '   <li class="%s" id="%s-menu" style="display: none"><a href="#%s-title">%s</a>: <span id="%s-count">0</span></li>\n' % (label.lower(), label.lower(), label.lower(), label, label.lower())
+
+        menu += '<li class="total">Total: <span id="total-count">0</span></li></ul>\n'
+
+        table_pattern = Template(\
+        """\
+            <h2 id=\"${label}-title\" style="display: none">${labelU}</h2>
+            <table id="${label}" style="display: none">
+            <thead>
+                <tr>
+                    <th class="file">File</th>
+                    <th class="comment">Comment</th>
+                </tr>
+            </thead>
+            <tbody id="${label}-rows">
+            </tbody></table>
+        """
+        )
+
+        html += menu
+
+        for label_ in self.known_marks_list:
+            html += table_pattern.substitute(dict(label=label_.lower(),labelU=label_.upper()))
+
+        html += '   <a href="#todo_list" id="toplink">↑ top</a>\n  </div>'
+
+        todo_links_css_pattern = \
+        """
+            #${label}-title {
+                color: ${color};
+            }
+            li.${label} {
+                background: ${color};
+            }
+        """
+
+        todo_links_css = ''
+
+        color_rx = re.compile(r'^(.*)(#[0-9a-fA-F]{6})$')
+
+        todo_links_template = Template(todo_links_css_pattern)
+
+        for markcolor in configs['MARK_COLORS'].split(';'):
+            c_match = color_rx.search(markcolor)
+            if c_match:
+                mark,mcolor = c_match.group(1), c_match.group(2)
+                todo_links_css += todo_links_template.substitute(label=mark.lower(),color=mcolor)
+
+        markup = Template(html_pattern)
+
+        markup_out = markup.substitute(todo_header=todo_header(), \
+            todo_gears=todo_gears(),root=escape(self.root), html=html, \
+            labelcss=todo_links_css, \
+            show_empty=configs['SHOW_EMPTY_MARKS'] == '1' and 'true' or 'false')
+        return markup_out
+
+# TODO: load this template pattern from a file.
+html_pattern = \
     """
     <!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN"
         "http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">
@@ -360,6 +514,57 @@ def parse_directory(root):
         }
 
         </style>
+    <script type="text/javascript">
+    var show_empty_marks = ${show_empty};
+    var todo_rows = {};
+
+    // Replaces the rows of each [file, name, marks] entry
+    // and updates the counters of the labels
+    function todo_update(files, counts) {
+        for (var i = 0; i < files.length; i++) {
+            var file = files[i][0], marks = files[i][2];
+            var old = todo_rows[file] || [];
+            for (var j = 0; j < old.length; j++) {
+                old[j].parentNode.removeChild(old[j]);
+            }
+            var rows = [];
+            for (var j = 0; j < marks.length; j++) {
+                var row = document.createElement('tr');
+                var cell = document.createElement('td');
+                var link = document.createElement('a');
+                link.href = marks[j][3];
+                link.title = file;
+                link.appendChild(document.createTextNode(files[i][1]));
+                var line = document.createElement('span');
+                line.appendChild(document.createTextNode('(' + marks[j][1] + ')'));
+                cell.appendChild(link);
+                cell.appendChild(document.createTextNode(' '));
+                cell.appendChild(line);
+                row.appendChild(cell);
+                cell = document.createElement('td');
+                cell.innerHTML = marks[j][2];
+                row.appendChild(cell);
+                document.getElementById(marks[j][0] + '-rows').appendChild(row);
+                rows.push(row);
+            }
+            todo_rows[file] = rows;
+        }
+        var total = 0;
+        for (var label in counts) {
+            var count = counts[label];
+            total += count;
+            document.getElementById(label + '-count').innerHTML = count;
+            document.getElementById(label + '-menu').style.display = (count || show_empty_marks) ? '' : 'none';
+            document.getElementById(label + '-title').style.display = count ? '' : 'none';
+            document.getElementById(label).style.display = count ? '' : 'none';
+            var body_rows = document.getElementById(label + '-rows').rows;
+            for (var j = 0; j < body_rows.length; j++) {
+                body_rows[j].className = j % 2 ? 'odd' : 'even';
+            }
+        }
+        document.getElementById('total-count').innerHTML = total;
+    }
+    </script>
     </head>
     <body>
     <div id="container">
@@ -373,11 +578,3 @@ def parse_directory(root):
     </body>
     </html>
     """
-
-    markup = Template(html_pattern)
-
-    markup_out = markup.substitute(todo_header=todo_header(), \
-        todo_gears=todo_gears(),root=escape(root), html=html, \
-        labelcss=todo_links_css)
-    return markup_out
-
@@ -18,15 +18,20 @@
 
 import gedit
 import os
+import re
 import gconf
 
-from smart_indent import get_crop_spaces_eol, get_insert_newline_eof, get_remove_blanklines_eof
+from lib.lines import ModifiedLines
+from smart_indent import get_crop_spaces_eol, get_crop_modified_lines_only, get_insert_newline_eof, get_remove_blanklines_eof
 
 
 class SaveWithoutTrailingSpacePlugin(gedit.Plugin):
 
     """Automatically strip all trailing whitespace before saving."""
 
+    # Spaces and tabs before a line break or the end of the document
+    trailing_space = re.compile(ur"(?<![ \t])[ \t]+(?=[\r\n\u2029]|\Z)")
+
     def activate(self, window):
         """Activate plugin."""
 
@@ -37,10 +42,16 @@ class SaveWithoutTrailingSpacePlugin(gedit.Plugin):
 
 
     def connect_document(self, doc):
-        """Connect to document's 'saving' signal."""
+        """Connect to document's 'saving' signal and track modified lines."""
 
-        handler_id = doc.connect("saving", self.on_document_saving)
-        doc.set_data(self.__class__.__name__, handler_id)
+        lines = ModifiedLines()
+        handler_ids = (doc.connect("saving", self.on_document_saving),
+                       doc.connect("insert-text", lines.on_insert_text),
+                       doc.connect("delete-range", lines.on_delete_range),
+                       doc.connect("saved", lines.on_saved_or_loaded),
+                       doc.connect("loaded", lines.on_saved_or_loaded))
+        doc.set_data(self.__class__.__name__, handler_ids)
+        doc.set_data(ModifiedLines.__name__, lines)
 
 
     def deactivate(self, window):
@@ -51,9 +62,10 @@ class SaveWithoutTrailingSpacePlugin(gedit.Plugin):
         window.disconnect(handler_id)
         window.set_data(name, None)
         for doc in window.get_documents():
-            handler_id = doc.get_data(name)
-            doc.disconnect(handler_id)
+            for handler_id in doc.get_data(name):
+                doc.disconnect(handler_id)
             doc.set_data(name, None)
+            doc.set_data(ModifiedLines.__name__, None)
 
 
     def on_document_saving(self, doc, *args):
@@ -78,8 +90,8 @@ class SaveWithoutTrailingSpacePlugin(gedit.Plugin):
 
         name = self.__class__.__name__
         doc = tab.get_document()
-        handler_id = doc.get_data(name)
-        if handler_id is None:
+        handler_ids = doc.get_data(name)
+        if handler_ids is None:
             self.connect_document(doc)
 
 
@@ -117,14 +129,27 @@ class SaveWithoutTrailingSpacePlugin(gedit.Plugin):
         """Delete trailing space at the end of each line."""
         lng = self.get_language_id(doc)
         if get_crop_spaces_eol(lng):
-            buffer_end = doc.get_end_iter()
-            for line in range(buffer_end.get_line() + 1):
-                line_end = doc.get_iter_at_line(line)
-                line_end.forward_to_line_end()
-                itr = line_end.copy()
-                while itr.backward_char():
-                    if not itr.get_char() in (" ", "\t"):
-                        itr.forward_char()
-                        break
-                doc.delete(itr, line_end)
-
+            line_count = doc.get_line_count()
+            lines = [(0, line_count)]
+            if get_crop_modified_lines_only(lng):
+                lines = doc.get_data(ModifiedLines.__name__).ranges
+            spans = []
+            for first, last in lines:
+                last = min(last, line_count)
+                if first >= last:
+                    continue
+                start = doc.get_iter_at_line(first)
+                end = doc.get_iter_at_line(last - 1)
+                if not end.ends_line():
+                    end.forward_to_line_end()
+                base = start.get_offset()
+                text = unicode(doc.get_text(start, end), "utf-8")
+                for match in self.trailing_space.finditer(text):
+                    spans.append((base + match.start(), base + match.end()))
+            if not spans:
+                return
+            # Delete from the end backwards so the offsets left stay valid
+            doc.begin_user_action()
+            for start, end in reversed(spans):
+                doc.delete(doc.get_iter_at_offset(start), doc.get_iter_at_offset(end))
+            doc.end_user_action()
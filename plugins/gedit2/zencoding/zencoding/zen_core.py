@@ -35,6 +35,10 @@ caret_placeholder = '{%::zen-caret::%}'
 
 default_tag = 'div'
 
+re_tabstop = re.compile(r'\$(\d+)|\$\{(\d+):[^\}]+\}')
+
+re_escaped = re.compile(r'\\(.)')
+
 re_tag = re.compile(r'<\/?[\w:\-]+(?:\s+[\w\-:]+(?:\s*=\s*(?:(?:"[^"]*")|(?:\'[^\']*\')|[^>\s]+))?)*\s*(\/?)>$')
 
 profiles = {}
@@ -63,6 +67,21 @@ basic_filters = 'html';
 max_tabstop = 0
 "Maximum tabstop index for current session"
 
+resource_map = {}
+"First resource found through the inheritance chain, by syntax and name"
+
+merged_resource_map = {}
+"Dictionary resources merged along the inheritance chain, by syntax and name"
+
+parsed_trees = {}
+"Recently parsed abbreviation trees, see get_parsed_tree()"
+
+parsed_trees_order = []
+"Keys of parsed_trees, least recently used first"
+
+max_parsed_trees = 100
+"How many parsed trees are kept"
+
 def char_at(text, pos):
 	"""
 	Returns character at specified index of text.
@@ -309,6 +328,36 @@ def create_resource_chain(syntax, name):
 				
 	return result
 
+def build_resource_maps():
+	"""
+	Resolves the inheritance chain of every resource of every syntax once, 
+	so that lookups don't have to walk it for each element
+	"""
+	resource_map.clear()
+	merged_resource_map.clear()
+	
+	for syntax, resource in zen_settings.items():
+		if not isinstance(resource, dict):
+			continue
+		
+		names = set(resource)
+		for type in resource.get('extends', []):
+			if isinstance(zen_settings.get(type), dict):
+				names.update(zen_settings[type])
+		
+		resource_map[syntax] = first = {}
+		merged_resource_map[syntax] = merged = {}
+		for name in names:
+			chain = create_resource_chain(syntax, name)
+			if not chain:
+				continue
+			first[name] = chain[0]
+			# resources earlier in the chain take precedence
+			merged[name] = {}
+			for item in reversed(chain):
+				if isinstance(item, dict):
+					merged[name].update(item)
+
 def get_resource(syntax, name):
 	"""
 	Get resource collection from settings file for specified syntax. 
@@ -319,8 +368,7 @@ def get_resource(syntax, name):
 	@param name: Resource name
 	@type name: str
 	"""
-	chain = create_resource_chain(syntax, name)
-	return chain[0] if chain else None
+	return resource_map.get(syntax, {}).get(name)
 
 def get_settings_resource(syntax, abbr, name):
 	"""
@@ -333,11 +381,7 @@ def get_settings_resource(syntax, abbr, name):
 	@type name: str
 	@return dict, None
 	"""
-	for item in create_resource_chain(syntax, name):
-		if abbr in item:
-			return item[abbr]
-		
-	return None
+	return merged_resource_map.get(syntax, {}).get(name, {}).get(abbr)
 
 def get_word(ix, text):
 	"""
@@ -561,14 +605,21 @@ def rollout_tree(tree, parent=None):
 		else:
 			tag_content = child.get_content()
 		
+		template = None
 		for j in range(how_many):
-			tag = ZenNode(child)
+			if template is None:
+				tag = ZenNode(child)
+				if child.children:
+					rollout_tree(child, tag)
+				template = tag
+			else:
+				# repeated elements only differ by counter and content, 
+				# copy the first one instead of rolling out its subtree again
+				tag = template.clone()
+				
 			parent.add_child(tag)
 			tag.counter = j + 1
 			
-			if child.children:
-				rollout_tree(child, tag)
-				
 			add_point = tag.find_deepest_child() or tag
 			
 			if tag_content:
@@ -783,7 +834,7 @@ def expand_abbreviation(abbr, syntax='html', profile_name='plain'):
 	@type abbr: str
 	@return: str
 	"""
-	tree_root = parse_into_tree(abbr, syntax);
+	tree_root = get_parsed_tree(abbr, syntax, profile_name)
 	if tree_root:
 		tree = rollout_tree(tree_root)
 		apply_filters(tree, syntax, profile_name, tree_root.filters)
@@ -860,6 +911,37 @@ def parse_into_tree(abbr, doc_type='html'):
 	tree_root.filters = ''.join(filter_list)
 	return tree_root
 
+def get_parsed_tree(abbr, doc_type='html', profile_name='plain'):
+	"""
+	Same as <code>parse_into_tree()</code>, but keeps the most recently 
+	used trees. The returned tree is shared, so it must not be modified
+	@param abbr: Abbreviation to transform
+	@type abbr: str
+	@param doc_type: Document type (xsl, html)
+	@type doc_type: str
+	@param profile_name: Output profile's name
+	@type profile_name: str
+	@return: Tag
+	"""
+	if callable(caret_placeholder):
+		# placeholders may differ on each call, like tabstops
+		return parse_into_tree(abbr, doc_type)
+	
+	key = (abbr, doc_type, profile_name, caret_placeholder)
+	if key in parsed_trees:
+		parsed_trees_order.remove(key)
+	else:
+		tree_root = parse_into_tree(abbr, doc_type)
+		if not tree_root:
+			return None
+		
+		parsed_trees[key] = tree_root
+		if len(parsed_trees_order) >= max_parsed_trees:
+			del parsed_trees[parsed_trees_order.pop(0)]
+			
+	parsed_trees_order.append(key)
+	return parsed_trees[key]
+
 def is_inside_tag(html, cursor_pos):
 	re_tag = re.compile(r'^<\/?\w[\w\:\-]*.*?>')
 	
@@ -997,7 +1079,7 @@ def upgrade_tabstops(node):
 		return re.sub(r'\d+', str(num + max_tabstop), m.group(0), 1)
 	
 	for prop in props:
-		node.__setattr__(prop, re.sub(r'\$(\d+)|\$\{(\d+):[^\}]+\}', _replace, node.__getattribute__(prop)))
+		node.__setattr__(prop, re_tabstop.sub(_replace, node.__getattribute__(prop)))
 		
 	globals()['max_tabstop'] += max_num[0]
 		
@@ -1009,7 +1091,7 @@ def unescape_text(text):
 	@type text: str
 	@return: str
 	"""
-	return re.sub(r'\\(.)', r'\1', text)
+	return re_escaped.sub(r'\1', text)
 
 def get_profile(name):
 	"""
@@ -1019,6 +1101,9 @@ def get_profile(name):
 
 def update_settings(settings):
 	globals()['zen_settings'] = settings
+	build_resource_maps()
+	parsed_trees.clear()
+	del parsed_trees_order[:]
 	
 class Tag(object):
 	def __init__(self, name, count=1, doc_type='html'):
@@ -1261,6 +1346,20 @@ class ZenNode(object):
 		
 		return deepest_child
 	
+	def clone(self):
+		"""
+		Creates a copy of current node and its children, which still share 
+		their source elements
+		@return: ZenNode
+		"""
+		node = ZenNode(self.source)
+		node.counter = self.counter
+		node.content = self.content
+		for item in self.children:
+			node.add_child(item.clone())
+			
+		return node
+	
 	def to_string(self):
 		"@return {String}"
 		content = ''.join([item.to_string() for item in self.children])
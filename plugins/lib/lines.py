@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+    Line ranges of a document kept up to date through its edits.
+
+    LineRanges holds a set of lines as a sorted list of disjoint
+    [start, end) ranges, which are moved along as lines are inserted or
+    deleted above them, so no per-line state has to live in the buffer.
+    ModifiedLines connects it to a document to track the lines modified
+    since the document was last saved or loaded.
+"""
+import re
+
+
+# The line breaks of GtkTextBuffer
+LINE_BREAK_RE = re.compile("\r\n|\r|\n|\xe2\x80\xa9")
+
+
+class LineRanges(object):
+    """A set of lines as sorted, disjoint [start, end) ranges."""
+
+    def __init__(self):
+        self.ranges = []
+
+    def clear(self):
+        self.ranges = []
+
+    def normalize(self, ranges):
+        """Sorts ranges and merges the overlapping or adjacent ones."""
+        ranges.sort()
+        merged = []
+        for start, end in ranges:
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        self.ranges = merged
+
+    def add(self, first, last):
+        """Adds the lines first..last."""
+        if first > last:
+            return
+        self.normalize(self.ranges + [[first, last + 1]])
+
+    def insert_lines(self, line, count):
+        """Moves the lines along count new lines inserted by splitting line."""
+        if not count:
+            return
+        for r in self.ranges:
+            if r[0] > line:
+                r[0] += count
+                r[1] += count
+            elif r[1] > line:
+                r[1] += count
+
+    def delete_lines(self, line, count):
+        """Moves the lines along the count lines after line joined into it."""
+        if not count:
+            return
+
+        def move(x):
+            if x <= line:
+                return x
+            if x <= line + count:
+                return line
+            return x - count
+
+        self.normalize([[move(start), move(end - 1) + 1] for start, end in self.ranges])
+
+    def lines_in(self, first, last):
+        """Yields the lines among first..last."""
+        for start, end in self.ranges:
+            if end <= first:
+                continue
+            if start > last:
+                break
+            for line in xrange(max(start, first), min(end, last + 1)):
+                yield line
+
+
+class ModifiedLines(LineRanges):
+    """
+        The lines of a document modified since it was last saved, kept by
+        connecting the handlers below to its signals: on_insert_text to
+        'insert-text' and on_delete_range to 'delete-range', both before the
+        default handler, and on_saved_or_loaded to 'saved' and 'loaded'.
+    """
+
+    def on_insert_text(self, doc, itr, text, length):
+        """Adds the lines of the inserted text and moves the ones below."""
+        line = itr.get_line()
+        count = len(LINE_BREAK_RE.findall(text))
+        self.insert_lines(line, count)
+        self.add(line, line + count)
+
+    def on_delete_range(self, doc, start, end):
+        """Adds the line joined by the deletion and moves the ones below."""
+        line = start.get_line()
+        self.delete_lines(line, end.get_line() - line)
+        self.add(line, line)
+
+    def on_saved_or_loaded(self, doc, error):
+        """The document matches its file again."""
+        if not error:
+            self.clear()
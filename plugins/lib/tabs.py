@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+    Tab helpers shared by the plugins restoring documents.
+
+    A tab restored lazily is an empty placeholder document holding the uri
+    it loads once it is activated, which the plugins do by calling
+    load_pending_tab from their 'active-tab-changed' handler. All of them
+    use the same document data, so a placeholder is loaded once whichever
+    plugin created it.
+
+    gedit labels a placeholder as an unsaved document. label_pending_tab
+    shows the name of the file the tab will load instead. gedit sets the
+    label again when the name of the document changes, which it does once
+    it is loaded.
+"""
+import os
+import sys
+import urllib
+
+import gedit
+import gtk
+
+
+# Document data holding the uri a placeholder tab loads once activated
+PENDING_URI = "GmatePendingUri"
+
+
+def _find_label(widget):
+    if isinstance(widget, gtk.Label):
+        return widget
+    if isinstance(widget, gtk.Container):
+        for child in widget.get_children():
+            label = _find_label(child)
+            if label is not None:
+                return label
+    return None
+
+
+def label_pending_tab(tab, uri):
+    """Labels tab, which will load uri once activated, with the file name."""
+    notebook = tab.get_parent()
+    if notebook is None:
+        return
+    tab_label = notebook.get_tab_label(tab)
+    label = _find_label(tab_label)
+    if label is None:
+        return
+    path = urllib.url2pathname(uri[7:]) if uri.startswith('file://') else uri
+    name = os.path.basename(path).decode(sys.getfilesystemencoding() or 'utf-8', 'replace')
+    label.set_text(name.encode('utf-8'))
+    tab_label.set_tooltip_text(path.decode(sys.getfilesystemencoding() or 'utf-8', 'replace').encode('utf-8'))
+
+
+def create_pending_tab(window, uri):
+    """Adds a placeholder tab to window which loads uri once activated."""
+    tab = window.create_tab(False)
+    tab.get_document().set_data(PENDING_URI, uri)
+    label_pending_tab(tab, uri)
+    return tab
+
+
+def document_uri(doc):
+    """Returns the uri of doc, or the one it loads if it is a placeholder."""
+    return doc.get_uri() or doc.get_data(PENDING_URI)
+
+
+def load_pending_tab(tab, encoding=None):
+    """Loads the document of tab if it is a placeholder."""
+    if tab is None:
+        return
+    doc = tab.get_document()
+    uri = doc.get_data(PENDING_URI)
+    if uri:
+        doc.set_data(PENDING_URI, None)
+        doc.load(uri, encoding or gedit.encoding_get_current(), 0, False)
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""
+    Background threads for the plugins.
+
+    Python threads only run while gtk's main loop is idle once
+    gobject.threads_init has been called. start_thread calls it before the
+    first thread is started, so gedit only pays for it once a plugin
+    actually works in the background.
+"""
+import threading
+
+import gobject
+
+
+_initialized = False
+
+
+def start_thread(target, args=(), daemon=True):
+    """Starts and returns a thread running target(*args)."""
+    global _initialized
+    if not _initialized:
+        gobject.threads_init()
+        _initialized = True
+    thread = threading.Thread(target=target, args=args)
+    thread.setDaemon(daemon)
+    thread.start()
+    return thread
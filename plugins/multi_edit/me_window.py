@@ -66,7 +66,6 @@ class WindowInstance:
             
             # Event trackers
             self._mouse_event = {'current':False, 'followup':False}
-            self._change_supported = False
             self._cursor_move_supported = [False, False]  # [insert, selection_bound]
     
     def _destroy_settings(self):
@@ -121,11 +120,8 @@ class WindowInstance:
         return False
     
     def _text_changed(self, *args):
-        """ Check text changes and exit multi-edit mode if unsupported. """
-        if self._change_supported:
-            self._change_supported = False
-        else:
-            self._clear_marks()
+        """ Exit multi-edit mode on changes not made by the plugin itself. """
+        self._clear_marks()
         return False
     
     def _mouse_handler(self, event, type_):
@@ -351,36 +347,64 @@ class WindowInstance:
     
     # ============================================================ Text modifiers
     
-    def _single_edit(self, start, insert, value,  start_is_iter=False):
-        """ Insert or delete text at the given position.
+    def _insert_edit(self, mark, value):
+        """ Return the edit inserting "value" at a mark. """
+        offset = self._buffer.get_iter_at_mark(mark).get_offset()
+        return (offset, offset, str(value))
+    
+    def _delete_edit(self, start, length):
+        """ Return the edit deleting "length" cursor positions from the iter "start".
+        
+        length: +: forward deletion, -: backward deletion
+        """
+        end = start.copy()
+        if length > 0:
+            end.forward_cursor_positions(length)
+        else:
+            start = start.copy()
+            start.forward_cursor_positions(length)
+        return (start.get_offset(), end.get_offset(), '')
+    
+    def _apply_edits(self, edits):
+        """ Apply a batch of edits to the buffer.
         
         Important: Multi-edit text modifications must never occur anywhere but here.
                    And only "_multi_edit" may call this function.
         
-        Arguments:
-            start: A mark or iter (depending on "start_is_iter")
-            insert: True for insert, False for delete
-            value: String for insert, length for delete (+: forward deletion, -: backward deletion)
+        Each edit is a (start offset, end offset, text) tuple, with all the offsets
+        taken before any edit is made. The edits are applied back to front, so the
+        offsets of the ones left stay valid, with the change handlers blocked
+        since every change made here is supported. Deletions overlapping an edit
+        already applied are cut short.
         """
-        self._change_supported = True
-        if not start_is_iter:
-            start = self._buffer.get_iter_at_mark(start)
-        if insert:
-            self._buffer.insert_interactive(start, str(value), True)
-        else:
-            end = start.copy()
-            if value > 0:
-                end.forward_cursor_positions(value)
-            else:
-                start.forward_cursor_positions(value)
-            self._buffer.delete_interactive(start, end, True)
-            self._cleanup_marks()
+        self._buffer.handler_block(self._text_change)
+        self._buffer.handler_block(self._mark_move)
+        try:
+            limit = None
+            for start, end, text in sorted(edits, reverse=True):
+                if limit is not None and end > limit:
+                    end = limit
+                    if start >= end and not text:
+                        continue
+                start_iter = self._buffer.get_iter_at_offset(start)
+                if end > start:
+                    end_iter = self._buffer.get_iter_at_offset(end)
+                    self._buffer.delete_interactive(start_iter, end_iter, True)
+                if text:
+                    self._buffer.insert_interactive(start_iter, text, True)
+                limit = start
+        finally:
+            self._buffer.handler_unblock(self._mark_move)
+            self._buffer.handler_unblock(self._text_change)
     
     def _multi_edit(self, mode, value=None):
         """ Make mode dependant text modifications at all multi-edit marks.
         
         "value" is mode dependant.
         
+        The edits at all marks are worked out first, from the text as it is, and
+        then applied together as one user action.
+        
         Modes:
             insert: normal text insertion
             delete: normal (backward or forward) text deletion
@@ -388,23 +412,23 @@ class WindowInstance:
             tab: emulate gedit (indent)
             shift_tab: emulate gedit (preceding indentation deletion for lines)
         """
-        self._buffer.begin_user_action()
+        edits = []
         
         if mode == 'insert':
             # value = string
             for mark in self._marks:
-                self._single_edit(mark, True, value)
+                edits.append(self._insert_edit(mark, value))
         
         elif mode == 'delete':
             # value = length
             for mark in self._marks:
-                self._single_edit(mark, False, value)
+                edits.append(self._delete_edit(self._buffer.get_iter_at_mark(mark), value))
         
         elif mode == 'increment' and len(value) != 0:
             # value = list
             i = 0
             for mark in self._marks:
-                self._single_edit(mark, True, value[i])
+                edits.append(self._insert_edit(mark, value[i]))
                 i += 1
                 if not i < len(value):
                     i = 0
@@ -412,10 +436,20 @@ class WindowInstance:
         elif mode == 'space_tab':
             # value = not used
             tab_width = self._view.get_tab_width()
-            for mark in self._marks:
-                offset = self._get_physical_line_offset(mark)
-                tab_string = ' ' * (tab_width - (offset % tab_width))
-                self._single_edit(mark, True, tab_string)
+            # {line: [(line_offset, tab_string)]}, spaces inserted before the next marks of a line
+            inserted = {}
+            marks = [(self._buffer.get_iter_at_mark(mark).get_offset(), mark) for mark in self._marks]
+            for offset, mark in sorted(marks):
+                pos = self._buffer.get_iter_at_mark(mark)
+                line_start = pos.copy()
+                line_start.set_line_offset(0)
+                text = unicode(line_start.get_slice(pos), 'utf-8')
+                line_inserted = inserted.setdefault(pos.get_line(), [])
+                for line_offset, tab_string in reversed(line_inserted):
+                    text = text[:line_offset] + tab_string + text[line_offset:]
+                tab_string = ' ' * (tab_width - (self._get_physical_width(text) % tab_width))
+                line_inserted.append((pos.get_line_offset(), tab_string))
+                edits.append((offset, offset, tab_string))
         
         elif mode == 'left_tab':
             # value not used
@@ -434,7 +468,7 @@ class WindowInstance:
                     pos.forward_char()
                     i += 1
                 pos.set_line_offset(0)
-                self._single_edit(pos, False, i, True)
+                edits.append(self._delete_edit(pos, i))
         
         elif mode == 'indent_nl':
             # value not used
@@ -449,7 +483,7 @@ class WindowInstance:
                     else:
                         break
                     i.forward_char()
-                self._single_edit(mark, True, indent_str)
+                edits.append(self._insert_edit(mark, indent_str))
         
         elif mode == 'level':
             # value not used
@@ -504,7 +538,7 @@ class WindowInstance:
                                 insert += '\t'
                         else:
                             insert = ' ' * dif
-                        self._single_edit(lines[line][column][0], True, insert)
+                        edits.append(self._insert_edit(lines[line][column][0], insert))
                         # Update succeeding offets in same line
                         for i in range(len(lines[line]) - next_column):
                             lines[line][next_column + i][1] += dif
@@ -513,7 +547,16 @@ class WindowInstance:
                       lines[line][next_column][1] > max_offsets[next_column]:
                         max_offsets[next_column] = lines[line][next_column][1]
         
+        if len(edits) == 0:
+            return
+        
+        self._buffer.begin_user_action()
+        self._apply_edits(edits)
         self._buffer.end_user_action()
+        
+        # Deletions may have collapsed marks
+        if mode in ('delete', 'left_tab'):
+            self._cleanup_marks()
     
     def _get_physical_line_offset(self, mark):
         """ Get the physical line offset of a mark.
@@ -525,14 +568,17 @@ class WindowInstance:
         pos = self._buffer.get_iter_at_mark(mark)
         i = pos.copy()
         i.set_line_offset(0)
+        return self._get_physical_width(unicode(i.get_slice(pos), 'utf-8'))
+    
+    def _get_physical_width(self, text):
+        """ Get the physical width of the text at the start of a line. """
         offset = 0
         tab_width = self._view.get_tab_width()
-        while not i.equal(pos):
-            if i.get_char() == '\t':
+        for char in text:
+            if char == '\t':
                 offset += tab_width - (offset % tab_width)
             else:
                 offset += 1
-            i.forward_char()
         return offset
     
     def _get_logical_line_offset(self, pos, phy_offset):
@@ -790,14 +836,16 @@ class WindowInstance:
     
     def _cleanup_marks(self):
         """ Remove any duplicate marks caused by text deletion. """
-        offsets = []
-        for mark in self._marks[:]:
+        offsets = set()
+        marks = []
+        for mark in self._marks:
             offset = self._buffer.get_iter_at_mark(mark).get_offset()
             if offset in offsets:
                 self._buffer.delete_mark(mark)
-                self._marks.remove(mark)
             else:
-                offsets.append(offset)
+                offsets.add(offset)
+                marks.append(mark)
+        self._marks = marks
     
     def _clear_marks(self):
         """ Exit multi-edit mode by removing any marks. """
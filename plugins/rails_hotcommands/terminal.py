@@ -28,6 +28,8 @@ from vte import Terminal
 import gconf
 import gnomevfs
 
+from lib.roots import rails_root
+
 class TerminaldWidget():
     def __init__(self, window):
         self.window = window
@@ -102,20 +104,7 @@ class TerminaldWidget():
         self.close_bt_action()
 
     def get_rails_root(self, uri):
-        base_dir = os.path.dirname(uri)
-        depth = 10
-        rails_root = ''
-
-        while depth > 0:
-            depth -= 1
-            app_dir = os.path.join(base_dir, 'app')
-            config_dir = os.path.join(base_dir, 'config')
-            if os.path.isdir(app_dir) and os.path.isdir(config_dir):
-                rails_root = base_dir
-                break
-            else:
-                base_dir = os.path.abspath(os.path.join(base_dir, '..'))
-        return rails_root
+        return rails_root(uri) or ''
 
 
     # FileBrowser Integration
@@ -24,6 +24,13 @@ import re
 import webbrowser
 from time import sleep
 
+from lib.roots import rails_roots
+
+try:
+    import gio
+except ImportError:
+    gio = None
+
 def debug(text, level=1):
     if os.environ.has_key('RH_DEBUG'):
         try:
@@ -34,6 +41,214 @@ def debug(text, level=1):
         except:
             print "[rails_mode] debug error"
 
+# Inflection rules, the last matching one wins
+PLURALS = [
+    ('$', 's'),
+    ('s$', 's'),
+    ('(ax|test)is$', '\\1es'),
+    ('(octop|vir)us$', '\\1i'),
+    ('(alias|status)$', '\\1es'),
+    ('(bu)s$', '\\1ses'),
+    ('(buffal|tomat)o$', '\\1oes'),
+    ('([ti])um$', '\\1a'),
+    ('sis$', 'ses'),
+    ('(?:([^f])fe|([lr])f)$', '\\1\\2ves'),
+    ('(hive)$', '\\1s'),
+    ('([^aeiouy]|qu)y$', '\\1ies'),
+    ('([^aeiouy]|qu)ies$', '\\1y'),
+    ('(x|ch|ss|sh)$', '\\1es'),
+    ('(matr|vert|ind)ix|ex$', '\\1ices'),
+    ('([m|l])ouse$', '\\1ice'),
+    ('^(ox)$', '\\1en'),
+    ('(quiz)$', '\\1zes'),
+    ('^person$', 'people'),
+    ('^man$', 'men'),
+    ('^child$', 'children'),
+    ('^sex$', 'sexes'),
+    ('^move$', 'moves'),
+    ('^(deer|fish|sheep|species)$', '\\1')
+]
+
+SINGULARS = [
+    ('s$', ''),
+    ('(n)ews$', '\\1ews'),
+    ('([ti])a$', '\\1um'),
+    ('((a)naly|(b)a|(d)iagno|(p)arenthe|(p)rogno|(s)ynop|(t)he)ses$', '\\1\\2sis'),
+    ('(^analy)ses$', '\\1sis'),
+    ('([^f])ves$', '\\1fe'),
+    ('(hive)s$', '\\1'),
+    ('(tive)s$', '\\1'),
+    ('([lr])ves$', '\\1f'),
+    ('([^aeiouy]|qu)ies$', '\\1y'),
+    ('(s)eries$', '\\1eries'),
+    ('(m)ovies$', '\\1ovie'),
+    ('(x|ch|ss|sh)es$', '\\1'),
+    ('([m|l])ice$', '\\1ouse'),
+    ('(bus)es$', '\\1'),
+    ('(o)es$', '\\1'),
+    ('(shoe)s$', '\\1'),
+    ('(cris|ax|test)es$', '\\1is'),
+    ('([octop|vir])i$', '\\1us'),
+    ('(alias|status)es$', '\\1'),
+    ('^(ox)en', '\\1'),
+    ('(vert|ind)ices$', '\\1ex'),
+    ('(matr)ices$', '\\1ix'),
+    ('(quiz)zes$', '\\1'),
+    ('^people$', 'person'),
+    ('^men$', 'man'),
+    ('^children$', 'child'),
+    ('^sexes$', 'sex'),
+    ('^moves$', 'move'),
+    ('^(deer|fish|sheep|species)$', '\\1')
+]
+
+def compile_rules(rules):
+    rules = [(re.compile(re_from), re_to) for re_from, re_to in rules]
+    rules.reverse()
+    return rules
+
+PLURAL_RULES = compile_rules(PLURALS)
+SINGULAR_RULES = compile_rules(SINGULARS)
+
+plural_cache = {}
+singular_cache = {}
+
+def inflect(text, rules, cache):
+    result = cache.get(text)
+    if result is None:
+        result = text
+        for re_from, re_to in rules:
+            if re_from.search(text):
+                result = re_from.sub(re_to, text)
+                break
+        cache[text] = result
+    return result
+
+def pluralize(text):
+    return inflect(text, PLURAL_RULES, plural_cache)
+
+def singularize(text):
+    return inflect(text, SINGULAR_RULES, singular_cache)
+
+
+# Files related to a resource: kind -> (directory, file suffix, plural name)
+RESOURCE_FILES = {
+    'model':            (('app', 'models'), '.rb', False),
+    'controller':       (('app', 'controllers'), '_controller.rb', True),
+    'helper':           (('app', 'helpers'), '_helper.rb', True),
+    'unit':             (('test', 'unit'), '_test.rb', False),
+    'functional':       (('test', 'functional'), '_controller_test.rb', True),
+    'integration':      (('test', 'integration'), '_test.rb', True),
+    'fixtures':         (('test', 'fixtures'), '.yml', True),
+    'model_spec':       (('spec', 'models'), '_spec.rb', False),
+    'controller_spec':  (('spec', 'controllers'), '_controller_spec.rb', True),
+    'helper_spec':      (('spec', 'helpers'), '_helper_spec.rb', True),
+}
+
+# Directory holding a folder of views per resource
+VIEWS_DIR = ('app', 'views')
+
+
+class RailsIndex(object):
+    """
+        Files of a Rails application by resource (singular name) and kind.
+
+        The index is built on the first lookup. The directories it is built
+        from are watched, and the index is rebuilt on the next lookup once
+        any of them changed.
+    """
+
+    _instances = {}
+
+    def __init__(self, root):
+        self.root = root
+        self.resources = None
+        self._monitors = []
+        self._watch()
+
+    @classmethod
+    def get(cls, root):
+        index = cls._instances.get(root)
+        if index is None:
+            index = cls._instances[root] = cls(root)
+        return index
+
+    def lookup(self, kind, name):
+        """Returns the path of a kind of file of resource name or None."""
+        if self.resources is None:
+            self.build()
+        return self.resources.get(singularize(name), {}).get(kind)
+
+    def build(self):
+        debug('indexing %s' % self.root)
+        resources = {}
+        for kind, (parts, suffix, plural) in RESOURCE_FILES.iteritems():
+            directory = os.path.join(self.root, *parts)
+            for filename in self._listdir(directory):
+                if not filename.endswith(suffix):
+                    continue
+                name = filename[:-len(suffix)]
+                if plural:
+                    name = singularize(name)
+                resources.setdefault(name, {})[kind] = os.path.join(directory, filename)
+        directory = os.path.join(self.root, *VIEWS_DIR)
+        for filename in self._listdir(directory):
+            path = os.path.join(directory, filename)
+            if os.path.isdir(path):
+                resources.setdefault(singularize(filename), {})['views'] = path
+        self.resources = resources
+
+    def _listdir(self, directory):
+        try:
+            return os.listdir(directory)
+        except OSError:
+            return []
+
+    def _watch(self):
+        if gio is None:
+            return
+        directories = [parts for parts, suffix, plural in RESOURCE_FILES.itervalues()]
+        directories += [VIEWS_DIR, ('app',), ('test',), ('spec',)]
+        for parts in set(directories):
+            try:
+                monitor = gio.File(os.path.join(self.root, *parts)).monitor_directory()
+            except gio.Error:
+                continue
+            monitor.connect('changed', self.on_changed)
+            self._monitors.append(monitor)
+
+    def on_changed(self, monitor, file, other_file, event_type):
+        if event_type in (gio.FILE_MONITOR_EVENT_CREATED, gio.FILE_MONITOR_EVENT_DELETED):
+            self.resources = None
+
+
+# Rails mode commands by key
+KEY_TYPES = {
+    gtk.keysyms.a: 'application',
+    gtk.keysyms.b: 'rails',
+    gtk.keysyms.c: 'controller',
+    gtk.keysyms.d: 'database',
+    gtk.keysyms.e: 'environment',
+    gtk.keysyms.f: 'functional',
+    gtk.keysyms.h: 'helper',
+    gtk.keysyms.i: 'integration',
+    gtk.keysyms.j: 'fixtures',
+    gtk.keysyms.l: 'layout',
+    gtk.keysyms.m: 'model',
+    gtk.keysyms.n: 'navigate',
+    gtk.keysyms.p: 'public',
+    gtk.keysyms.F1: 'help',
+    gtk.keysyms.r: 'routes',
+    gtk.keysyms.t: 'tests',
+    gtk.keysyms.u: 'unit',
+    gtk.keysyms.v: 'views',
+}
+for keyval, type in KEY_TYPES.items():
+    KEY_TYPES[gtk.gdk.keyval_to_upper(keyval)] = type
+
+RESOURCE_NAME_RE = re.compile('(_controller|_test|_controller_test)?\.(rb|yml)$')
+VIEW_PATH_RE = re.compile('\/app\/views\/')
+
 class RailsHotkeysPlugin(gedit.Plugin):
     def __init__(self):
         gedit.Plugin.__init__(self)
@@ -113,135 +328,23 @@ class RailsHotkeysWindowHelper:
         os.system('gedit %s' % uri)
 
     def get_rails_root(self, uri):
-        rails_root = self.get_data('RailsModeRoot')
-
-        if rails_root:
-            debug('returning previously defined rails_root')
-            return rails_root
-
-        base_dir = os.path.dirname(uri)
-        depth = 10
-
-        while depth > 0:
-            depth -= 1
-            app_dir = os.path.join(base_dir, 'app')
-            config_dir = os.path.join(base_dir, 'config')
-            debug('base_dir: %s' % base_dir)
-            if os.path.isdir(app_dir) and os.path.isdir(config_dir):
-                rails_root = base_dir
-                break
-            else:
-                base_dir = os.path.abspath(os.path.join(base_dir, '..'))
+        rails_root = rails_roots.find(uri)
 
-        if rails_root:
-            self.set_data('RailsModeRoot', rails_root)
-
-        debug('setting rails_root to %s' % rails_root)
+        debug('rails_root of %s is %s' % (uri, rails_root))
 
         return rails_root
 
     def pluralize(self, text):
-        plurals = [
-            ('$', 's'),
-            ('s$', 's'),
-            ('(ax|test)is$', '\\1es'),
-            ('(octop|vir)us$', '\\1i'),
-            ('(alias|status)$', '\\1es'),
-            ('(bu)s$', '\\1ses'),
-            ('(buffal|tomat)o$', '\\1oes'),
-            ('([ti])um$', '\\1a'),
-            ('sis$', 'ses'),
-            ('(?:([^f])fe|([lr])f)$', '\\1\\2ves'),
-            ('(hive)$', '\\1s'),
-            ('([^aeiouy]|qu)y$', '\\1ies'),
-            ('([^aeiouy]|qu)ies$', '\\1y'),
-            ('(x|ch|ss|sh)$', '\\1es'),
-            ('(matr|vert|ind)ix|ex$', '\\1ices'),
-            ('([m|l])ouse$', '\\1ice'),
-            ('^(ox)$', '\\1en'),
-            ('(quiz)$', '\\1zes'),
-            ('^person$', 'people'),
-            ('^man$', 'men'),
-            ('^child$', 'children'),
-            ('^sex$', 'sexes'),
-            ('^move$', 'moves'),
-            ('^(deer|fish|sheep|species)$', '\\1')
-        ]
-        plurals.reverse()
-
-        for re_from, re_to in plurals:
-            if re.search(re_from, text):
-                text = re.sub(re_from, re_to, text)
-                break
-        return text
+        return pluralize(text)
 
     def singularize(self, text):
-        singulars = [
-            ('s$', ''),
-            ('(n)ews$', '\\1ews'),
-            ('([ti])a$', '\\1um'),
-            ('((a)naly|(b)a|(d)iagno|(p)arenthe|(p)rogno|(s)ynop|(t)he)ses$', '\\1\\2sis'),
-            ('(^analy)ses$', '\\1sis'),
-            ('([^f])ves$', '\\1fe'),
-            ('(hive)s$', '\\1'),
-            ('(tive)s$', '\\1'),
-            ('([lr])ves$', '\\1f'),
-            ('([^aeiouy]|qu)ies$', '\\1y'),
-            ('(s)eries$', '\\1eries'),
-            ('(m)ovies$', '\\1ovie'),
-            ('(x|ch|ss|sh)es$', '\\1'),
-            ('([m|l])ice$', '\\1ouse'),
-            ('(bus)es$', '\\1'),
-            ('(o)es$', '\\1'),
-            ('(shoe)s$', '\\1'),
-            ('(cris|ax|test)es$', '\\1is'),
-            ('([octop|vir])i$', '\\1us'),
-            ('(alias|status)es$', '\\1'),
-            ('^(ox)en', '\\1'),
-            ('(vert|ind)ices$', '\\1ex'),
-            ('(matr)ices$', '\\1ix'),
-            ('(quiz)zes$', '\\1'),
-            ('^people$', 'person'),
-            ('^men$', 'man'),
-            ('^children$', 'child'),
-            ('^sexes$', 'sex'),
-            ('^moves$', 'move'),
-            ('^(deer|fish|sheep|species)$', '\\1')
-        ]
-        singulars.reverse()
-
-        for re_from, re_to in singulars:
-            if re.search(re_from, text):
-                text = re.sub(re_from, re_to, text)
-                break
-        return text
+        return singularize(text)
 
     def on_key_press(self, view, event):
         ctrl = False
         shift = False
         alt = False
 
-        keys = {
-            'A': (gtk.keysyms.a, gtk.keysyms.A),
-            'B': (gtk.keysyms.b, gtk.keysyms.B),
-            'C': (gtk.keysyms.c, gtk.keysyms.C),
-            'D': (gtk.keysyms.d, gtk.keysyms.D),
-            'E': (gtk.keysyms.e, gtk.keysyms.E),
-            'F': (gtk.keysyms.f, gtk.keysyms.F),
-            'H': (gtk.keysyms.h, gtk.keysyms.H),
-            'I': (gtk.keysyms.i, gtk.keysyms.I),
-            'J': (gtk.keysyms.j, gtk.keysyms.J),
-            'L': (gtk.keysyms.l, gtk.keysyms.L),
-            'M': (gtk.keysyms.m, gtk.keysyms.M),
-            'N': (gtk.keysyms.n, gtk.keysyms.N),
-            'P': (gtk.keysyms.p, gtk.keysyms.P),
-            'Q': (gtk.keysyms.q, gtk.keysyms.Q),
-            'R': (gtk.keysyms.r, gtk.keysyms.R),
-            'T': (gtk.keysyms.t, gtk.keysyms.T),
-            'U': (gtk.keysyms.u, gtk.keysyms.U),
-            'V': (gtk.keysyms.v, gtk.keysyms.V),
-        }
-
         if event.state & gtk.gdk.CONTROL_MASK:
             ctrl = True
 
@@ -260,7 +363,7 @@ class RailsHotkeysWindowHelper:
             view.set_data('RailsMode', False)
             return True
 
-        r_pressed = event.keyval in keys['R']
+        r_pressed = event.keyval in (gtk.keysyms.r, gtk.keysyms.R)
 
         debug('R key pressed? %s' % r_pressed, 2)
 
@@ -280,46 +383,8 @@ class RailsHotkeysWindowHelper:
                 return True
 
             uri = os.path.abspath(uri)
-            name = re.sub('(_controller|_test|_controller_test)?\.(rb|yml)$', '', os.path.basename(uri))
-            type = None
-
-            if event.keyval in keys['A']:
-                type = 'application'
-            elif event.keyval in keys['B']:
-                type = 'rails'
-            elif event.keyval in keys['C']:
-                type = 'controller'
-            elif event.keyval in keys['D']:
-                type = 'database'
-            elif event.keyval in keys['E']:
-                type = 'environment'
-            elif event.keyval in keys['F']:
-                type = 'functional'
-            elif event.keyval in keys['H']:
-                type = 'helper'
-            elif event.keyval in keys['I']:
-                type = 'integration'
-            elif event.keyval in keys['J']:
-                type = 'fixtures'
-            elif event.keyval in keys['L']:
-                type = 'layout'
-            elif event.keyval in keys['M']:
-                type = 'model'
-            elif event.keyval in keys['N']:
-                type = 'navigate'
-            elif event.keyval in keys['P']:
-                type = 'public'
-            #elif event.keyval in keys['Q']:
-            elif event.keyval == gtk.keysyms.F1:
-                type = 'help'
-            elif event.keyval in keys['R']:
-                type = 'routes'
-            elif event.keyval in keys['T']:
-                type = 'tests'
-            elif event.keyval in keys['U']:
-                type = 'unit'
-            elif event.keyval in keys['V']:
-                type = 'views'
+            name = RESOURCE_NAME_RE.sub('', os.path.basename(uri))
+            type = KEY_TYPES.get(event.keyval)
 
             debug('type: %s' % type)
 
@@ -353,10 +418,16 @@ class RailsHotkeysWindowHelper:
         if not rails_root:
             return self.set_status(_('Root not found'))
 
-        if re.search('\/app\/views\/', uri):
+        if VIEW_PATH_RE.search(uri):
             name = os.path.basename(os.path.dirname(uri))
 
-        if type == 'unit':
+        # Related files of the resource are looked up in the index first
+        index = RailsIndex.get(rails_root)
+        path = index.lookup(type, name)
+
+        if path:
+            debug('type: %s, indexed path: %s' % (type, path))
+        elif type == 'unit':
             name = self.singularize(name)
             path = os.path.join(rails_root, 'test', 'unit', '%s_test.rb' % name)
         elif type == 'functional':
@@ -385,6 +456,9 @@ class RailsHotkeysWindowHelper:
             self.open('functional', uri, name)
             self.open('integration', uri, name)
             self.open('fixtures', uri, name)
+            for kind in ('model_spec', 'controller_spec', 'helper_spec'):
+                if index.lookup(kind, name):
+                    self.open(kind, uri, name)
             return
         elif type == 'application':
             path = os.path.join(rails_root, 'app', 'controllers', 'application.rb')
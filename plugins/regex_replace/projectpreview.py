@@ -0,0 +1,260 @@
+import cgi
+import gedit
+from gettext import gettext as _
+import gobject
+import gtk
+import os
+import sys
+import urllib
+from replacements import ProjectSearch, find_replacements, apply_replacements, \
+    replace_in_file, document_path
+
+# Milliseconds between two looks at the results of a running search
+POLL_INTERVAL = 200
+
+# Files added to the preview per look, so a large tree does not freeze gedit
+RESULTS_PER_POLL = 100
+
+# Matches listed under a file, the others are only counted
+MAX_MATCH_ROWS = 100
+
+# Characters of a matched line shown around the match
+CONTEXT_LENGTH = 40
+
+(COLUMN_APPLY, COLUMN_TEXT, COLUMN_PATH, COLUMN_LINE) = range(4)
+
+class ProjectPreview:
+
+    ###
+    # Object initialization
+    #
+    # The documents open in gedit are searched as they are in their
+    # buffers, and replaced there, instead of their files.
+    def __init__(self, window, root, regex, replace_string, use_backreferences):
+        self._window = window
+        self._root = root
+        self._regex = regex
+        self._replace_string = replace_string
+        self._use_backreferences = use_backreferences
+        self._n_files = 0
+        self._n_matches = 0
+        self._poll_id = None
+
+        buffers = {}
+        for document in gedit.app_get_default().get_documents():
+            path = document_path(document)
+            if path is not None:
+                buffers[path] = unicode(document.get_text(document.get_start_iter(),
+                                                          document.get_end_iter(), False), "utf-8")
+
+        self._search = ProjectSearch(root, regex, replace_string, use_backreferences, buffers)
+        self.create_window()
+
+    ###
+    # Create the preview window: a tree of the files with matches, where
+    # each file can be left out, a status line and the buttons.
+    def create_window(self):
+        self._preview = gtk.Window()
+        self._preview.set_title(_("Replace in %s") % self.display_name(self._root))
+        self._preview.set_transient_for(self._window)
+        self._preview.set_destroy_with_parent(True)
+        self._preview.set_default_size(640, 480)
+        self._preview.connect("destroy", self.on_destroy)
+
+        self._store = gtk.TreeStore(bool, str, str, int)
+        self._tree = gtk.TreeView(self._store)
+        self._tree.set_headers_visible(False)
+        self._tree.connect("row-activated", self.on_row_activated)
+
+        toggle = gtk.CellRendererToggle()
+        toggle.connect("toggled", self.on_apply_toggled)
+        column = gtk.TreeViewColumn("", toggle, active=COLUMN_APPLY)
+        column.set_cell_data_func(toggle, self.apply_cell_data)
+        self._tree.append_column(column)
+        self._tree.append_column(gtk.TreeViewColumn("", gtk.CellRendererText(), markup=COLUMN_TEXT))
+
+        scrolled = gtk.ScrolledWindow()
+        scrolled.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
+        scrolled.set_shadow_type(gtk.SHADOW_IN)
+        scrolled.add(self._tree)
+
+        self._status = gtk.Label()
+        self._status.set_alignment(0, 0.5)
+
+        self._close_button = gtk.Button(stock=gtk.STOCK_CLOSE)
+        self._close_button.connect("clicked", self.on_close_button_clicked)
+        self._replace_button = gtk.Button(_("Replace"))
+        self._replace_button.set_sensitive(False)
+        self._replace_button.connect("clicked", self.on_replace_button_clicked)
+
+        buttons = gtk.HButtonBox()
+        buttons.set_layout(gtk.BUTTONBOX_END)
+        buttons.set_spacing(6)
+        buttons.pack_start(self._close_button)
+        buttons.pack_start(self._replace_button)
+
+        vbox = gtk.VBox(False, 6)
+        vbox.set_border_width(6)
+        vbox.pack_start(scrolled)
+        vbox.pack_start(self._status, False)
+        vbox.pack_start(buttons, False)
+        self._preview.add(vbox)
+
+    ###
+    # Shows the window and starts the search.
+    def show(self):
+        self._preview.show_all()
+        self._search.start()
+        self.update_status(False)
+        self._poll_id = gobject.timeout_add(POLL_INTERVAL, self.poll_search)
+
+    ###
+    # Adds the files found since the last call to the tree, returns
+    # True while the search is running.
+    def poll_search(self):
+        results, done = self._search.pop_results(RESULTS_PER_POLL)
+        for path, matches in results:
+            self.add_file(path, matches)
+        self.update_status(done)
+        if done:
+            self._poll_id = None
+        return not done
+
+    def add_file(self, path, matches):
+        self._n_files += 1
+        self._n_matches += len(matches)
+        name = cgi.escape(self.display_name(os.path.relpath(path, self._root)))
+        file_iter = self._store.append(None, [True, u"<b>%s</b> (%d)" % (name, len(matches)), path, -1])
+        for match in matches[:MAX_MATCH_ROWS]:
+            self._store.append(file_iter, [True, self.match_markup(match), path, match.line])
+        if len(matches) > MAX_MATCH_ROWS:
+            self._store.append(file_iter, [True, _("<i>%d more</i>") % (len(matches) - MAX_MATCH_ROWS), path, -1])
+        self._replace_button.set_sensitive(True)
+
+    ###
+    # Paths are kept as the bytes os.walk returns, they are only decoded to
+    # be shown.
+    def display_name(self, path):
+        if isinstance(path, unicode):
+            return path
+        return path.decode(sys.getfilesystemencoding() or "utf-8", "replace")
+
+    ###
+    # The line of a match, cut around the match, with the matched text
+    # struck out and followed by its replacement.
+    def match_markup(self, match):
+        start, end, replace_text = match.span
+        offset = match.column
+        text = match.text
+        matched = text[offset:offset + (end - start)]
+        before = text[max(0, offset - CONTEXT_LENGTH):offset].lstrip()
+        after = text[offset + len(matched):offset + len(matched) + CONTEXT_LENGTH]
+        return u"%d: %s<s>%s</s><b>%s</b>%s" % (match.line + 1, cgi.escape(before), cgi.escape(matched),
+                                               cgi.escape(replace_text), cgi.escape(after))
+
+    def update_status(self, done):
+        if done:
+            status = _("%d matches in %d files, %d files searched")
+        else:
+            status = _("Searching... %d matches in %d files, %d files searched")
+        self._status.set_text(status % (self._n_matches, self._n_files, self._search.n_files))
+
+    ###
+    # Only file rows can be left out, match rows follow their file.
+    def apply_cell_data(self, column, cell, model, iter):
+        cell.set_property("visible", model.iter_parent(iter) is None)
+
+    def on_apply_toggled(self, cell, path):
+        iter = self._store.get_iter(path)
+        self._store.set_value(iter, COLUMN_APPLY, not self._store.get_value(iter, COLUMN_APPLY))
+
+    ###
+    # Opens the file of the activated row, at the line of the match.
+    def on_row_activated(self, tree, path, column):
+        iter = self._store.get_iter(path)
+        file_path = self._store.get_value(iter, COLUMN_PATH)
+        line = max(self._store.get_value(iter, COLUMN_LINE), 0)
+
+        for document in self._window.get_documents():
+            if document_path(document) == file_path:
+                tab = gedit.tab_get_from_document(document)
+                self._window.set_active_tab(tab)
+                document.goto_line(line)
+                tab.get_view().scroll_to_cursor()
+                return
+        uri = "file://" + urllib.pathname2url(file_path)
+        self._window.create_tab_from_uri(uri, None, line + 1, False, True)
+
+    ###
+    # Replaces the matches in the checked files.
+    #
+    # The matches are looked for again, so that changes made since the
+    # search are not overwritten. Open documents are edited in their buffer,
+    # each as one user action, other files are rewritten on disk, each one
+    # replaced as a whole or not at all.
+    def on_replace_button_clicked(self, button):
+        self.stop_search()
+
+        documents = {}
+        for document in gedit.app_get_default().get_documents():
+            path = document_path(document)
+            if path is not None:
+                documents[path] = document
+
+        n_replacements = 0
+        n_files = 0
+        errors = []
+        iter = self._store.get_iter_first()
+        while iter is not None:
+            path = self._store.get_value(iter, COLUMN_PATH)
+            if self._store.get_value(iter, COLUMN_APPLY):
+                document = documents.get(path)
+                try:
+                    if document is not None:
+                        n = self.replace_in_document(document)
+                    else:
+                        n = replace_in_file(path, self._regex, self._replace_string, self._use_backreferences)
+                except (IOError, OSError), e:
+                    errors.append(u"%s: %s" % (self.display_name(path),
+                                               self.display_name(str(e))))
+                else:
+                    n_replacements += n
+                    n_files += 1
+            iter = self._store.iter_next(iter)
+
+        message = u"%d replacement(s) in %d file(s)." % (n_replacements, n_files)
+        if errors:
+            message += u"\n\nThese files could not be changed:\n" + u"\n".join(errors)
+        self.show_alert_dialog(message)
+        self._preview.destroy()
+
+    def replace_in_document(self, document):
+        text = unicode(document.get_text(document.get_start_iter(), document.get_end_iter(), False), "utf-8")
+        spans, n_replacements = find_replacements(self._regex, text, self._replace_string, self._use_backreferences)
+        if spans:
+            document.begin_user_action()
+            apply_replacements(document, spans)
+            document.end_user_action()
+        return n_replacements
+
+    def on_close_button_clicked(self, button):
+        self._preview.destroy()
+
+    def on_destroy(self, widget):
+        self.stop_search()
+
+    def stop_search(self):
+        self._search.cancel()
+        if self._poll_id is not None:
+            gobject.source_remove(self._poll_id)
+            self._poll_id = None
+            self.update_status(True)
+
+    def show_alert_dialog(self, s):
+        dlg = gtk.MessageDialog(self._window,
+                                gtk.DIALOG_MODAL | gtk.DIALOG_DESTROY_WITH_PARENT,
+                                gtk.MESSAGE_INFO,
+                                gtk.BUTTONS_CLOSE,
+                                s)
+        dlg.run()
+        dlg.destroy()
@@ -16,7 +16,9 @@
 
 """Automatically detects if file resides in a ruby on rails application and set the properly language."""
 
-import gedit, os
+import gedit
+
+from lib.roots import rails_environment_roots
 
 class RubyOnRailsLoader(gedit.Plugin):
 
@@ -70,31 +72,4 @@ class RubyOnRailsLoader(gedit.Plugin):
 
 
     def get_in_rails(self, uri):
-        rails_root = self.get_data('RailsLoaderRoot')
-        if rails_root:
-            return rails_root
-        base_dir = os.path.dirname(uri)
-        depth = 10
-        while depth > 0:
-            depth -= 1
-            app_dir = os.path.join(base_dir, 'app')
-            config_dir = os.path.join(base_dir, 'config')
-            environment_file = os.path.join(base_dir, 'config', 'environment.rb')
-            if os.path.isdir(app_dir) and os.path.isdir(config_dir) and os.path.isfile(environment_file):
-                rails_root = base_dir
-                break
-            else:
-                base_dir = os.path.abspath(os.path.join(base_dir, '..'))
-        if rails_root:
-            self.set_data('RailsLoaderRoot', rails_root)
-            return True
-        return False
-
-
-    def set_data(self, name, value):
-        self.window.get_active_tab().get_view().set_data(name, value)
-
-
-    def get_data(self, name):
-        return self.window.get_active_tab().get_view().get_data(name)
-
+        return rails_environment_roots.find(uri) is not None
@@ -21,9 +21,10 @@
 
 VERSION = "0.3b"
 
-import gedit, gtk
+import gedit, gtk, gconf
 from gettext import gettext as _
 import cPickle, os
+from lib.tabs import create_pending_tab, document_uri, load_pending_tab
 
 # Menu item example, insert a new item in the Tools menu
 ui_str = """<ui>
@@ -42,6 +43,10 @@ ui_str = """<ui>
 
 import errno
 
+# When set, only the active document is loaded on restore, the others are
+# loaded by their placeholder tabs once activated
+LAZY_RESTORE_KEY = "/apps/gedit-2/plugins/session/lazy_restore"
+
 def mkdir_p(path):
     try:
         os.makedirs(path)
@@ -59,6 +64,7 @@ class SessionPluginInstance:
 		self.olddocs = []
 		# Insert menu items
 		self._insert_menu()
+		self._tab_handler = window.connect("active-tab-changed", self.on_active_tab_changed)
 		try:
 		  os.mkdir(os.path.expanduser('~/.gnome2/gedit'))
 		except:
@@ -67,6 +73,7 @@ class SessionPluginInstance:
 	def stop(self):
 		# Remove any installed menu items
 		self._remove_menu()
+		self._window.disconnect(self._tab_handler)
 		
 		self._window = None
 		self._plugin = None
@@ -114,29 +121,48 @@ class SessionPluginInstance:
 	
 	def on_save(self):
 		cdocs = self._window.get_documents()
-		self.docs = [d.get_uri() for d in cdocs]
+		self.docs = [document_uri(d) for d in cdocs]
+		active = self._window.get_active_document()
+		active = active and document_uri(active)
 		fn = os.path.expanduser('~/.gnome2/gedit/sessionsave.dump')
 		fd = open(fn, 'w')
-		cPickle.dump(self.docs, fd)
+		cPickle.dump((self.docs, active), fd)
 		fd.close()
 		
 	
 	def on_restore(self):
 		fn = os.path.expanduser('~/.gnome2/gedit/sessionsave.dump')
 		try:
-			self.docs = cPickle.load(open(fn, 'r'))
+			session = cPickle.load(open(fn, 'r'))
 		except IOError:
 			mkdir_p(os.path.expanduser('~/.gnome2/gedit'));
 			fd = open(fn, 'w')
-			cPickle.dump(self.docs, fd)
+			cPickle.dump((self.docs, None), fd)
 			fd.close()
 			return
-			
 		
+		# Sessions saved by older versions are a list of uris
+		if isinstance(session, list):
+			session = (session, None)
+		self.docs, active = session
+		
+		lazy = gconf.client_get_default().get_bool(LAZY_RESTORE_KEY)
+		if active not in self.docs:
+			active = None
+		# Without a saved active document the first one is loaded
+		if lazy and active is None:
+			active = ([uri for uri in self.docs if uri is not None] or [None])[0]
 		for uri in self.docs:
-		  if  not uri is None: self._window.create_tab_from_uri(uri, self.enc, 0, False, False)
+		  if uri is None: continue
+		  if lazy and uri != active:
+		    create_pending_tab(self._window, uri)
+		  else:
+		    self._window.create_tab_from_uri(uri, self.enc, 0, False, uri == active)
 	  # TODO: search for "TODO HERE" and goto_line to there (like first analyze the file then load it) 
 
+	def on_active_tab_changed(self, window, tab):
+		load_pending_tab(tab, self.enc)
+
 
 class SessionPlugin(gedit.Plugin):
 	DATA_TAG = "SessionPluginInstance"
@@ -83,12 +83,15 @@ class ConfigUI(object):
 		
 	def on_matchWholeWordCheckbutton_toggled(self, widget):
 		self._instance.options['MATCH_WHOLE_WORD'] = widget.get_active()
+		self._instance.options_changed()
 		
 	def on_matchCaseCheckbutton_toggled(self, widget):
 		self._instance.options['MATCH_CASE'] = widget.get_active()
+		self._instance.options_changed()
 	
 	def on_regexSearchCheckbutton_toggled(self, widget):
 		self._instance.options['REGEX_SEARCH'] = widget.get_active()
+		self._instance.options_changed()
 		
 	def on_fgColorbutton_color_set(self, widget):
 		self._instance.smart_highlight['FOREGROUND_COLOR'] = widget.get_color().to_string()
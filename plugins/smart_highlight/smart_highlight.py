@@ -26,8 +26,10 @@
 
 import gtk
 import gedit
+import gobject
 import re
 import os.path
+import itertools
 #import pango
 
 import config_manager
@@ -40,6 +42,10 @@ LOCALE_DIR = '/usr/share/locale'
 #	LOCALE_DIR = '/usr/share/locale'
 gettext.install(APP_NAME, LOCALE_DIR, unicode=True)
 
+# milliseconds the selection has to stay put before it is highlighted
+HIGHLIGHT_DELAY = 150
+# matches highlighted per idle call outside of the visible region
+MATCHES_PER_CHUNK = 200
 
 
 
@@ -48,6 +54,10 @@ class SmartHighlightWindowHelper:
 		self._window = window
 		self._plugin = plugin
 		self.active_tab_added_id = self._window.connect("tab-added", self.tab_added_action)
+		self.active_tab_removed_id = self._window.connect("tab-removed", self.tab_removed_action)
+		self._pending_timeouts = {}
+		self._pending_chunks = {}
+		self._highlighted = {}
 		
 		configfile = os.path.join(os.path.dirname(__file__), "config.xml")
 		self.config_manager = config_manager.ConfigManager(configfile)
@@ -62,6 +72,11 @@ class SmartHighlightWindowHelper:
 	def deactivate(self):
 		# Remove any installed menu items
 		self._window.disconnect(self.active_tab_added_id)
+		self._window.disconnect(self.active_tab_removed_id)
+		for doc in self._window.get_documents():
+			self.disconnect_document(doc)
+		for doc in self._pending_timeouts.keys() + self._pending_chunks.keys():
+			self.cancel_highlighting(doc)
 		self.config_manager.update_config_file(self.config_manager.config_file, 'search_option', self.options)
 		self.config_manager.update_config_file(self.config_manager.config_file, 'smart_highlight', self.smart_highlight)
 	
@@ -99,39 +114,88 @@ class SmartHighlightWindowHelper:
 		return regex
 
 	def smart_highlighting_action(self, doc, search_pattern):
+		if self._highlighted.get(doc) == search_pattern:
+			return
 		regex = self.create_regex(search_pattern, self.options)
 		self.smart_highlight_off(doc)
+		self._highlighted[doc] = search_pattern
 		start, end = doc.get_bounds()
 		text = unicode(doc.get_text(start, end), 'utf-8')
-		lines = text.splitlines(True)
-		
-		for i in range(len(lines)):
-			result = regex.findall(lines[i])
-			line_start = doc.get_iter_at_line(i)
-				
-			if result:
-				match_pos = 0
-				for cnt in range(0,len(result)):
-					match = regex.search(lines[i][match_pos:])
-					result_offset_start = line_start.get_offset() + match.start() + match_pos
-					result_len = len(match.group(0))
-					self.smart_highlight_on(doc, result_offset_start, result_len)
-					match_pos += match.end()
+		tag = self.get_highlight_tag(doc)
+		
+		# highlight what is in view right away and the rest of the buffer when idle,
+		# the whole text is searched in one go so no match is cut at the view's edges
+		first, last = 0, len(text)
+		view = self._window.get_active_view()
+		if view is not None and view.get_buffer() == doc:
+			first, last = self.get_visible_offsets(view)
+		matches = regex.finditer(text)
+		hidden = []
+		for match in matches:
+			if match.start() >= last:
+				hidden.append(match)
+				break
+			if match.end() <= first:
+				hidden.append(match)
+				continue
+			doc.apply_tag(tag, doc.get_iter_at_offset(match.start()), doc.get_iter_at_offset(match.end()))
+		if hidden:
+			rest = itertools.chain(hidden, matches)
+			self._pending_chunks[doc] = gobject.idle_add(self.smart_highlight_matches, doc, tag, rest, MATCHES_PER_CHUNK)
+		
+	def get_visible_offsets(self, view):
+		rect = view.get_visible_rect()
+		start = view.get_line_at_y(rect.y)[0]
+		end = view.get_line_at_y(rect.y + rect.height)[0]
+		end.forward_to_line_end()
+		return start.get_offset(), end.get_offset()
+		
+	def options_changed(self):
+		# the highlighted matches were found with the old options
+		for doc in self._highlighted:
+			self._highlighted[doc] = None
 		
 	def tab_added_action(self, action, tab):
 		doc = tab.get_document()
-		view = tab.get_view()
 		#view.connect('button-release-event', self.on_textveiw_button_release_event, doc)
-		view.get_buffer().connect('mark-set', self.on_textbuffer_markset_event)
+		doc.set_data('SmartHighlightHandlers', [
+			doc.connect('mark-set', self.on_textbuffer_markset_event),
+			doc.connect('changed', self.on_textbuffer_changed_event),
+		])
+		
+	def tab_removed_action(self, action, tab):
+		doc = tab.get_document()
+		self.disconnect_document(doc)
+		self.cancel_highlighting(doc)
+	
+	def disconnect_document(self, doc):
+		for handler_id in doc.get_data('SmartHighlightHandlers') or []:
+			doc.disconnect(handler_id)
+		doc.set_data('SmartHighlightHandlers', None)
 	
 	def on_textbuffer_markset_event(self, textbuffer, iter, textmark):
 		if textmark.get_name() == None:
 			return
-		if textbuffer.get_selection_bounds():
-			start, end = textbuffer.get_selection_bounds()
- 			self.smart_highlighting_action(textbuffer, textbuffer.get_text(start, end))
- 		else:
- 			self.smart_highlight_off(textbuffer)
+		# dragging a selection moves the marks on every motion, wait for it to settle
+		if textbuffer in self._pending_timeouts:
+			gobject.source_remove(self._pending_timeouts[textbuffer])
+		self._pending_timeouts[textbuffer] = gobject.timeout_add(HIGHLIGHT_DELAY, self.on_selection_settled, textbuffer)
+		
+	def on_textbuffer_changed_event(self, textbuffer):
+		# the offsets of the queued matches are stale now
+		if textbuffer in self._pending_chunks:
+			gobject.source_remove(self._pending_chunks.pop(textbuffer))
+		if textbuffer in self._highlighted:
+			self._highlighted[textbuffer] = None
+		
+	def on_selection_settled(self, doc):
+		del self._pending_timeouts[doc]
+		if doc.get_selection_bounds():
+			start, end = doc.get_selection_bounds()
+			self.smart_highlighting_action(doc, doc.get_text(start, end))
+		else:
+			self.smart_highlight_off(doc)
+		return False
 	
 	'''
 	def on_textveiw_button_release_event(self, widget, event, doc):
@@ -142,15 +206,36 @@ class SmartHighlightWindowHelper:
 			self.smart_highlight_off(doc)
 	#'''
 	
-	def smart_highlight_on(self, doc, highlight_start, highlight_len):
-		if doc.get_tag_table().lookup('smart_highlight') == None:
+	def get_highlight_tag(self, doc):
+		tag = doc.get_tag_table().lookup('smart_highlight')
+		if tag == None:
 			tag = doc.create_tag("smart_highlight", foreground=self.smart_highlight['FOREGROUND_COLOR'], background=self.smart_highlight['BACKGROUND_COLOR'])
-		doc.apply_tag_by_name('smart_highlight', doc.get_iter_at_offset(highlight_start), doc.get_iter_at_offset(highlight_start + highlight_len))
+		return tag
+		
+	def smart_highlight_matches(self, doc, tag, matches, limit):
+		count = 0
+		for match in matches:
+			doc.apply_tag(tag, doc.get_iter_at_offset(match.start()), doc.get_iter_at_offset(match.end()))
+			count += 1
+			if count == limit:
+				return True
+		self._pending_chunks.pop(doc, None)
+		return False
 		
 	def smart_highlight_off(self, doc):
+		if doc in self._pending_chunks:
+			gobject.source_remove(self._pending_chunks.pop(doc))
+		if doc not in self._highlighted:
+			return
+		del self._highlighted[doc]
 		start, end = doc.get_bounds()
-		if doc.get_tag_table().lookup('smart_highlight') == None:
-			tag = doc.create_tag("smart_highlight", foreground=self.smart_highlight['FOREGROUND_COLOR'], background=self.smart_highlight['BACKGROUND_COLOR'])
-		doc.remove_tag_by_name('smart_highlight', start, end)
+		doc.remove_tag(self.get_highlight_tag(doc), start, end)
+		
+	def cancel_highlighting(self, doc):
+		if doc in self._pending_timeouts:
+			gobject.source_remove(self._pending_timeouts.pop(doc))
+		if doc in self._pending_chunks:
+			gobject.source_remove(self._pending_chunks.pop(doc))
+		self._highlighted.pop(doc, None)
 	
 
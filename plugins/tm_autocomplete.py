@@ -27,10 +27,12 @@
 __version__ = '1.0.4'
 __author__ = 'Kevin McGuinness'
 
+import bisect
 import gedit
 import gtk
 import re
 import gconf
+from lib.vocabulary import ProjectVocabulary
 
 # The default trigger: a (keyval, mod) pair
 DEFAULT_TRIGGER = (gtk.keysyms.Escape, 0)
@@ -52,11 +54,154 @@ def zip_no_truncation(v,w):
       z.append(w[i])
   return z
 
+class TokenIndex(object):
+  """Index of the words in a document, kept up to date as it is edited.
+
+     The words of each line are kept in a list of line buckets, and the
+     distinct words of the document in a sorted list. Words beginning with a
+     prefix are found with a binary search, and words near a line are found
+     by walking the buckets outwards from it, so no text has to be extracted
+     or scanned when autocompleting.
+  """
+
+  WordRegex = re.compile(r'\w+')
+  LineRegex = re.compile(r'\r\n|\r|\n|\xe2\x80\xa9')
+
+  __slots__ = (
+    'lines',     # List of word lists, one for every line in the document
+    'counts',    # Number of occurrences of every word in the document
+    'words',     # Sorted list of the distinct words in the document
+    'pending',   # Line range of the deletion in progress
+    'handlers',  # Ids of the signal handlers connected to the document
+  )
+
+  def __init__(self, doc):
+    self.pending = None
+    self.rebuild(doc)
+    self.handlers = (
+      doc.connect_after('insert-text', self.on_insert_text),
+      doc.connect('delete-range', self.on_delete_range),
+      doc.connect_after('delete-range', self.on_delete_range_after),
+    )
+
+  @classmethod
+  def for_document(cls, doc):
+    """Returns the index of the document, creating it on first use"""
+    index = getattr(doc, 'autocomplete_index', None)
+    if index is None:
+      index = cls(doc)
+      setattr(doc, 'autocomplete_index', index)
+    return index
+
+  @classmethod
+  def detach(cls, doc):
+    """Disconnects and drops the index of the document, if any"""
+    index = getattr(doc, 'autocomplete_index', None)
+    if index is not None:
+      for handler_id in index.handlers:
+        doc.disconnect(handler_id)
+      setattr(doc, 'autocomplete_index', None)
+
+  def rebuild(self, doc):
+    """Indexes the whole document from scratch"""
+    self.lines = []
+    self.counts = {}
+    self.words = []
+    text = doc.get_text(doc.get_start_iter(), doc.get_end_iter())
+    self._replace_lines(0, 0, self._split_lines(text))
+
+  def _split_lines(self, text):
+    return [self.WordRegex.findall(line) for line in self.LineRegex.split(text)]
+
+  def _read_lines(self, doc, first, last):
+    """Returns the word lists of the lines from first to last"""
+    iter1 = doc.get_iter_at_line(first)
+    iter2 = doc.get_iter_at_line(last)
+    if not iter2.ends_line():
+      iter2.forward_to_line_end()
+    return self._split_lines(doc.get_text(iter1, iter2))
+
+  def _replace_lines(self, start, stop, lines):
+    for words in self.lines[start:stop]:
+      for word in words:
+        count = self.counts[word] - 1
+        if count:
+          self.counts[word] = count
+        else:
+          del self.counts[word]
+          del self.words[bisect.bisect_left(self.words, word)]
+    for words in lines:
+      for word in words:
+        count = self.counts.get(word, 0)
+        if not count:
+          bisect.insort(self.words, word)
+        self.counts[word] = count + 1
+    self.lines[start:stop] = lines
+
+  def _check_line_count(self, doc):
+    # Line breaks joined or split by an edit (such as inserting a newline
+    # after a carriage return) are not tracked, start over when that happens
+    if len(self.lines) != doc.get_line_count():
+      self.rebuild(doc)
+
+  def on_insert_text(self, doc, iter1, text, length):
+    # After the default handler iter1 points to the end of the insertion
+    last = iter1.get_line()
+    first = last - len(self.LineRegex.split(text)) + 1
+    self._replace_lines(first, first + 1, self._read_lines(doc, first, last))
+    self._check_line_count(doc)
+
+  def on_delete_range(self, doc, iter1, iter2):
+    self.pending = (iter1.get_line(), iter2.get_line())
+
+  def on_delete_range_after(self, doc, iter1, iter2):
+    first, last = self.pending
+    self.pending = None
+    line = iter1.get_line()
+    self._replace_lines(first, last + 1, self._read_lines(doc, line, line))
+    self._check_line_count(doc)
+
+  def count(self, word):
+    """Returns the number of occurrences of the word in the document"""
+    return self.counts.get(word, 0)
+
+  def words_with_prefix(self, prefix):
+    """Yields the words longer than and beginning with the given prefix in
+       alphabetical order.
+    """
+    words = self.words
+    i = bisect.bisect_left(words, prefix)
+    while i < len(words) and words[i].startswith(prefix):
+      if words[i] != prefix:
+        yield words[i]
+      i += 1
+
+  def words_near_line(self, line, wanted):
+    """Yields the words in wanted ordered by the distance of their nearest 
+       occurrence from the given line, which itself is not searched.
+    """
+    remaining = set(wanted)
+    lines = self.lines
+    for distance in xrange(1, max(line, len(lines) - line - 1) + 1):
+      if not remaining:
+        break
+      buckets = []
+      if line - distance >= 0:
+        buckets.append(reversed(lines[line - distance]))
+      if line + distance < len(lines):
+        buckets.append(lines[line + distance])
+      for bucket in buckets:
+        for word in bucket:
+          if word in remaining:
+            remaining.discard(word)
+            yield word
+
+
 class AutoCompleter(object):
   """Class that actually does the autocompletion"""
 
   IgnoreUnderscore = True
-  ValidScopes = ('document', 'window', 'application')
+  ValidScopes = ('document', 'window', 'application', 'project')
   ValidOrders = ('alphabetical', 'proximity')
   LastAcceptedMatch = None
 
@@ -68,7 +213,7 @@ class AutoCompleter(object):
     'iter_s',    # GtkTextIterator pointing to the start of word being completed
     'iter_i',    # GtkTextIterator pointing to insertion point
     'iter_e',    # GtkTextIterator pointing to end of last insertion
-    'scope',     # Search scope (document|application|window)
+    'scope',     # Search scope (document|application|window|project)
     'order',     # Result list ordering (proximity|alphabetical)
     'promote',   # Promote last accepted match
   )
@@ -119,33 +264,46 @@ class AutoCompleter(object):
         return True
     return False
 
-  def _get_current_doc_words_sorted_by_proximity(self, regex):
-    """Returns the words in the current document sorted by distance from 
-       cursor.
+  def _get_current_doc_words_sorted_by_proximity(self, prefix):
+    """Returns the words in the current document beginning with the prefix
+       sorted by distance from cursor. Only the line of the cursor is read
+       from the buffer, the other lines are searched in the token index.
     """
-    fwd_text = self.doc.get_text(self.iter_i, self.doc.get_end_iter())
-    bck_text = self.doc.get_text(self.doc.get_start_iter(), self.iter_s)
-    fwd_words = regex.findall(fwd_text)
-    bck_words = regex.findall(bck_text)
+    index = TokenIndex.for_document(self.doc)
+    line_s = self.iter_s.copy()
+    line_s.set_line_offset(0)
+    line_e = self.iter_i.copy()
+    if not line_e.ends_line():
+      line_e.forward_to_line_end()
+    bck_text = self.doc.get_text(line_s, self.iter_s)
+    fwd_text = self.doc.get_text(self.iter_i, line_e)
+    wanted = set(index.words_with_prefix(prefix))
+    # The word under the cursor is not a match unless it occurs elsewhere
+    current = (re.search(r'\w*$', bck_text).group() + prefix +
+      re.match(r'\w*', fwd_text).group())
+    if index.count(current) == 1:
+      wanted.discard(current)
+    fwd_words = [w for w in TokenIndex.WordRegex.findall(fwd_text) 
+      if w in wanted]
+    bck_words = [w for w in TokenIndex.WordRegex.findall(bck_text) 
+      if w in wanted]
     bck_words.reverse()
-    all_words = zip_no_truncation(bck_words, fwd_words)
-    return uniq_order_preserved(all_words)
-
-  def _get_current_doc_words(self, regex):
-    """Returns an unsorted list of words in the current document. The given 
-       regex is used to match the words.
+    words = uniq_order_preserved(zip_no_truncation(bck_words, fwd_words))
+    remaining = wanted.difference(words)
+    words.extend(index.words_near_line(self.iter_i.get_line(), remaining))
+    return words
+
+  def _get_current_doc_words(self, prefix):
+    """Returns an alphabetical list of words in the current document 
+       beginning with the given prefix.
     """
-    iter1 = self.doc.get_start_iter()
-    iter2 = self.doc.get_end_iter()
-    text = self.doc.get_text(iter1, iter2)
-    words = set(regex.findall(text))
-    return list(words)
+    return list(TokenIndex.for_document(self.doc).words_with_prefix(prefix))
 
-  def _get_other_doc_words(self, regex):
-    """Returns an unsorted list of words in the non-current document based
-       on the selected scope. The given regex is used to match the words.
+  def _get_other_doc_words(self, prefix):
+    """Returns an unsorted list of words beginning with the given prefix in 
+       the non-current documents based on the selected scope.
     """
-    if self.scope == 'application':
+    if self.scope in ('application', 'project'):
       # Index all documents open in any gedit window
       docs = gedit.app_get_default().get_documents()
     elif self.scope == 'window':
@@ -157,30 +315,28 @@ class AutoCompleter(object):
     words = set()
     for doc in docs:
       if doc != self.doc:
-        text = doc.get_text(doc.get_start_iter(), doc.get_end_iter())
-        words.update(regex.findall(text))
+        words.update(TokenIndex.for_document(doc).words_with_prefix(prefix))
+    if self.scope == 'project':
+      # Words from source files of the project that may not be open, none
+      # outside a project
+      vocabulary = ProjectVocabulary.for_document(self.doc)
+      if vocabulary is not None:
+        words.update(w for w in vocabulary.words_with_prefix(prefix) 
+          if w != prefix)
     return list(words)
 
-  def _create_regex_for_prefix(self, prefix):
-    """Compiles a regular expression that matches words beginning with the 
-       given prefix. If the prefix is empty, a match-any-word regular 
-       expression is created.
-    """
-    return re.compile(r'\b' + prefix + r'\w+\b')
-
   def _get_candidate_matches(self, doc, prefix):
     """Returns all words in the document that match the given word"""
-    regex = self._create_regex_for_prefix(prefix)
     if self.order == 'alphabetical':
       # Alphabetical sort
-      words = self._get_current_doc_words(regex)
-      other = self._get_other_doc_words(regex) 
+      words = self._get_current_doc_words(prefix)
+      other = self._get_other_doc_words(prefix) 
       words.extend(other)
       words.sort()
     else:
       # Proximity sort in current doc, alphabetical in others
-      words = self._get_current_doc_words_sorted_by_proximity(regex)
-      other = self._get_other_doc_words(regex) 
+      words = self._get_current_doc_words_sorted_by_proximity(prefix)
+      other = self._get_other_doc_words(prefix) 
       other.sort()
       words.extend(other)
     return uniq_order_preserved(words)
@@ -274,6 +430,8 @@ class AutoCompletionPlugin(gedit.Plugin):
       for handler_id in getattr(view, 'autocomplete_handlers', []):
         view.disconnect(handler_id)
       setattr(view, 'autocomplete_handlers_attached', False)
+    for doc in window.get_documents():
+      TokenIndex.detach(doc)
     self.autocompleter = None   
     self.gconf_deactivate()
 
@@ -421,6 +579,7 @@ class ConfigurationDialog(gtk.Dialog):
   ScopeDocText = 'The current document only'
   ScopeWinText = 'All open documents in the current window'
   ScopeAppText = 'All open documents in the application'
+  ScopeProjectText = 'All open documents and source files in the project'
   OrderKey = 'order'
   OrderFrameText = '<b>Sort autocompletion list:</b>'
   OrderAlphaText = 'In alphabetical order'
@@ -455,6 +614,7 @@ class ConfigurationDialog(gtk.Dialog):
     btn1 = scope_radio(self.ScopeDocText, 'document')
     btn2 = scope_radio(self.ScopeWinText, 'window', btn1)
     btn3 = scope_radio(self.ScopeAppText, 'application', btn2)
+    scope_radio(self.ScopeProjectText, 'project', btn3)
     frame.add(scope_box)
     mainbox.pack_start(frame)
     # Order configuration
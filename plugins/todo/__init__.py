@@ -22,6 +22,7 @@
 from gettext import gettext as _
 import gedit
 import gconf
+import gobject
 import gtk
 import gtk.gdk
 import os
@@ -30,11 +31,15 @@ import webkit
 import re
 import urllib
 
-from todo import parse_directory
+from todo import TodoScanner
+from lib.roots import project_root
 
 DEBUG_NAME = 'TODO_DEBUG'
 DEBUG_TITLE = 'todo'
 
+# Milliseconds between two looks at the results of a running scan
+POLL_INTERVAL = 200
+
 ui_str = """
 <ui>
     <menubar name="MenuBar">
@@ -88,17 +93,52 @@ class TodoWindowHelper:
         self.plugin = plugin
         self.todo_window = None
         self._browser = None
+        self._scanner = None
+        self._page_loaded = False
+        self._poll_id = None
         self.client = gconf.client_get_default()
         self.add_menu()
 
+        # saved documents are read again to keep the list current
+        for doc in self.window.get_documents():
+            self.connect_document(doc)
+        self._tab_added_id = self.window.connect('tab-added', self.on_tab_added)
+
     def deactivate(self):
         debug('deactivate function called')
 
+        if self._poll_id is not None:
+            gobject.source_remove(self._poll_id)
+            self._poll_id = None
+        self._scanner = None
+        self.window.disconnect(self._tab_added_id)
+        for doc in self.window.get_documents():
+            handler_id = doc.get_data('TodoSavedHandler')
+            if handler_id is not None:
+                doc.disconnect(handler_id)
+                doc.set_data('TodoSavedHandler', None)
         self._browser = None
         self.todo_window = None
         self.window = None
         self.plugin = None
 
+    def on_tab_added(self, window, tab):
+        self.connect_document(tab.get_document())
+
+    def connect_document(self, doc):
+        handler_id = doc.connect('saved', self.on_document_saved)
+        doc.set_data('TodoSavedHandler', handler_id)
+
+    def on_document_saved(self, doc, error):
+        uri = doc.get_uri()
+        if error or uri is None or not uri.startswith('file://'):
+            return
+        path = urllib.unquote(uri[7:])
+        for scanner in TodoScanner._instances.values():
+            if scanner.rescan_file(path) and scanner is self._scanner and self._page_loaded:
+                debug("marks of %s updated" % path)
+                self.show_files([path])
+
     def add_menu(self):
         actions = [
             ('ToDo', gtk.STOCK_EDIT, _('TODO-List'), '<Control><Alt>t', _("List all TODO marks from your current project"), self.show_todo_marks)
@@ -124,8 +164,13 @@ class TodoWindowHelper:
             title = "TODO List (EDDT integration)"
             root = eddt_root
         else:
-            title = "TODO List (current directory)"
-            root = os.path.dirname(__file__)
+            doc = self.window.get_active_document()
+            root = doc and doc.get_uri() and project_root(doc.get_uri())
+            if root:
+                title = "TODO List (project of the current document)"
+            else:
+                title = "TODO List (current directory)"
+                root = os.path.dirname(__file__)
 
         rt_path = urllib.unquote(root.replace("file://", ""))
         return (rt_path, title)
@@ -167,7 +212,8 @@ class TodoWindowHelper:
         debug("title: %s" % title)
         debug("root: %s" % root)
 
-        html_str = parse_directory(root)
+        self._scanner = TodoScanner.get(root)
+        html_str = self._scanner.render_page()
 
         if self.todo_window:
             self.todo_window.show()
@@ -175,6 +221,7 @@ class TodoWindowHelper:
         else:
             self._browser = BrowserPage()
             self._browser.connect('navigation-requested', self.on_navigation_request)
+            self._browser.connect('load-finished', self.on_load_finished)
             self.todo_window = gtk.Window()
             self.todo_window.set_type_hint(gtk.gdk.WINDOW_TYPE_HINT_DIALOG)
             self.todo_window.resize(700,510)
@@ -185,8 +232,34 @@ class TodoWindowHelper:
             self.todo_window.show_all()
 
         self.todo_window.set_title(title)
+        self._page_loaded = False
         self._browser.load_string(html_str, "text/html", "utf-8", "file://")
 
+        # the marks are added to the page as the files are read
+        self._scanner.scan()
+        if self._poll_id is None:
+            self._poll_id = gobject.timeout_add(POLL_INTERVAL, self.poll_scanner)
+
+    def on_load_finished(self, page, frame):
+        self._page_loaded = True
+        # marks known from a previous scan or the cache are shown at once
+        self.show_files(self._scanner.files.keys())
+
+    def poll_scanner(self):
+        if not self._page_loaded:
+            return True
+        changed, finished = self._scanner.pop_results()
+        self.show_files(changed)
+        if finished:
+            debug("scan of %s finished" % self._scanner.root)
+            self._poll_id = None
+            return False
+        return True
+
+    def show_files(self, files):
+        if files:
+            self._browser.execute_script(self._scanner.update_script(files))
+
     def on_todo_close(self, *args):
         self.todo_window.hide()
         return True
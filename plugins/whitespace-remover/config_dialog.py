@@ -62,6 +62,14 @@ class ConfigDialog(gtk.Dialog):
         whitespace_checkbox.set_active(
             self._config.get_bool('remove_whitespace'))
 
+        checkbox_label = _("Only strip the lines _modified since the last save")
+        modified_lines_checkbox = gtk.CheckButton(checkbox_label)
+        modified_lines_checkbox.connect('clicked',
+                                        self.update_setting,
+                                        'modified_lines_only')
+        modified_lines_checkbox.set_active(
+            self._config.get_bool('modified_lines_only'))
+
         checkbox_label = _("_Remove newlines at the end of document")
         newlines_checkbox = gtk.CheckButton(checkbox_label)
         newlines_checkbox.connect('clicked',
@@ -78,6 +86,7 @@ class ConfigDialog(gtk.Dialog):
             self._config.get_bool('preserve_cursor'))
 
         config_box.pack_start(whitespace_checkbox, True, True, 0)
+        config_box.pack_start(modified_lines_checkbox, True, True, 0)
         config_box.pack_start(newlines_checkbox, True, True, 0)
         config_box.pack_start(preserve_cursor_checkbox, True, True, 0)
 
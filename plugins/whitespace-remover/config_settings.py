@@ -29,6 +29,7 @@ class ConfigSettings():
     _default_remove_whitespace = True
     _default_remove_newlines = True
     _default_preserve_cursor = True
+    _default_modified_lines_only = False
 
     def __init__(self):
         """Constructor."""
@@ -44,6 +45,10 @@ class ConfigSettings():
             self._set_bool_forced('preserve_cursor',
                                   self.__class__._default_preserve_cursor)
 
+        if not self._has_key('modified_lines_only'):
+            self._set_bool_forced('modified_lines_only',
+                                  self.__class__._default_modified_lines_only)
+
     def _has_key(self, key):
         """Test if a key exists."""
         key = self.__class__._gconf_base + key
@@ -20,6 +20,7 @@
 # trailsave plugin <http://users.tkk.fi/~otsaloma/gedit/>.
 
 from document_manipulator import DocumentManipulator
+from lib.lines import ModifiedLines
 
 class DocumentHelper:
     """Handles a document instance and reacts on saving events."""
@@ -28,12 +29,24 @@ class DocumentHelper:
         self._document = document
         self._config = config
 
-        self._saving_handler = self._document.connect('saving',
-                                                      self._on_saving)
+        self._modified_lines = ModifiedLines()
+
+        self._handlers = [
+            self._document.connect('saving', self._on_saving),
+            self._document.connect('insert-text',
+                                   self._modified_lines.on_insert_text),
+            self._document.connect('delete-range',
+                                   self._modified_lines.on_delete_range),
+            self._document.connect('saved',
+                                   self._modified_lines.on_saved_or_loaded),
+            self._document.connect('loaded',
+                                   self._modified_lines.on_saved_or_loaded),
+        ]
 
     def deactivate(self):
-        """Disconnects the saving-event."""
-        self._document.disconnect(self._saving_handler)
+        """Disconnects the document events."""
+        for handler in self._handlers:
+            self._document.disconnect(handler)
 
         self._config = None
         self._document = None
@@ -45,8 +58,12 @@ class DocumentHelper:
         preserve_cursor = self._config.get_bool('preserve_cursor')
 
         if (self._config.get_bool('remove_whitespace')):
+            lines = None
+            if (self._config.get_bool('modified_lines_only')):
+                lines = self._modified_lines.ranges
             DocumentManipulator.strip_trailing_spaces_on_lines(doc,
-                                                               preserve_cursor)
+                                                               preserve_cursor,
+                                                               lines)
 
         if (self._config.get_bool('remove_newlines')):
             DocumentManipulator.strip_trailing_blank_lines(doc,
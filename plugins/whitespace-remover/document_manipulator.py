@@ -19,9 +19,14 @@
 # This software is heavily inspried and in parts based on Osmo Salomaa's
 # trailsave plugin <http://users.tkk.fi/~otsaloma/gedit/>.
 
+import re
+
 class DocumentManipulator(object):
     """Provides class methods that manipluate a GtkTextBuffer object."""
 
+    # Spaces and tabs before a line break or the end of the document
+    _trailing_space = re.compile(ur"(?<![ \t])[ \t]+(?=[\r\n\u2029]|\Z)")
+
     @classmethod
     def strip_trailing_blank_lines(_cls_, doc, preserve_cursor):
         """Delete trailing newlines at the end of the document."""
@@ -41,23 +46,34 @@ class DocumentManipulator(object):
             doc.delete(itr, buffer_end)
 
     @classmethod
-    def strip_trailing_spaces_on_lines(_cls_, doc, preserve_cursor):
-        """Delete trailing space at the end of each line."""
-        cursor_line = doc.get_iter_at_mark(doc.get_insert()).get_line()
-        buffer_end = doc.get_end_iter()
+    def strip_trailing_spaces_on_lines(_cls_, doc, preserve_cursor,
+                                       lines=None):
+        """Delete trailing space at the end of each line, or only of the
+        lines in the given [start, end) line ranges."""
+        cursor = doc.get_iter_at_mark(doc.get_insert()).get_offset()
+        line_count = doc.get_line_count()
+        if lines is None:
+            lines = [(0, line_count)]
 
-        for line in range(buffer_end.get_line() + 1):
-            line_end = doc.get_iter_at_line(line)
-            if not line_end.ends_line():
-                line_end.forward_to_line_end()
-            itr = line_end.copy()
-            while itr.backward_char():
-                if (preserve_cursor and
-                    line == cursor_line and
-                    (itr.compare(doc.get_iter_at_mark(doc.get_insert())) < 0)):
-                    itr.forward_char()
-                    break
-                if not itr.get_char() in (" ", "\t"):
-                    itr.forward_char()
-                    break
-            doc.delete(itr, line_end)
+        spans = []
+        for first, last in lines:
+            last = min(last, line_count)
+            if first >= last:
+                continue
+            start = doc.get_iter_at_line(first)
+            end = doc.get_iter_at_line(last - 1)
+            if not end.ends_line():
+                end.forward_to_line_end()
+            base = start.get_offset()
+            text = unicode(doc.get_text(start, end), 'utf-8')
+            for match in _cls_._trailing_space.finditer(text):
+                start, end = base + match.start(), base + match.end()
+                if preserve_cursor and start < cursor <= end:
+                    start = cursor
+                if start < end:
+                    spans.append((start, end))
+
+        # Delete from the end backwards so the offsets left stay valid
+        for start, end in reversed(spans):
+            doc.delete(doc.get_iter_at_offset(start),
+                       doc.get_iter_at_offset(end))
@@ -12,6 +12,7 @@ dictionary for later use.
 
 @author: Sergey Chikuyonok (serge.che@gmail.com)
 '''
+import bisect
 import re
 
 start_tag = r'<([\w\:\-]+)((?:\s+[\w\-:]+(?:\s*=\s*(?:(?:"[^"]*")|(?:\'[^\']*\')|[^>\s]+))?)*)\s*(\/?)>'
@@ -158,6 +159,139 @@ def get_tags(html, start_ix, mode='xhtml'):
 	return _find_pair(html, start_ix, mode, lambda op, cl=None, ix=0: (op, cl) if op and op.type == 'tag' else None)
 
 
+class TagIndex(object):
+	"""
+	Positions of the tags and comment delimiters of a document, found in a 
+	single pass. Pairs are searched by walking these tokens instead of every
+	character of the document, and found pairs are remembered
+	"""
+	def __init__(self, html):
+		self.html = html
+		self.pairs = {}
+		tokens = []
+		
+		re_start_tag = re.compile(start_tag)
+		re_end_tag = re.compile(end_tag)
+		
+		ix = html.find('<')
+		while ix != -1:
+			m = re_end_tag.match(html, ix)
+			if m:
+				tokens.append((ix, 'close', m))
+			else:
+				m = re_start_tag.match(html, ix)
+				if m:
+					tokens.append((ix, 'open', m))
+				elif html.startswith('<!--', ix):
+					tokens.append((ix, 'comment_start', html.find('-->', ix)))
+			ix = html.find('<', ix + 1)
+		
+		ix = html.find('-->')
+		while ix != -1:
+			tokens.append((ix, 'comment_end', None))
+			ix = html.find('-->', ix + 1)
+		
+		tokens.sort()
+		self.tokens = tokens
+		self.positions = [token[0] for token in tokens]
+	
+	def find_comment_start(self, start_pos):
+		ix = self.html.rfind('<!--', 1, start_pos + 4)
+		return ix if ix != -1 else 0
+	
+	def find_pair(self, start_ix, mode):
+		"""
+		Returns arguments for the selection range function: opening tag,
+		closing tag and position, as the character by character search did
+		"""
+		key = (start_ix, mode)
+		if key not in self.pairs:
+			self.pairs[key] = self._find_pair(start_ix)
+		return self.pairs[key]
+	
+	def _find_pair(self, start_ix):
+		tokens = self.tokens
+		forward_stack = []
+		backward_stack = []
+		opening_tag = None
+		closing_tag = None
+		
+#		find opening tag
+		i = bisect.bisect_left(self.positions, start_ix) - 1
+		while i >= 0:
+			ix, kind, data = tokens[i]
+			if kind == 'close': # found closing tag
+				tmp_tag = Tag(data, ix)
+				if tmp_tag.start < start_ix and tmp_tag.end > start_ix: # direct hit on searched closing tag
+					closing_tag = tmp_tag
+				else:
+					backward_stack.append(tmp_tag)
+			elif kind == 'open': # found opening tag
+				tmp_tag = Tag(data, ix)
+				if tmp_tag.unary:
+					if tmp_tag.start < start_ix and tmp_tag.end > start_ix: # exact match
+						return (tmp_tag, None, start_ix)
+				elif backward_stack and backward_stack[-1].name == tmp_tag.name:
+					backward_stack.pop()
+				else: # found nearest unclosed tag
+					opening_tag = tmp_tag
+					break
+			elif kind == 'comment_start':
+				end_ix = (data if data != -1 else ix - 1) + 3
+				if ix < start_ix and end_ix >= start_ix:
+					return (Comment(ix, end_ix),)
+			else: # found comment end
+				# skip everything up to comment start
+				i = bisect.bisect_left(self.positions, self.find_comment_start(ix))
+			
+			i -= 1
+			
+		if not opening_tag:
+			return (None,)
+		
+		# find closing tag
+		if not closing_tag:
+			i = bisect.bisect_left(self.positions, start_ix)
+			while i < len(tokens):
+				ix, kind, data = tokens[i]
+				if kind == 'open': # found opening tag
+					tmp_tag = Tag(data, ix)
+					if not tmp_tag.unary:
+						forward_stack.append(tmp_tag)
+				elif kind == 'close': # found closing tag
+					tmp_tag = Tag(data, ix)
+					if forward_stack and forward_stack[-1].name == tmp_tag.name:
+						forward_stack.pop()
+					else:  # found matched closing tag
+						closing_tag = tmp_tag
+						break
+				elif kind == 'comment_start': # found comment, skip it
+					end_ix = data + 3 if data != -1 else ix + 2
+					i = bisect.bisect_left(self.positions, end_ix)
+					continue
+				else:
+					# looks like cursor was inside comment with invalid HTML
+					return (Comment(self.find_comment_start(ix), ix + 3),)
+				
+				i += 1
+		
+		return (opening_tag, closing_tag, start_ix)
+
+_index = None
+"Tag index of the last searched document"
+
+def get_index(html):
+	"""
+	Returns tag index of <code>html</code>, which is reused as long as the
+	same document is searched
+	@type html: str
+	@return: TagIndex
+	"""
+	global _index
+	if _index is None or (_index.html is not html and _index.html != html):
+		_index = TagIndex(html)
+	return _index
+
 def _find_pair(html, start_ix, mode='xhtml', action=make_range):
 	"""
 	Search for matching tags in <code>html</code>, starting from
@@ -175,99 +309,5 @@ def _find_pair(html, start_ix, mode='xhtml', action=make_range):
 	
 	@return: list
 	"""
-
-	forward_stack = []
-	backward_stack = []
-	opening_tag = None
-	closing_tag = None
-	html_len = len(html)
-	
 	set_mode(mode)
-
-	def has_match(substr, start=None):
-		if start is None:
-			start = ix
-
-		return html.find(substr, start) == start
-
-
-	def find_comment_start(start_pos):
-		while start_pos:
-			if html[start_pos] == '<' and has_match('<!--', start_pos):
-				break
-
-			start_pos -= 1
-
-		return start_pos
-
-#    find opening tag
-	ix = start_ix - 1
-	while ix >= 0:
-		ch = html[ix]
-		if ch == '<':
-			check_str = html[ix:]
-			m = re.match(end_tag, check_str)
-			if m:  # found closing tag
-				tmp_tag = Tag(m, ix)
-				if tmp_tag.start < start_ix and tmp_tag.end > start_ix: # direct hit on searched closing tag
-					closing_tag = tmp_tag
-				else:
-					backward_stack.append(tmp_tag)
-			else:
-				m = re.match(start_tag, check_str)
-				if m: # found opening tag
-					tmp_tag = Tag(m, ix);
-					if tmp_tag.unary:
-						if tmp_tag.start < start_ix and tmp_tag.end > start_ix: # exact match
-							return action(tmp_tag, None, start_ix)
-					elif backward_stack and backward_stack[-1].name == tmp_tag.name:
-						backward_stack.pop()
-					else: # found nearest unclosed tag
-						opening_tag = tmp_tag
-						break
-				elif check_str.startswith('<!--'): # found comment start
-					end_ix = check_str.find('-->') + ix + 3;
-					if ix < start_ix and end_ix >= start_ix:
-						return action(Comment(ix, end_ix))
-		elif ch == '-' and has_match('-->'): # found comment end
-			# search left until comment start is reached
-			ix = find_comment_start(ix)
-
-		ix -= 1
-		
-	if not opening_tag:
-		return action(None)
-	
-	# find closing tag
-	if not closing_tag:
-		ix = start_ix
-		while ix < html_len:
-			ch = html[ix]
-			if ch == '<':
-				check_str = html[ix:]
-				m = re.match(start_tag, check_str)
-				if m: # found opening tag
-					tmp_tag = Tag(m, ix);
-					if not tmp_tag.unary:
-						forward_stack.append(tmp_tag)
-				else:
-					m = re.match(end_tag, check_str)
-					if m:   #found closing tag
-						tmp_tag = Tag(m, ix);
-						if forward_stack and forward_stack[-1].name == tmp_tag.name:
-							forward_stack.pop()
-						else:  # found matched closing tag
-							closing_tag = tmp_tag;
-							break
-					elif has_match('<!--'): # found comment
-						ix += check_str.find('-->') + 3
-						continue
-			elif ch == '-' and has_match('-->'):
-				# looks like cursor was inside comment with invalid HTML
-				if not forward_stack or forward_stack[-1].type != 'comment':
-					end_ix = ix + 3
-					return action(Comment( find_comment_start(ix), end_ix ))
-				
-			ix += 1
-	
-	return action(opening_tag, closing_tag, start_ix)
+	return action(*get_index(html).find_pair(start_ix, cur_mode))